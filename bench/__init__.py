@@ -0,0 +1,12 @@
+# __init__.py
+#
+# Benchmarks for Project Lorikeet.
+#
+# bench.generate fills a PostgreSQL database with a synthetic training site,
+# and bench.harness times Lorikeet's helpers and routes against it:
+#
+#   createdb lorikeet_bench
+#   python -m bench.generate --dbname lorikeet_bench --scale 100k \
+#       --groups lorikeet/groups.py
+#   python -m bench.harness --dbname lorikeet_bench --json before.json
+#   python -m bench.harness --dbname lorikeet_bench --baseline before.json
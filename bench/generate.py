@@ -0,0 +1,389 @@
+# generate.py
+#
+# Synthetic dataset generator for Project Lorikeet.
+#
+# Creates the tables Lorikeet reads and fills them with a made-up training site
+# of a given number of submissions. Activity is skewed the way it is on the
+# real site: a few competitors make most of the submissions, a few problems get
+# most of the attempts, hard problems take more attempts, and the rate of
+# submissions grows over time. The same seed always gives the same data.
+
+import argparse
+import base64
+import bisect
+import datetime
+import io
+import random
+import sys
+import zipfile
+
+import psycopg2
+
+# Number of submissions for each named scale.
+SCALES = {
+    '1k': 1000,
+    '10k': 10000,
+    '100k': 100000,
+    '1m': 1000000,
+    '10m': 10000000,
+}
+
+# Only primary keys are created, so that indexes can be benchmarked by adding
+# them afterwards (checkdb.py --ddl writes out the ones Lorikeet needs).
+SCHEMA = [
+    'CREATE TABLE languages ('
+        'id text PRIMARY KEY, '
+        'name text NOT NULL);',
+    'CREATE TABLE competitors ('
+        'id serial PRIMARY KEY, '
+        'username text NOT NULL, '
+        'firstname text NOT NULL, '
+        'lastname text NOT NULL, '
+        'school text NOT NULL, '
+        'year integer, '
+        'state text, '
+        'country text);',
+    'CREATE TABLE problems ('
+        'id serial PRIMARY KEY, '
+        'name text NOT NULL, '
+        'title text NOT NULL);',
+    'CREATE TABLE sets ('
+        'name text PRIMARY KEY, '
+        'title text NOT NULL, '
+        'public boolean NOT NULL);',
+    'CREATE TABLE set_contents ('
+        'set text NOT NULL, '
+        'problemid integer NOT NULL);',
+    'CREATE TABLE submissions ('
+        'id serial PRIMARY KEY, '
+        'competitorid integer NOT NULL, '
+        'problemid integer NOT NULL, '
+        'attempt integer NOT NULL, '
+        'mark integer NOT NULL, '
+        'timestamp timestamp NOT NULL, '
+        'languageid text NOT NULL, '
+        'judge text NOT NULL, '
+        'submitted_file text NOT NULL);',
+    'CREATE TABLE progress ('
+        'competitorid integer NOT NULL, '
+        'problemid integer NOT NULL, '
+        'bestscore integer NOT NULL, '
+        'bestscoreon timestamp NOT NULL);',
+]
+TABLES = ['progress', 'submissions', 'set_contents', 'sets', 'problems',
+    'competitors', 'languages']
+
+# Each competitor's best score and when they first got it.
+PROGRESS_QUERY = ('INSERT INTO progress '
+    '(competitorid, problemid, bestscore, bestscoreon) '
+    'SELECT DISTINCT ON (competitorid, problemid) '
+        'competitorid, problemid, mark, timestamp '
+    'FROM submissions '
+    'ORDER BY competitorid, problemid, mark DESC, timestamp ASC;')
+
+# (id, name, relative popularity). Submissions in the 'zip' language are
+# base64-encoded zip archives.
+LANGUAGES = [
+    ('c', 'C', 10),
+    ('cpp', 'C++', 60),
+    ('pas', 'Pascal', 5),
+    ('py', 'Python', 15),
+    ('java', 'Java', 6),
+    ('hs', 'Haskell', 2),
+    ('php', 'PHP', 1),
+    ('ml', 'Caml', 1),
+    ('zip', 'Zip', 1),
+]
+
+_FIRST_NAMES = ['Alex', 'Sam', 'Jordan', 'Taylor', 'Chris', 'Jamie', 'Morgan',
+    'Casey', 'Riley', 'Avery', 'Quinn', 'Harper', 'Rowan', 'Emerson', 'Kai',
+    'Robin', 'Ashley', 'Drew', 'Jesse', 'Skyler']
+_LAST_NAMES = ['Smith', 'Nguyen', 'Chen', 'Williams', 'Brown', 'Wilson',
+    'Taylor', 'Lee', 'Martin', 'Anderson', 'Thompson', 'White', 'Tran',
+    'Kelly', 'Walker', 'Harris', 'Young', 'King', 'Wright', 'Patel']
+_STATES = ['NSW', 'VIC', 'QLD', 'WA', 'SA', 'TAS', 'ACT', 'NT']
+_WORDS = ['Bank', 'Robbery', 'Treasure', 'Island', 'Garden', 'Path', 'Tower',
+    'River', 'Bridge', 'Castle', 'Market', 'Orchard', 'Cards', 'Dice',
+    'Maze', 'Train', 'Kingdom', 'Flood', 'Lights', 'Sheep', 'Farm', 'Robots',
+    'Lasers', 'Mountain', 'Lake', 'Cookies', 'Fence', 'Tiles', 'Signal',
+    'Network', 'Library', 'Puzzle']
+
+_PARTIAL_MARKS = [0, 0, 0, 10, 20, 30, 40, 50, 60, 70, 80, 90]
+
+_JUDGE_OUTPUT = {
+    100: 'Test 1: OK\nTest 2: OK\nTest 3: OK\n',
+    0: 'Test 1: Wrong answer\nTest 2: Wrong answer\nTest 3: Time limit\n',
+}
+_PARTIAL_JUDGE_OUTPUT = 'Test 1: OK\nTest 2: Wrong answer\nTest 3: Time limit\n'
+
+_SOURCE = ('/* competitor %d, problem %d, attempt %d */\n'
+    '#include <cstdio>\n\n'
+    'int main() {\n'
+    '    freopen("in.txt", "r", stdin);\n'
+    '    freopen("out.txt", "w", stdout);\n'
+    '    int n;\n'
+    '    scanf("%%d", &n);\n'
+    '%s'
+    '    printf("%%d\\n", n);\n'
+    '    return 0;\n'
+    '}\n')
+
+# Picks indexes at random with probability proportional to weights.
+class WeightedChoice(object):
+    def __init__(self, weights, rng):
+        self.rng = rng
+        self.totals = []
+        total = 0.0
+        for w in weights:
+            total += w
+            self.totals.append(total)
+        self.total = total
+
+    def __call__(self):
+        return bisect.bisect_right(self.totals, self.rng.random() * self.total)
+
+# Returns n weights following Zipf's law with exponent s, in random order.
+def zipf_weights(n, s, rng):
+    weights = [1.0 / (i + 1) ** s for i in range(n)]
+    rng.shuffle(weights)
+    return weights
+
+# A file-like object for copy_from that reads rows from an iterator.
+class RowFile(object):
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        lines = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            line = '\t'.join(map(copy_value, row)) + '\n'
+            lines.append(line)
+            length += len(line)
+            self.count += 1
+        data = ''.join(lines)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+# Formats a value for COPY's text format.
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+        .replace('\n', '\\n').replace('\r', '\\r'))
+
+# Returns the number of competitors, problems and sets to go with a number of
+# submissions.
+def dataset_sizes(num_submissions):
+    num_competitors = max(20, num_submissions // 100)
+    num_problems = max(10, min(5000, int(num_submissions ** 0.5)))
+    num_sets = max(2, num_problems // 6)
+    return num_competitors, num_problems, num_sets
+
+def generate_competitors(rng, num_competitors):
+    for i in range(1, num_competitors + 1):
+        yield (i, 'user%06d' % (i), rng.choice(_FIRST_NAMES),
+            rng.choice(_LAST_NAMES),
+            '%s %s High School' % (rng.choice(_WORDS), rng.choice(_WORDS)),
+            rng.randint(7, 12), rng.choice(_STATES), 'Australia')
+
+def generate_problems(rng, num_problems):
+    for i in range(1, num_problems + 1):
+        first, second = rng.sample(_WORDS, 2)
+        yield (i, '%s%d' % (first.lower(), i), '%s %s' % (first, second))
+
+# Sets are mostly runs of consecutive problems, as on the real site, and some
+# problems are in more than one set.
+def generate_sets(rng, num_sets, num_problems):
+    sets = []
+    contents = []
+    for i in range(1, num_sets + 1):
+        name = 'set%04d' % (i)
+        sets.append((name, 'Training Set %d: %s' % (i, rng.choice(_WORDS)),
+            rng.random() < 0.8))
+        size = rng.randint(4, 12)
+        start = rng.randint(1, max(1, num_problems - size + 1))
+        for problemid in range(start, min(num_problems, start + size - 1) + 1):
+            contents.append((name, problemid))
+    return sets, contents
+
+# Yields submission rows. Each time a competitor works on a problem they make a
+# run of attempts, more of them on harder problems, until they get full marks
+# or give up. Runs start in order of time, but a run's attempts can go on past
+# the start of the next, so the rows are only roughly in order of time (as
+# they would be from many competitors submitting at once).
+def generate_submissions(rng, num_submissions, num_competitors, num_problems,
+    start, end):
+    pick_competitor = WeightedChoice(
+        zipf_weights(num_competitors, 1.1, rng), rng)
+    pick_problem = WeightedChoice(zipf_weights(num_problems, 0.9, rng), rng)
+    pick_language = WeightedChoice([x[2] for x in LANGUAGES], rng)
+    difficulty = [rng.random() for _ in range(num_problems)]
+
+    # (number of attempts, time of last attempt) for each (competitor,
+    # problem) pair seen so far.
+    pairs = {}
+    span = (end - start).total_seconds()
+    emitted = 0
+    while emitted < num_submissions:
+        # Time runs more slowly as we go, so later years have more
+        # submissions.
+        fraction = (float(emitted) / num_submissions) ** 0.7
+        timestamp = start + datetime.timedelta(seconds=span * fraction)
+
+        competitorid = pick_competitor() + 1
+        problemid = pick_problem() + 1
+        languageid = LANGUAGES[pick_language()][0]
+        attempts, last = pairs.get((competitorid, problemid), (0, None))
+        if last is not None and timestamp <= last:
+            timestamp = last + datetime.timedelta(minutes=1)
+
+        d = difficulty[problemid - 1]
+        num_attempts = min(num_submissions - emitted,
+            1 + int(rng.expovariate(1.0 / (1 + 4 * d))))
+        for i in range(num_attempts):
+            attempts += 1
+            timestamp += datetime.timedelta(seconds=rng.randint(30, 1800))
+            if rng.random() < (1 - d) * (0.4 + 0.15 * i):
+                mark = 100
+            else:
+                mark = rng.choice(_PARTIAL_MARKS)
+            judge = _JUDGE_OUTPUT.get(mark, _PARTIAL_JUDGE_OUTPUT)
+            source = _SOURCE % (competitorid, problemid, attempts,
+                '    n += %d;\n' % (i) * rng.randint(0, 20))
+            if languageid == 'zip':
+                source = zip_source(source)
+            yield (competitorid, problemid, attempts, mark, timestamp,
+                languageid, judge, source)
+            emitted += 1
+            if mark == 100:
+                break
+        pairs[(competitorid, problemid)] = (attempts, timestamp)
+
+# Returns source packed the way zip submissions are stored.
+def zip_source(source):
+    f = io.BytesIO()
+    archive = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+    archive.writestr('main.cpp', source)
+    archive.close()
+    return base64.b64encode(f.getvalue())
+
+def copy_rows(cur, table, columns, rows):
+    f = RowFile(rows)
+    cur.copy_from(f, table, columns=columns)
+    return f.count
+
+# Writes a groups module defining a few groups of the generated competitors and
+# sets, of increasing size, for benchmarking the group pages.
+def write_groups(path, rng, num_competitors, num_sets):
+    sizes = [('bench-small', 20, 2), ('bench-medium', 200, 10),
+        ('bench-large', 2000, 40)]
+    lines = [
+        '# groups.py',
+        '#',
+        '# Groups for a dataset made by bench.generate.',
+        '',
+        'GROUPS = {',
+    ]
+    for (name, num_users, num_group_sets) in sizes:
+        userids = rng.sample(range(1, num_competitors + 1),
+            min(num_users, num_competitors))
+        setids = sorted(rng.sample(range(1, num_sets + 1),
+            min(num_group_sets, num_sets)))
+        lines.append('    %r: {' % (name))
+        lines.append('        \'title\': %r,' % (name.replace('-', ' ').title()))
+        lines.append('        \'usernames\': %r,' %
+            (['user%06d' % (x) for x in userids]))
+        lines.append('        \'setnames\': %r,' % (['set%04d' % (x)
+            for x in setids]))
+        lines.append('    },')
+    lines.append('}')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def log(message):
+    sys.stderr.write(message + '\n')
+    sys.stderr.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Fill a database with a synthetic Lorikeet dataset.')
+    parser.add_argument('--dbname', default='lorikeet_bench',
+        help='database to fill (default: %(default)s)')
+    parser.add_argument('--scale', choices=sorted(SCALES, key=SCALES.get),
+        default='10k', help='number of submissions (default: %(default)s)')
+    parser.add_argument('--submissions', type=int,
+        help='exact number of submissions, instead of --scale')
+    parser.add_argument('--years', type=int, default=5,
+        help='length of time the submissions span (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+        help='random seed (default: %(default)s)')
+    parser.add_argument('--drop', action='store_true',
+        help='drop existing tables first')
+    parser.add_argument('--groups', metavar='PATH',
+        help='also write a groups module for the dataset to PATH')
+    args = parser.parse_args(argv)
+
+    num_submissions = args.submissions or SCALES[args.scale]
+    num_competitors, num_problems, num_sets = dataset_sizes(num_submissions)
+    rng = random.Random(args.seed)
+    end = datetime.datetime(2015, 1, 1)
+    start = end - datetime.timedelta(days=365 * args.years)
+
+    conn = psycopg2.connect('dbname=%s' % (args.dbname))
+    cur = conn.cursor()
+    if args.drop:
+        for table in TABLES:
+            cur.execute('DROP TABLE IF EXISTS %s;' % (table))
+    for statement in SCHEMA:
+        cur.execute(statement)
+
+    copy_rows(cur, 'languages', ('id', 'name'),
+        [x[:2] for x in LANGUAGES])
+    log('competitors: %d' % copy_rows(cur, 'competitors',
+        ('id', 'username', 'firstname', 'lastname', 'school', 'year', 'state',
+            'country'),
+        generate_competitors(rng, num_competitors)))
+    log('problems: %d' % copy_rows(cur, 'problems', ('id', 'name', 'title'),
+        generate_problems(rng, num_problems)))
+    sets, contents = generate_sets(rng, num_sets, num_problems)
+    log('sets: %d' % copy_rows(cur, 'sets', ('name', 'title', 'public'), sets))
+    copy_rows(cur, 'set_contents', ('set', 'problemid'), contents)
+    log('submissions: %d' % copy_rows(cur, 'submissions',
+        ('competitorid', 'problemid', 'attempt', 'mark', 'timestamp',
+            'languageid', 'judge', 'submitted_file'),
+        generate_submissions(rng, num_submissions, num_competitors,
+            num_problems, start, end)))
+    cur.execute(PROGRESS_QUERY)
+    log('progress: %d' % (cur.rowcount))
+
+    # Explicit ids were copied in, so move the sequences past them.
+    for table in ('competitors', 'problems', 'submissions'):
+        cur.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+            "(SELECT max(id) FROM %s));" % (table, table))
+    conn.commit()
+
+    conn.autocommit = True
+    cur.execute('ANALYZE;')
+    cur.close()
+    conn.close()
+
+    if args.groups:
+        write_groups(args.groups, rng, num_competitors, num_sets)
+        log('groups: %s' % (args.groups))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,455 @@
+# harness.py
+#
+# Benchmark harness for Project Lorikeet.
+#
+# Times the helper functions in views.py and every page and API route (through
+# the Flask test client) except the live feed against a database made by bench.generate. For each, reports latency
+# percentiles along with the number of queries run and rows fetched per call.
+# Results can be saved as JSON and compared against an earlier run, so that
+# regressions stand out.
+
+import argparse
+import functools
+import json
+import sys
+import threading
+import timeit
+
+import psycopg2
+import psycopg2.extensions
+
+from lorikeet import app
+from lorikeet import views
+
+# Counts the queries run and rows fetched on every connection the harness
+# opens, from any thread.
+class QueryCounter(object):
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self._lock = threading.Lock()
+
+    def add_query(self):
+        with self._lock:
+            self.queries += 1
+
+    def add_rows(self, n):
+        with self._lock:
+            self.rows += n
+
+    def reset(self):
+        with self._lock:
+            self.queries = 0
+            self.rows = 0
+
+counter = QueryCounter()
+
+# A cursor that reports to counter.
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        counter.add_query()
+        return super(CountingCursor, self).execute(query, vars)
+
+    def fetchone(self):
+        row = super(CountingCursor, self).fetchone()
+        if row is not None:
+            counter.add_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        rows = super(CountingCursor, self).fetchmany(size)
+        counter.add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super(CountingCursor, self).fetchall()
+        counter.add_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+# Points Lorikeet at the benchmark database, through counting cursors.
+def use_database(dbname):
+    views._DATABASE_NAME = dbname
+    connect = functools.partial(psycopg2.connect, 'dbname=%s' % (dbname),
+        cursor_factory=CountingCursor)
+    views.db_pool.connect = views.fanout_pool.connect = connect
+
+# Empties every in-process and on-disk cache, so the next call does all of its
+# work against the database. The analytics snapshot is loaded again straight
+# away: pages never load it themselves (they fall back to other queries, or
+# answer 503, until it is ready), so a fresh copy is as cold as it gets. With
+# snapshot False, the snapshot is left as it is.
+def reset_caches(snapshot=True):
+    views.clear_entity_caches()
+    views.response_cache.clear()
+    views.archive_cache.clear()
+    views._PROBLEM_STATS.clear()
+    views._PROBLEM_LEADERBOARDS.clear()
+    views.overall_leaderboard.indexes = None
+    with views._SCOREBOARDS_LOCK:
+        views._SCOREBOARDS.clear()
+    with views._HISTORIES_LOCK:
+        views._HISTORIES.clear()
+    views._watermark['read_at'] = None
+    if snapshot and views.submission_snapshot is not None:
+        views.submission_snapshot.clear()
+        load_snapshot()
+
+# Loads the analytics snapshot, if NumPy is available, and waits until it is
+# ready, so that the pages using it are timed with it rather than without.
+def load_snapshot():
+    snapshot = views.submission_snapshot
+    if snapshot is None or snapshot.ready:
+        return
+    snapshot.start()
+    thread = snapshot._thread
+    if thread is not None:
+        thread.join()
+
+# Raised by pick_samples when the database is too empty to benchmark.
+class NoSamples(Exception):
+    pass
+
+# Picks the entities to benchmark with: the busiest competitor, their most
+# attempted problem, the biggest set, the biggest group and the newest
+# submission in the 'zip' language (so the archive decoding is timed too), and
+# a time a day before the latest submission to show scoreboards at.
+# Raises NoSamples if there are no submissions or no sets to pick from.
+def pick_samples():
+    conn = views.db_pool.connect()
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT c.username, c.lastname, p.name, p.title '
+            'FROM submissions s '
+            'INNER JOIN competitors c ON (c.id = s.competitorid) '
+            'INNER JOIN problems p ON (p.id = s.problemid) '
+            'GROUP BY c.id, p.id '
+            'ORDER BY count(*) DESC LIMIT 1;')
+        row = cur.fetchone()
+        if row is None:
+            raise NoSamples('the database has no submissions')
+        username, lastname, problemname, title = row
+        cur.execute('SELECT set FROM set_contents '
+            'GROUP BY set ORDER BY count(*) DESC, set LIMIT 1;')
+        row = cur.fetchone()
+        if row is None:
+            raise NoSamples('the database has no problem sets')
+        setname = row[0]
+        cur.execute("SELECT max(timestamp) - interval '1 day' "
+            'FROM submissions;')
+        scoreboard_at = cur.fetchone()[0]
+        cur.execute('SELECT c.username, p.name, s.attempt '
+            'FROM submissions s '
+            'INNER JOIN competitors c ON (c.id = s.competitorid) '
+            'INNER JOIN problems p ON (p.id = s.problemid) '
+            "WHERE s.languageid = 'zip' "
+            'ORDER BY s.timestamp DESC LIMIT 1;')
+        zipped = cur.fetchone()
+    finally:
+        cur.close()
+        conn.close()
+
+    groupname = None
+    params = getattr(views.groups, 'GROUPS', {})
+    if params:
+        groupname = max(sorted(params),
+            key=lambda x: len(params[x].get('usernames', [])))
+
+    return {
+        'username': username,
+        'problemname': problemname,
+        'setname': setname,
+        'groupname': groupname,
+        'user_query': lastname.lower(),
+        'problem_query': title.split()[0].lower(),
+        'zipped': zipped,
+        'scoreboard_at': scoreboard_at.strftime('%Y-%m-%dT%H:%M'),
+    }
+
+# Returns a list of (name, function) for the helpers in views.py. Each function
+# is called inside a request context.
+def helper_benchmarks(samples):
+    with app.app_context():
+        user = views.get_user(username=samples['username'])
+        problem = views.get_problem(problemname=samples['problemname'])
+        problem_set = views.get_set(samples['setname'])
+        group = views.get_group(samples['groupname'])
+
+    def stream(**kwargs):
+        return sum(1 for _ in views.stream_submissions(**kwargs))
+    def export(**kwargs):
+        return sum(len(data) for (_, data, _) in
+            views.export_submissions(**kwargs))
+
+    ret = [
+        ('get_user', functools.partial(views.get_user,
+            username=user.username)),
+        ('get_problem', functools.partial(views.get_problem,
+            problemname=problem.name)),
+        ('get_set', functools.partial(views.get_set, problem_set.name)),
+        ('get_users_by_name', functools.partial(views.get_users_by_name,
+            [user.username])),
+        ('get_sets_by_name', functools.partial(views.get_sets_by_name,
+            [problem_set.name])),
+        ('get_num_attempts', functools.partial(views.get_num_attempts,
+            user.userid, problem.problemid)),
+        ('get_submission', functools.partial(views.get_submission,
+            user.username, problem.name, 1)),
+        ('get_submission_summary', functools.partial(
+            views.get_submission_summary, user.username, problem.name, -1)),
+        ('get_submission_watermark', views.get_submission_watermark),
+        ('filter_submissions', views.filter_submissions),
+        ('filter_submissions(user)', functools.partial(
+            views.filter_submissions, users=[user.username])),
+        ('filter_submissions(problem)', functools.partial(
+            views.filter_submissions, problems=[problem.name])),
+        ('filter_submissions(set)', functools.partial(
+            views.filter_submissions, sets=[problem_set.name])),
+        ('stream_submissions(user)', functools.partial(stream,
+            users=[user.username])),
+        ('user_search_query', functools.partial(views.user_search_query,
+            samples['user_query'])),
+        ('problem_search_query', functools.partial(views.problem_search_query,
+            samples['problem_query'])),
+        ('set_search_query', functools.partial(views.set_search_query,
+            samples['problem_query'])),
+        ('sets_containing_problems', functools.partial(
+            views.sets_containing_problems, problem_set.problems)),
+        ('problem_stats', functools.partial(views.problem_stats,
+            problem.problemid)),
+        ('get_problem_competitor_stats', functools.partial(
+            views.get_problem_competitor_stats, problem.problemid)),
+        ('get_problem_viewers', functools.partial(views.get_problem_viewers,
+            problem.problemid)),
+        ('recent_solves', functools.partial(views.recent_solves,
+            user.userid)),
+        ('export_submissions(user)', functools.partial(export,
+            users=[user.username])),
+    ]
+    if samples['zipped'] is not None:
+        ret.append(('export_submissions(zip user)', functools.partial(export,
+            users=[samples['zipped'][0]])))
+    if group is not None:
+        problems = views.group_problems(group)
+        ret.extend([
+            ('get_best_scores', functools.partial(views.get_best_scores,
+                group.users, problems)),
+            ('get_group_scores', functools.partial(views.get_group_scores,
+                group)),
+            ('get_group_marks', functools.partial(views.get_group_marks,
+                group)),
+            ('load_groups', functools.partial(views.load_groups,
+                dict(views.groups.GROUPS))),
+        ])
+    return [(name, functools.partial(call_helper, fn)) for (name, fn) in ret]
+
+def call_helper(fn):
+    with app.test_request_context():
+        fn()
+
+# Returns a list of (name, function) for the pages and the JSON API. The live
+# feed never ends, so it isn't included.
+def route_benchmarks(samples):
+    s = samples
+    api = views._API_PREFIX
+    paths = [
+        '/',
+        '/user/%s' % (s['username']),
+        '/problem/%s' % (s['problemname']),
+        '/set/%s' % (s['setname']),
+        '/user/%s/problem/%s' % (s['username'], s['problemname']),
+        '/user/%s/set/%s' % (s['username'], s['setname']),
+        '/user/%s/problem/%s/1' % (s['username'], s['problemname']),
+        '/user/%s/problem/%s/1/extract' % (s['username'], s['problemname']),
+        '/user/%s?all=1' % (s['username']),
+        '/user/%s/export' % (s['username']),
+        '/set/%s/export' % (s['setname']),
+        '/search/user?query=%s' % (s['user_query']),
+        '/search/problem?query=%s' % (s['problem_query']),
+        '/leaderboard',
+        '/leaderboard?by=score&user=%s' % (s['username']),
+        '/problem/%s/leaderboard' % (s['problemname']),
+        '/set/%s/analytics' % (s['setname']),
+        api + '/user/%s' % (s['username']),
+        api + '/problem/%s' % (s['problemname']),
+        api + '/set/%s' % (s['setname']),
+        api + '/search/user?query=%s' % (s['user_query']),
+        api + '/search/problem?query=%s' % (s['problem_query']),
+    ]
+    if s['zipped'] is not None:
+        paths.extend([
+            '/user/%s/problem/%s/%d/extract' % s['zipped'],
+            '/user/%s/export' % (s['zipped'][0]),
+        ])
+    if s['groupname'] is not None:
+        paths.extend([
+            '/group/%s/scoreboard' % (s['groupname']),
+            '/group/%s/scoreboard?at=%s' % (s['groupname'],
+                s['scoreboard_at']),
+            '/group/%s/subs' % (s['groupname']),
+            '/group/%s/analytics' % (s['groupname']),
+            '/group/%s/export' % (s['groupname']),
+            api + '/group/%s/scoreboard' % (s['groupname']),
+            '/group/%s/problem/%s' % (s['groupname'], s['problemname']),
+            '/group/%s/set/%s' % (s['groupname'], s['setname']),
+        ])
+
+    client = app.test_client()
+    return [(path, functools.partial(get_page, client, path))
+        for path in paths]
+
+def get_page(client, path):
+    response = client.get(path)
+    try:
+        response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError('%s returned %s' % (path, response.status))
+    finally:
+        response.close()
+
+# Returns the value below which fraction of the sorted values fall.
+def percentile(values, fraction):
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+# Calls fn warmup times and then iterations times, returning its latencies (in
+# milliseconds) and the queries and rows per call.
+def run_benchmark(fn, iterations, warmup, cold):
+    for _ in range(warmup):
+        if cold:
+            reset_caches()
+        fn()
+
+    times = []
+    queries = 0
+    rows = 0
+    for _ in range(iterations):
+        if cold:
+            reset_caches()
+        counter.reset()
+        start = timeit.default_timer()
+        fn()
+        times.append((timeit.default_timer() - start) * 1000)
+        queries += counter.queries
+        rows += counter.rows
+
+    times.sort()
+    return {
+        'iterations': iterations,
+        'mean': sum(times) / len(times),
+        'p50': percentile(times, 0.5),
+        'p90': percentile(times, 0.9),
+        'p99': percentile(times, 0.99),
+        'max': times[-1],
+        'queries': float(queries) / iterations,
+        'rows': float(rows) / iterations,
+    }
+
+# Returns a list of the ways result is worse than baseline: a p50 more than
+# threshold (a fraction) slower, or more queries or rows per call.
+def regressions(result, baseline, threshold):
+    ret = []
+    if result['p50'] > baseline['p50'] * (1 + threshold):
+        ret.append('p50 %.2fx' % (result['p50'] / max(baseline['p50'], 1e-9)))
+    if result['queries'] > baseline['queries']:
+        ret.append('queries %g -> %g' % (baseline['queries'],
+            result['queries']))
+    if result['rows'] > baseline['rows']:
+        ret.append('rows %g -> %g' % (baseline['rows'], result['rows']))
+    return ret
+
+def print_results(results, baseline, threshold, out=sys.stdout):
+    width = max([len(name) for (name, _) in results] + [4])
+    out.write('%-*s %9s %9s %9s %9s %8s %9s\n' % (width, 'name', 'p50 ms',
+        'p90 ms', 'p99 ms', 'max ms', 'queries', 'rows'))
+    num_regressions = 0
+    for (name, r) in results:
+        if 'error' in r:
+            out.write('%-*s  error: %s\n' % (width, name, r['error']))
+            continue
+        line = '%-*s %9.2f %9.2f %9.2f %9.2f %8.1f %9.1f' % (width, name,
+            r['p50'], r['p90'], r['p99'], r['max'], r['queries'], r['rows'])
+        if baseline and name in baseline and 'error' not in baseline[name]:
+            worse = regressions(r, baseline[name], threshold)
+            if worse:
+                num_regressions += 1
+                line += '  REGRESSION: ' + ', '.join(worse)
+        out.write(line + '\n')
+    return num_regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark Lorikeet against a generated dataset.')
+    parser.add_argument('--dbname', default='lorikeet_bench',
+        help='database made by bench.generate (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=20,
+        help='timed calls per benchmark (default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=2,
+        help='untimed calls before timing (default: %(default)s)')
+    parser.add_argument('--cold', action='store_true',
+        help='empty all caches before every call')
+    parser.add_argument('--only', metavar='TEXT',
+        help='only run benchmarks whose names contain TEXT')
+    parser.add_argument('--no-helpers', action='store_true',
+        help='skip the helper functions')
+    parser.add_argument('--no-routes', action='store_true',
+        help='skip the pages')
+    parser.add_argument('--json', metavar='PATH',
+        help='save the results to PATH')
+    parser.add_argument('--baseline', metavar='PATH',
+        help='compare against results saved with --json')
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help='slowdown counted as a regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    use_database(args.dbname)
+    load_snapshot()
+    try:
+        samples = pick_samples()
+    except NoSamples as e:
+        sys.stderr.write('error: %s; fill it with bench.generate first\n' % (e))
+        return 1
+    benchmarks = []
+    if not args.no_helpers:
+        benchmarks.extend(helper_benchmarks(samples))
+    if not args.no_routes:
+        benchmarks.extend(route_benchmarks(samples))
+    if args.only:
+        benchmarks = [b for b in benchmarks if args.only in b[0]]
+
+    results = []
+    for (name, fn) in benchmarks:
+        try:
+            r = run_benchmark(fn, args.iterations, args.warmup, args.cold)
+        except Exception as e:
+            r = {'error': '%s: %s' % (type(e).__name__, e)}
+        results.append((name, r))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    num_regressions = print_results(results, baseline, args.threshold)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'samples': samples,
+                'cold': args.cold,
+                'iterations': args.iterations,
+                'results': dict(results),
+            }, f, indent=2, sort_keys=True)
+
+    return 1 if num_regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
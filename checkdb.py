@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# checkdb.py
+#
+# Checks that a database is ready for Project Lorikeet.
+#
+# Runs each of Lorikeet's helpers and pages once against the database (using
+# the samples from bench.harness), recording every distinct query they issue.
+# The queries that only run on later requests or in the background (the next
+# and previous pages of submissions, refreshes since a watermark, the live feed
+# and the analytics snapshot) are run explicitly too.
+# Each query is then EXPLAINed and any sequential scan of a large table is
+# reported. Finally, the indexes in views.INDEXES and views.SEARCH_INDEXES
+# that are missing are listed, along with the DDL to create them. Exits with
+# status 1 if anything was found.
+
+import argparse
+import calendar
+import functools
+import sys
+
+import psycopg2
+
+from bench import harness
+from lorikeet import app
+from lorikeet import views
+from lorikeet import schema
+
+# Returns a list of (name, function) for the queries that the benchmarks don't
+# reach from a cold start: keyset pages either side of a first page, the
+# incremental refreshes of statistics, leaderboards and scoreboards since the
+# watermark, the live feed reading on from a cursor, and the snapshot loads.
+def background_calls(samples):
+    with app.test_request_context():
+        user = views.get_user(username=samples['username'])
+        problem = views.get_problem(problemname=samples['problemname'])
+        first_page = views.filter_submissions()
+        since = views.get_submission_watermark() - views._WATERMARK_SLACK
+        feed_cursor = views.recent_submissions_cursor()
+    epoch_since = calendar.timegm(since.timetuple())
+    userids = [user.userid]
+    problemids = [problem.problemid]
+
+    def drain(chunks):
+        return sum(len(rows) for rows in chunks)
+
+    ret = [
+        ('filter_submissions(before)', functools.partial(
+            views.filter_submissions, before=first_page.older_cursor)),
+        ('filter_submissions(after)', functools.partial(
+            views.filter_submissions, after=first_page.older_cursor)),
+        ('get_problem_competitor_stats(since)', functools.partial(
+            views.get_problem_competitor_stats, problem.problemid, since)),
+        ('update_best_scores', functools.partial(views.update_best_scores,
+            [[None]], [user], [problem], since)),
+        ('get_competitor_totals(since)', functools.partial(
+            views.get_competitor_totals, since)),
+        ('get_problem_progress(since)', functools.partial(
+            views.get_problem_progress, problem.problemid, since)),
+        ('get_marked_submissions', functools.partial(
+            views.get_marked_submissions, userids, problemids, None,
+            since)),
+        ('get_marked_submissions(since)', functools.partial(
+            views.get_marked_submissions, userids, problemids, since,
+            since + views._WATERMARK_SLACK)),
+        ('fetch_new_submissions', functools.partial(
+            views.fetch_new_submissions, None)),
+        ('fetch_new_submissions(cursor)', functools.partial(
+            views.fetch_new_submissions, feed_cursor)),
+        ('fetch_snapshot_submissions', lambda: drain(
+            views.fetch_snapshot_submissions(None))),
+        ('fetch_snapshot_submissions(since)', lambda: drain(
+            views.fetch_snapshot_submissions(epoch_since))),
+        ('fetch_snapshot_progress', lambda: drain(
+            views.fetch_snapshot_progress())),
+    ]
+    return [(name, functools.partial(harness.call_helper, fn))
+        for (name, fn) in ret]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check a database\'s indexes and query plans.')
+    parser.add_argument('--dbname', default=views._DATABASE_NAME,
+        help='database to check (default: %(default)s)')
+    parser.add_argument('--analyze', action='store_true',
+        help='run each query with EXPLAIN ANALYZE')
+    parser.add_argument('--min-rows', type=int, default=10000,
+        help='smallest table whose sequential scans are reported '
+            '(default: %(default)s)')
+    parser.add_argument('--ddl', metavar='PATH',
+        help='write the DDL for missing indexes to PATH')
+    args = parser.parse_args(argv)
+
+    # Record the queries of every helper and page, with empty caches so that
+    # they all reach the database.
+    recorder = schema.QueryRecorder()
+    views._DATABASE_NAME = args.dbname
+    connect = functools.partial(psycopg2.connect, 'dbname=%s' % (args.dbname),
+        cursor_factory=recorder.cursor_factory)
+    views.db_pool.connect = views.fanout_pool.connect = connect
+    try:
+        samples = harness.pick_samples()
+    except harness.NoSamples as e:
+        print('error: %s, so there is nothing to check' % (e))
+        return 1
+
+    # The snapshot's queries are checked by background_calls; load it once
+    # first so that the pages using it don't answer 503.
+    recorder.label = 'load_snapshot'
+    harness.load_snapshot()
+    recorder.label = None
+    calls = (harness.helper_benchmarks(samples) +
+        harness.route_benchmarks(samples) + background_calls(samples))
+    problems = 0
+    for (name, fn) in calls:
+        harness.reset_caches(snapshot=False)
+        recorder.label = name
+        try:
+            fn()
+        except Exception as e:
+            problems += 1
+            print('error: %s: %s: %s' % (name, type(e).__name__, e))
+        recorder.label = None
+
+    conn = psycopg2.connect('dbname=%s' % (args.dbname))
+    cur = conn.cursor()
+    sizes = schema.table_sizes(cur)
+
+    print('%d query shapes' % (len(recorder.queries)))
+    for (query, (params, labels)) in recorder.queries.items():
+        if not query.lstrip().upper().startswith(('SELECT', 'WITH')):
+            continue
+        summary = ' '.join(query.split())
+        try:
+            plan = schema.explain(cur, query, params, args.analyze)
+        except psycopg2.Error as e:
+            problems += 1
+            print('\nerror: %s\n  %s\n  %s' % (', '.join(labels),
+                summary[:200], str(e).strip()))
+            continue
+        finally:
+            conn.rollback()
+
+        scans = schema.seq_scans(plan, sizes, args.min_rows)
+        status = 'SEQ SCAN' if scans else 'ok'
+        line = '\n%s (cost %.0f): %s\n  %s' % (status, plan['Total Cost'],
+            ', '.join(labels), summary[:200])
+        if 'Actual Total Time' in plan:
+            line += '\n  took %.1fms' % (plan['Actual Total Time'])
+        print(line)
+        for (table, condition) in scans:
+            problems += 1
+            print('  sequential scan of %s (%d rows)%s' % (table,
+                sizes.get(table, 0),
+                ' filtering on %s' % (condition) if condition else ''))
+
+    missing = schema.missing_indexes(cur,
+        [views.INDEXES, views.SEARCH_INDEXES])
+    cur.close()
+    conn.close()
+
+    if missing:
+        problems += 1
+        print('\nMissing indexes:\n')
+        print('\n'.join(missing))
+        if args.ddl:
+            with open(args.ddl, 'w') as f:
+                f.write('\n'.join(missing) + '\n')
+    else:
+        print('\nAll indexes present.')
+
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
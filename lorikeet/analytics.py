@@ -0,0 +1,325 @@
+# analytics.py
+#
+# In-memory columnar analytics for Project Lorikeet.
+
+import logging
+import threading
+import time
+
+# NumPy is optional. Without it, no snapshot can be built and callers should
+# fall back to querying the database.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# Score distributions have a bin for each 10 marks, with full marks in a bin of
+# their own.
+NUM_SCORE_BINS = 11
+
+# Columns of integers held in NumPy arrays with room to grow, so that appending
+# rows doesn't copy every column each time.
+class _Columns(object):
+    def __init__(self, dtypes):
+        self.dtypes = dtypes
+        self.size = 0
+        self.arrays = [numpy.empty(0, dtype) for (_, dtype) in dtypes]
+        self.names = dict((name, i) for (i, (name, _)) in enumerate(dtypes))
+
+    def __getitem__(self, name):
+        return self.arrays[self.names[name]][:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays)
+
+    # Drops every row from the size'th on.
+    def truncate(self, size):
+        self.size = min(size, self.size)
+
+    # Appends rows, a sequence of tuples with a value for each column.
+    def append(self, rows):
+        if not len(rows):
+            return
+        rows = numpy.array(rows, dtype=numpy.int64).reshape(-1,
+            len(self.dtypes))
+        end = self.size + len(rows)
+        capacity = len(self.arrays[0])
+        if end > capacity:
+            capacity = max(end, 2 * capacity, 1024)
+            for (i, (_, dtype)) in enumerate(self.dtypes):
+                grown = numpy.empty(capacity, dtype)
+                grown[:self.size] = self.arrays[i][:self.size]
+                self.arrays[i] = grown
+        for i in range(len(self.dtypes)):
+            self.arrays[i][self.size:end] = rows[:, i]
+        self.size = end
+
+# A copy of the submissions and progress tables held in memory as NumPy
+# arrays, for computing aggregate statistics across many problems and
+# competitors without querying the database for each page.
+#
+# fetch_submissions(since) returns an iterable of lists of rows of the form
+# (competitorid, problemid, attempt, mark or -1 if unmarked, timestamp in
+# seconds since the epoch) for every submission made after since (or all of
+# them if since is None), in order of time. fetch_progress() likewise returns
+# lists of (competitorid, problemid) rows.
+#
+# The snapshot is first loaded on a background thread by start(); until then
+# ready is False. After that, whenever it is queried and hasn't been brought up
+# to date for refresh_interval seconds, a refresh is started on the same
+# background thread: submissions since slack seconds before the newest one
+# already held are read again (to pick up submissions whose judging finished
+# late) and replace those held. Progress rows (which also record which
+# competitors have viewed a problem) are all read again every progress_max_age
+# seconds.
+#
+# The database is only ever read on the background thread, never on the
+# thread of a query (which may be in the middle of a request with connections
+# of its own), and never with _lock held: new rows are read first and then
+# swapped in under the lock, so queries and stats() only wait for the swap.
+# Until a refresh finishes, queries carry on with the rows already held.
+class SubmissionSnapshot(object):
+    def __init__(self, fetch_submissions, fetch_progress, refresh_interval=10,
+        progress_max_age=3600, slack=300):
+        self.fetch_submissions = fetch_submissions
+        self.fetch_progress = fetch_progress
+        self.refresh_interval = refresh_interval
+        self.progress_max_age = progress_max_age
+        self.slack = slack
+        self.ready = False
+        self.subs = None
+        self.progress = None
+        self.last_refresh = None
+        self.progress_loaded_at = None
+        self.refreshes = 0
+        self.errors = 0
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    # Starts loading the snapshot on a background thread, if it isn't loaded
+    # or being loaded already.
+    def start(self):
+        self._run_in_background(self._load, if_ready=False)
+
+    # Starts a refresh on a background thread if one is due, unless the thread
+    # is busy already.
+    def refresh(self):
+        now = time.time()
+        with self._lock:
+            if not self.ready:
+                return
+            due = (now - self.last_refresh >= self.refresh_interval or
+                now - self.progress_loaded_at >= self.progress_max_age)
+        if due:
+            self._run_in_background(self._refresh, if_ready=True)
+
+    # Drops everything held, so the next start() loads the snapshot again.
+    # Waits for a load or refresh in progress to finish first.
+    def clear(self):
+        with self._thread_lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        with self._lock:
+            self.ready = False
+            self.subs = self.progress = None
+            self.last_refresh = self.progress_loaded_at = None
+
+    # Runs target on the background thread, if it isn't running already and
+    # ready is if_ready.
+    def _run_in_background(self, target, if_ready):
+        with self._thread_lock:
+            if self.ready != if_ready or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._background,
+                args=(target, ), name='lorikeet-snapshot')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _background(self, target):
+        try:
+            target()
+        finally:
+            # Let the next load or refresh start, including after a failure.
+            with self._thread_lock:
+                self._thread = None
+
+    def _load(self):
+        try:
+            subs = _Columns([
+                ('competitorid', numpy.int32),
+                ('problemid', numpy.int32),
+                ('attempt', numpy.int32),
+                ('mark', numpy.int16),
+                ('timestamp', numpy.int64),
+            ])
+            for rows in self.fetch_submissions(None):
+                subs.append(rows)
+            progress = self.read_progress()
+            now = time.time()
+            with self._lock:
+                self.subs = subs
+                self.progress = progress
+                self.last_refresh = self.progress_loaded_at = now
+                self.refreshes += 1
+                self.ready = True
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            logger.exception('Could not load the submission snapshot')
+
+    def _refresh(self):
+        now = time.time()
+        with self._lock:
+            if not self.ready:
+                return
+            refresh_subs = now - self.last_refresh >= self.refresh_interval
+            refresh_progress = (now - self.progress_loaded_at >=
+                self.progress_max_age)
+            timestamps = self.subs['timestamp']
+            since = None
+            if len(timestamps):
+                since = int(timestamps[-1]) - self.slack
+
+        chunks = progress = None
+        try:
+            if refresh_subs:
+                chunks = list(self.fetch_submissions(since))
+            if refresh_progress:
+                progress = self.read_progress()
+        except Exception:
+            # Stale statistics are better than none.
+            with self._lock:
+                self.errors += 1
+                self.last_refresh = now
+            logger.exception('Could not refresh the submission snapshot')
+            return
+
+        with self._lock:
+            if chunks is not None:
+                # Rows after since were read again, so drop the ones held.
+                if since is not None:
+                    self.subs.truncate(numpy.searchsorted(
+                        self.subs['timestamp'], since, side='right'))
+                for rows in chunks:
+                    self.subs.append(rows)
+                self.last_refresh = now
+                self.refreshes += 1
+            if progress is not None:
+                self.progress = progress
+                self.progress_loaded_at = now
+
+    # Reads every progress row into new columns.
+    def read_progress(self):
+        progress = _Columns([
+            ('competitorid', numpy.int32),
+            ('problemid', numpy.int32),
+        ])
+        for rows in self.fetch_progress():
+            progress.append(rows)
+        return progress
+
+    # Returns the rows of the submission and progress columns named that are
+    # for one of problemids and (if given) one of userids, starting a refresh
+    # if one is due.
+    def _select(self, sub_columns, progress_columns, problemids, userids):
+        self.refresh()
+        with self._lock:
+            ret = []
+            for (table, columns) in ((self.subs, sub_columns),
+                (self.progress, progress_columns)):
+                mask = numpy.in1d(table['problemid'], problemids)
+                if userids is not None:
+                    mask &= numpy.in1d(table['competitorid'], userids)
+                ret.append([table[name][mask] for name in columns])
+            return ret
+
+    # Returns a mapping from the name of each statistic to a list of its value
+    # for each problem in problemids, counting only the submissions and views
+    # of the competitors in userids if given:
+    #   submissions: number of submissions
+    #   marked: number of marked submissions
+    #   mark_sum: total mark over all marked submissions
+    #   attempted: number of competitors who have submitted
+    #   solved: number of competitors with full marks
+    #   solver_submissions: number of submissions by those competitors
+    #   best_sum: total of each competitor's best mark
+    #   scored: number of competitors with a marked submission
+    #   distribution: number of competitors whose best mark is in each of the
+    #       NUM_SCORE_BINS bins
+    #   viewers: number of competitors who have viewed the problem
+    # Should only be called once ready is True.
+    def problem_summary(self, problemids, userids=None):
+        problems = numpy.asarray(problemids, dtype=numpy.int64)
+        if userids is not None:
+            userids = numpy.asarray(userids, dtype=numpy.int64)
+        (comp, prob, mark), (viewer_prob, ) = self._select(
+            ['competitorid', 'problemid', 'mark'], ['problemid'], problems,
+            userids)
+
+        # Map problem ids to their positions in problemids.
+        n = len(problems)
+        order = numpy.argsort(problems)
+        sorted_problems = problems[order]
+        def index_of(ids):
+            return order[numpy.searchsorted(sorted_problems, ids)]
+        def count(indexes, weights=None, bins=n):
+            return numpy.bincount(indexes, weights=weights,
+                minlength=bins)[:bins]
+
+        pidx = index_of(prob)
+        is_marked = mark >= 0
+
+        # Group submissions by (competitor, problem), taking each
+        # competitor's best mark and number of submissions.
+        pair = comp.astype(numpy.int64) * max(n, 1) + pidx
+        if len(pair):
+            by_pair = numpy.lexsort((mark, pair))
+            pair = pair[by_pair]
+            last = numpy.append(pair[1:] != pair[:-1], True)
+            ends = numpy.flatnonzero(last)
+            best = mark[by_pair][ends]
+            pair_subs = numpy.diff(numpy.append(-1, ends))
+            pair_pidx = pair[ends] % max(n, 1)
+        else:
+            best = pair_subs = pair_pidx = numpy.zeros(0, numpy.int64)
+
+        is_solved = best == 100
+        is_scored = best >= 0
+        bins = numpy.minimum(best[is_scored] // 10, NUM_SCORE_BINS - 1)
+
+        ret = {
+            'submissions': count(pidx),
+            'marked': count(pidx[is_marked]),
+            'mark_sum': count(pidx[is_marked], mark[is_marked]),
+            'attempted': count(pair_pidx),
+            'solved': count(pair_pidx[is_solved]),
+            'solver_submissions': count(pair_pidx[is_solved],
+                pair_subs[is_solved]),
+            'best_sum': count(pair_pidx[is_scored], best[is_scored]),
+            'scored': count(pair_pidx[is_scored]),
+            'distribution': count(
+                pair_pidx[is_scored] * NUM_SCORE_BINS + bins,
+                bins=n * NUM_SCORE_BINS).reshape(n, NUM_SCORE_BINS),
+            'viewers': count(index_of(viewer_prob)),
+        }
+        return dict((k, v.astype(numpy.int64).tolist())
+            for (k, v) in ret.items())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'submissions': len(self.subs) if self.subs else 0,
+                'progress': len(self.progress) if self.progress else 0,
+                'bytes': ((self.subs.nbytes() if self.subs else 0) +
+                    (self.progress.nbytes() if self.progress else 0)),
+                'refreshes': self.refreshes,
+                'errors': self.errors,
+            }
@@ -0,0 +1,296 @@
+# cache.py
+#
+# Caches for Project Lorikeet.
+
+import hashlib
+import logging
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# A thread-safe mapping that holds at most max_size entries, evicting the least
+# recently used entry when full. If ttl (in seconds) is given, entries older
+# than that are treated as missing. Keeps count of hits, misses and evictions.
+class LRUCache(object):
+    def __init__(self, max_size=1024, ttl=None, timer=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Returns the value stored under key, or default if there is no such entry
+    # or it has expired.
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, stored_at = entry
+            if self.ttl is not None and self.timer() - stored_at > self.ttl:
+                self.misses += 1
+                return default
+
+            # Re-insert to mark this entry as the most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, self.timer())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+# An LRUCache of objects that can be looked up by either of two attributes,
+# e.g. a User by userid or by username. Each object is stored once under each
+# key, so max_size should be twice the number of objects to keep.
+class EntityCache(LRUCache):
+    def __init__(self, id_attr, name_attr, max_size=1024, ttl=None,
+        timer=time.time):
+        super(EntityCache, self).__init__(max_size, ttl, timer)
+        self.id_attr = id_attr
+        self.name_attr = name_attr
+
+    def get_by_id(self, entity_id):
+        return self.get(('id', entity_id))
+
+    def get_by_name(self, name):
+        return self.get(('name', name))
+
+    def put_entity(self, entity):
+        self.put(('id', getattr(entity, self.id_attr)), entity)
+        self.put(('name', getattr(entity, self.name_attr)), entity)
+
+    # Drops an object given either of its keys. Both keys are dropped if the
+    # object is still cached under the one given.
+    def invalidate_entity(self, entity_id=None, name=None):
+        keys = []
+        if entity_id is not None:
+            keys.append(('id', entity_id))
+        if name is not None:
+            keys.append(('name', name))
+
+        with self._lock:
+            for key in list(keys):
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entity = entry[0]
+                    keys.append(('id', getattr(entity, self.id_attr)))
+                    keys.append(('name', getattr(entity, self.name_attr)))
+            for key in keys:
+                self._entries.pop(key, None)
+
+# A cache of byte strings stored as files in a directory, which survives
+# restarts and can be shared between processes on the same machine. Keys are
+# hashed to give file names. Holds at most max_entries files, removing the
+# least recently written when full. If ttl (in seconds) is given, older files
+# are treated as missing.
+#
+# The directory is created readable and writable only by this process's user.
+# Anyone else who could write to it could plant entries, so if it belongs to
+# another user or is a symlink, the cache isn't used at all.
+class DiskCache(object):
+    def __init__(self, directory, max_entries=1024, ttl=None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._private = False
+        self._warned = False
+        self._lock = threading.Lock()
+
+    # Returns whether the directory is private to us, creating it if needed and
+    # taking away other users' access if we own it.
+    def _check_directory(self):
+        if self._private and os.path.isdir(self.directory):
+            return True
+        try:
+            if not os.path.lexists(self.directory):
+                os.makedirs(self.directory, 0o700)
+            st = os.lstat(self.directory)
+            if (not stat.S_ISDIR(st.st_mode) or
+                st.st_uid != os.getuid()):
+                if not self._warned:
+                    logger.warning('Not using cache directory %s, which is '
+                        'not a directory owned by this user', self.directory)
+                    self._warned = True
+                return False
+            if st.st_mode & 0o077:
+                os.chmod(self.directory, 0o700)
+        except (IOError, OSError):
+            logger.exception('Could not create cache directory %s',
+                self.directory)
+            return False
+        self._private = True
+        return True
+
+    def _path(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    # Returns the data stored under key, or default if there is none.
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            if not self._check_directory():
+                raise IOError('Untrusted directory')
+            if (self.ttl is not None and
+                time.time() - os.path.getmtime(path) > self.ttl):
+                raise IOError('Expired')
+            with open(path, 'rb') as f:
+                ret = f.read()
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return default
+
+        with self._lock:
+            self.hits += 1
+        return ret
+
+    # Stores data under key. The file is written under a temporary name and
+    # then renamed, so readers never see a partly written file.
+    def put(self, key, data):
+        if not self._check_directory():
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self._path(key))
+        except (IOError, OSError):
+            # The cache is only an optimisation, so failing to write to it
+            # shouldn't fail the request.
+            return
+        self._prune()
+
+    def invalidate(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in self._entries():
+            self._remove_file(name)
+
+    def _remove_file(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            ret = {
+                'max_size': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+        ret['size'] = len(self._entries())
+        return ret
+
+    def _entries(self):
+        try:
+            return [name for name in os.listdir(self.directory)
+                if not name.startswith('.')]
+        except OSError:
+            return []
+
+    # Removes the oldest files while there are more than max_entries.
+    def _prune(self):
+        names = self._entries()
+        if len(names) <= self.max_entries:
+            return
+
+        def mtime(name):
+            try:
+                return os.path.getmtime(os.path.join(self.directory, name))
+            except OSError:
+                return 0
+        names.sort(key=mtime)
+        for name in names[:len(names) - self.max_entries]:
+            self._remove_file(name)
+            with self._lock:
+                self.evictions += 1
+
+# A cache of rendered pages and page fragments, in front of an LRUCache or a
+# DiskCache. Unlike those, each entry has its own time-to-live (in seconds).
+# Entries stored in a DiskCache are pickled.
+class ResponseCache(object):
+    def __init__(self, backend, timer=time.time):
+        self.backend = backend
+        self.timer = timer
+        self.serialize = isinstance(backend, DiskCache)
+
+    # Returns the value stored under key, or None if there is no such entry or
+    # it has expired.
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        if self.serialize:
+            try:
+                entry = pickle.loads(entry)
+            except Exception:
+                return None
+
+        expires, value = entry
+        if self.timer() > expires:
+            return None
+        return value
+
+    def put(self, key, value, ttl):
+        entry = (self.timer() + ttl, value)
+        if self.serialize:
+            entry = pickle.dumps(entry, 2)
+        self.backend.put(key, entry)
+
+    def invalidate(self, key):
+        self.backend.invalidate(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return self.backend.stats()
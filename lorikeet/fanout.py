@@ -0,0 +1,79 @@
+# fanout.py
+#
+# Concurrent execution of independent queries for Project Lorikeet.
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+import flask
+
+# Runs independent functions (typically database queries) at the same time.
+# The first runs in the calling thread, and so on the caller's database
+# connection; the rest run on a shared pool of num_workers threads. Each of
+# those runs in its own application context, so it gets its own database
+# connection from get_db and gives it back when it finishes. Functions can't use
+# the request, so anything they need from it must be worked out beforehand and
+# passed in, e.g. with functools.partial. Attributes of flask.g named in
+# inherit are copied into each worker's application context, and those in
+# context (a mapping of names to values) are set there, e.g. to have get_db
+# check connections out of a pool reserved for the workers. With num_workers
+# set to 0, functions are run one after another in the calling thread.
+class QueryFanout(object):
+    def __init__(self, app, num_workers=8, timeout=None, inherit=(),
+        context=None):
+        self.app = app
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.inherit = inherit
+        self.context = context or {}
+        self._pool = None
+        self._lock = threading.Lock()
+
+    # Calls each of the given functions with no arguments and returns a list of
+    # their results, in the same order. If any of them raises an exception,
+    # the first such exception is raised once they have all finished.
+    def run(self, *fns):
+        if self.num_workers <= 0 or len(fns) <= 1:
+            return [fn() for fn in fns]
+
+        inherited = dict(self.context)
+        if flask.has_app_context():
+            for name in self.inherit:
+                if hasattr(flask.g, name):
+                    inherited[name] = getattr(flask.g, name)
+
+        pool = self._get_pool()
+        pending = [pool.apply_async(self._call, (fn, inherited))
+            for fn in fns[1:]]
+
+        # Wait for all of them before raising, so no task is left holding a
+        # connection after the request ends.
+        results = []
+        error = None
+        try:
+            results.append(fns[0]())
+        except Exception as e:
+            results.append(None)
+            error = e
+        for p in pending:
+            try:
+                results.append(p.get(self.timeout))
+            except Exception as e:
+                results.append(None)
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return results
+
+    def _call(self, fn, inherited):
+        with self.app.app_context():
+            for (name, value) in inherited.items():
+                setattr(flask.g, name, value)
+            return fn()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.num_workers)
+            return self._pool
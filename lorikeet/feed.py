@@ -0,0 +1,183 @@
+# feed.py
+#
+# Live submission feed for Project Lorikeet.
+
+import Queue
+import logging
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+# A subscriber to a SubmissionFeed. New submissions for which matches returns
+# true are put on queue as (submission, update), where update is true if the
+# submission has been sent before and has changed since. If the subscriber falls
+# more than the queue's size behind, it is dropped and closed is set.
+class Subscription(object):
+    def __init__(self, matches, queue_size):
+        self.matches = matches
+        self.queue = Queue.Queue(queue_size)
+        self.closed = False
+
+# Fans new submissions out to every subscriber from one background thread.
+#
+# fetch(cursor) is called to read new submissions. It returns a list of
+# submissions made after cursor and a cursor to pass next time. When cursor is
+# None it should return the submissions that later calls may return again (or
+# none) and a cursor for the present; those are remembered but not published.
+# The thread calls fetch whenever a notification arrives on channel (if connect
+# is given, it should return a new database connection to LISTEN on), and at
+# least every poll_interval seconds, so the feed keeps working if nothing
+# sends notifications.
+#
+# fetch may return submissions it has returned before, e.g. by re-reading a
+# window of recent submissions to catch ones committed late. If key is given,
+# key(submission) returns (identity, version), and a submission is published
+# only if its identity wasn't returned by the previous fetch, or as an update if
+# its version has changed (e.g. it has been marked).
+class SubmissionFeed(object):
+    def __init__(self, fetch, connect=None, channel=None, poll_interval=5.0,
+        queue_size=1000, key=None):
+        self.fetch = fetch
+        self.key = key
+        self.connect = connect
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.cursor = None
+        self.notifications = 0
+        self.polls = 0
+        self.sent = 0
+        self.updates = 0
+        self.dropped = 0
+        self._versions = {}
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._listen_conn = None
+
+    # Adds a subscriber, starting the background thread if needed.
+    def subscribe(self, matches):
+        sub = Subscription(matches, self.queue_size)
+        with self._lock:
+            self._subscribers.add(sub)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name='lorikeet-feed')
+                self._thread.daemon = True
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+        sub.closed = True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': len(self._subscribers),
+                'listening': self._listen_conn is not None,
+                'notifications': self.notifications,
+                'polls': self.polls,
+                'sent': self.sent,
+                'updates': self.updates,
+                'dropped': self.dropped,
+            }
+
+    def _run(self):
+        while True:
+            try:
+                self._wait()
+                initial = self.cursor is None
+                subs, self.cursor = self.fetch(self.cursor)
+                events = self._changes(subs)
+                if not initial:
+                    self._publish(events)
+            except Exception:
+                logger.exception('Error reading new submissions')
+                threading.Event().wait(self.poll_interval)
+
+    # Waits until a notification arrives or poll_interval seconds pass.
+    def _wait(self):
+        if self.cursor is None:
+            return
+
+        if self.connect is not None and self._listen_conn is None:
+            conn = None
+            try:
+                conn = self.connect()
+                conn.set_isolation_level(
+                    psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute('LISTEN %s;' % (self.channel))
+                cur.close()
+                self._listen_conn = conn
+            except psycopg2.Error:
+                logger.exception('Could not LISTEN for new submissions; '
+                    'polling instead')
+                if conn is not None:
+                    conn.close()
+
+        conn = self._listen_conn
+        if conn is None:
+            threading.Event().wait(self.poll_interval)
+            self.polls += 1
+            return
+
+        try:
+            ready = select.select([conn], [], [], self.poll_interval)[0]
+            if ready:
+                conn.poll()
+                del conn.notifies[:]
+                self.notifications += 1
+            else:
+                self.polls += 1
+        except (psycopg2.Error, select.error):
+            logger.exception('Lost LISTEN connection')
+            self._listen_conn = None
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    # Returns (submission, update) for each of subs that is new or has changed
+    # since the previous fetch, and remembers the versions of subs.
+    def _changes(self, subs):
+        if self.key is None:
+            return [(sub, False) for sub in subs]
+
+        ret = []
+        versions = {}
+        for sub in subs:
+            identity, version = self.key(sub)
+            versions[identity] = version
+            if identity not in self._versions:
+                ret.append((sub, False))
+            elif self._versions[identity] != version:
+                ret.append((sub, True))
+        self._versions = versions
+        return ret
+
+    def _publish(self, events):
+        if not events:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscriber in subscribers:
+            for (sub, update) in events:
+                if not subscriber.matches(sub):
+                    continue
+                try:
+                    subscriber.queue.put_nowait((sub, update))
+                    self.sent += 1
+                    if update:
+                        self.updates += 1
+                except Queue.Full:
+                    self.dropped += 1
+                    self.unsubscribe(subscriber)
+                    break
@@ -0,0 +1,288 @@
+# metrics.py
+#
+# Request and query instrumentation for Project Lorikeet.
+
+import logging
+import os
+import sys
+import threading
+import time
+
+import flask
+import jinja2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+_THIS_FILE = os.path.splitext(os.path.abspath(__file__))[0]
+
+# Queries, rows and time spent on the database and on templates while handling
+# one request. Kept in flask.g as query_stats; queries run for the request on
+# other threads (see QueryFanout) count towards it too, so db_time can add up
+# to more than the time taken.
+class RequestStats(object):
+    def __init__(self):
+        self.start = time.time()
+        self.queries = 0
+        self.rows = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self._lock = threading.Lock()
+
+    def add_query(self, elapsed):
+        with self._lock:
+            self.queries += 1
+            self.db_time += elapsed
+
+    def add_rows(self, n):
+        with self._lock:
+            self.rows += n
+
+    def add_template(self, elapsed):
+        with self._lock:
+            self.template_time += elapsed
+
+    # Returns the value of a Server-Timing header for a request that took
+    # elapsed seconds.
+    def server_timing(self, elapsed):
+        return ('db;dur=%.1f;desc="%d queries, %d rows", tpl;dur=%.1f, '
+            'total;dur=%.1f' % (self.db_time * 1000, self.queries, self.rows,
+                self.template_time * 1000, elapsed * 1000))
+
+# Returns the RequestStats of the current request, or None outside of one.
+def current_stats():
+    if not flask.has_app_context():
+        return None
+    return getattr(flask.g, 'query_stats', None)
+
+# Records every query run through its cursor_factory: in the current request's
+# RequestStats, in running totals, and in the log (at warning level) if it
+# takes more than slow_threshold seconds. Slow queries are logged with their
+# SQL, cut to max_sql_length characters, and the line of code that ran them.
+# A slow_threshold of None turns the log off.
+class QueryMetrics(object):
+    def __init__(self, slow_threshold=None, max_sql_length=2000):
+        self.slow_threshold = slow_threshold
+        self.max_sql_length = max_sql_length
+        self.queries = 0
+        self.rows = 0
+        self.db_time = 0.0
+        self.slow_queries = 0
+        self._lock = threading.Lock()
+
+        class Cursor(InstrumentedCursor):
+            query_metrics = self
+        self.cursor_factory = Cursor
+
+    def record_query(self, cursor, query, elapsed):
+        slow = (self.slow_threshold is not None and
+            elapsed >= self.slow_threshold)
+        with self._lock:
+            self.queries += 1
+            self.db_time += elapsed
+            if slow:
+                self.slow_queries += 1
+
+        stats = current_stats()
+        if stats is not None:
+            stats.add_query(elapsed)
+
+        if slow:
+            sql = cursor.query or query
+            if isinstance(sql, bytes):
+                sql = sql.decode('utf-8', 'replace')
+            if len(sql) > self.max_sql_length:
+                sql = sql[:self.max_sql_length] + '...'
+            logger.warning('Slow query (%.3fs) at %s: %s', elapsed,
+                call_site(), sql)
+
+    def record_rows(self, n):
+        with self._lock:
+            self.rows += n
+        stats = current_stats()
+        if stats is not None:
+            stats.add_rows(n)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queries': self.queries,
+                'rows': self.rows,
+                'db_time': self.db_time,
+                'slow_queries': self.slow_queries,
+            }
+
+# Returns 'file:line in function' for the innermost caller outside this module.
+def call_site():
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        path = os.path.splitext(os.path.abspath(code.co_filename))[0]
+        if path != _THIS_FILE:
+            return '%s:%d in %s' % (os.path.basename(code.co_filename),
+                frame.f_lineno, code.co_name)
+        frame = frame.f_back
+    return 'unknown'
+
+# A cursor that reports its queries and rows to query_metrics. Use a
+# QueryMetrics's cursor_factory rather than this class directly.
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    query_metrics = None
+
+    def execute(self, query, vars=None):
+        start = time.time()
+        try:
+            return super(InstrumentedCursor, self).execute(query, vars)
+        finally:
+            self.query_metrics.record_query(self, query, time.time() - start)
+
+    def fetchone(self):
+        row = super(InstrumentedCursor, self).fetchone()
+        if row is not None:
+            self.query_metrics.record_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        rows = super(InstrumentedCursor, self).fetchmany(size)
+        self.query_metrics.record_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super(InstrumentedCursor, self).fetchall()
+        self.query_metrics.record_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+# A template that adds the time taken to render it to the current request's
+# RequestStats. Set as the Jinja environment's template_class.
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                stats.add_template(time.time() - start)
+
+# A histogram of observations, with a separate set of buckets for each value of
+# one label.
+class Histogram(object):
+    def __init__(self, name, help, buckets, label):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.label = label
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = {
+                    'counts': [0] * len(self.buckets),
+                    'sum': 0.0,
+                    'count': 0,
+                }
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self, prefix):
+        name = prefix + self.name
+        lines = ['# HELP %s %s' % (name, self.help),
+            '# TYPE %s histogram' % (name)]
+        with self._lock:
+            for label_value in sorted(self._series):
+                series = self._series[label_value]
+                label = '%s="%s"' % (self.label, escape_label(label_value))
+                for (bound, count) in zip(self.buckets, series['counts']):
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, label,
+                        format_value(bound), count))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, label,
+                    series['count']))
+                lines.append('%s_sum{%s} %s' % (name, label,
+                    format_value(series['sum'])))
+                lines.append('%s_count{%s} %d' % (name, label,
+                    series['count']))
+        return lines
+
+# Metrics in the Prometheus text format, each name starting with prefix and an
+# underscore. Besides histograms, any function returning a stats() style
+# mapping of names to numbers can be added as a collector; each entry becomes
+# a gauge named prefix_name_entry, or a counter named prefix_name_entry_total
+# if the entry is one of counters (running totals that only ever go up). If
+# label is given, the function should instead return a mapping of label values
+# to such mappings.
+class MetricsRegistry(object):
+    def __init__(self, prefix):
+        self.prefix = prefix + '_'
+        self._histograms = []
+        self._collectors = []
+
+    def histogram(self, name, help, buckets, label):
+        ret = Histogram(name, help, buckets, label)
+        self._histograms.append(ret)
+        return ret
+
+    def add_collector(self, name, fn, label=None, counters=()):
+        self._collectors.append((name, fn, label, frozenset(counters)))
+
+    def render(self):
+        lines = []
+        for histogram in self._histograms:
+            lines.extend(histogram.render(self.prefix))
+
+        for (name, fn, label, counters) in self._collectors:
+            try:
+                stats = fn()
+            except Exception:
+                logger.exception('Could not collect %s metrics', name)
+                continue
+            if label is None:
+                stats = {None: stats}
+
+            gauges = {}
+            for (label_value, values) in stats.items():
+                for (key, value) in values.items():
+                    if isinstance(value, bool):
+                        value = int(value)
+                    if not isinstance(value, (int, long, float)):
+                        continue
+                    gauges.setdefault(key, []).append((label_value, value))
+
+            for key in sorted(gauges):
+                metric = '%s%s_%s' % (self.prefix, name, key)
+                if key in counters:
+                    metric += '_total'
+                    lines.append('# TYPE %s counter' % (metric))
+                else:
+                    lines.append('# TYPE %s gauge' % (metric))
+                for (label_value, value) in sorted(gauges[key]):
+                    if label_value is None:
+                        lines.append('%s %s' % (metric, format_value(value)))
+                    else:
+                        lines.append('%s{%s="%s"} %s' % (metric, label,
+                            escape_label(label_value), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+def escape_label(value):
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n'))
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,218 @@
+# pool.py
+#
+# Database connection pooling for Project Lorikeet.
+
+import threading
+import time
+
+import psycopg2
+
+# Raised when no connection becomes available within the checkout timeout.
+class PoolTimeout(Exception):
+    pass
+
+# A thread-safe pool of database connections.
+#
+# connect is a function returning a new connection. At least min_size
+# connections are kept open once the pool is first used, and at most max_size
+# are open at once; a checkout waits up to timeout seconds for one to be
+# returned before raising PoolTimeout. Connections that have sat idle for more
+# than check_after seconds are pinged before being handed out, and replaced if
+# they turn out to be broken. Idle connections above min_size are closed after
+# max_idle seconds.
+class ConnectionPool(object):
+    def __init__(self, connect, min_size=1, max_size=10, timeout=10.0,
+        check_after=30.0, max_idle=300.0):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_idle = max_idle
+
+        # Idle connections, most recently returned last, as (conn, returned_at).
+        self._idle = []
+        self._in_use = set()
+        self._num_pending = 0
+        self._cond = threading.Condition(threading.Lock())
+
+        # Metrics.
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.discarded = 0
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._num_pending
+
+    # Returns a connection from the pool, opening a new one if none are idle
+    # and the pool isn't full.
+    def getconn(self):
+        start = time.time()
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    self._in_use.add(conn)
+                    break
+                if self._size() < self.max_size:
+                    conn, returned_at = None, None
+                    self._num_pending += 1
+                    break
+
+                remaining = self.timeout - (time.time() - start)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout('No database connection available '
+                        'after %.1fs' % (self.timeout))
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                self._cond.wait(remaining)
+
+            self.checkouts += 1
+            if waited:
+                self.wait_time += time.time() - start
+
+        # Connecting and health checks are done outside the lock so they don't
+        # hold up other threads.
+        if conn is None:
+            try:
+                conn = self._new_connection()
+            finally:
+                with self._cond:
+                    self._num_pending -= 1
+                    if conn is not None:
+                        self._in_use.add(conn)
+                    else:
+                        self._cond.notify()
+
+            # Failing to open spare connections shouldn't fail this checkout.
+            try:
+                self._fill()
+            except psycopg2.Error:
+                pass
+        elif not self._healthy(conn, returned_at):
+            with self._cond:
+                self._in_use.discard(conn)
+                self._num_pending += 1
+                self.discarded += 1
+            self._close(conn)
+            conn = None
+            try:
+                conn = self._new_connection()
+            finally:
+                with self._cond:
+                    self._num_pending -= 1
+                    if conn is not None:
+                        self._in_use.add(conn)
+                    else:
+                        self._cond.notify()
+
+        return conn
+
+    # Returns a connection to the pool. Any open transaction is rolled back.
+    # Connections that are broken, or that the caller asks to discard, are
+    # closed instead.
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._cond:
+            self._in_use.discard(conn)
+            now = time.time()
+            if discard or conn.closed:
+                self.discarded += 1
+                to_close = [conn]
+            else:
+                self._idle.append((conn, now))
+                to_close = []
+
+            # Trim connections above min_size that have been idle too long.
+            # The oldest idle connections are at the front of the list.
+            while (self._idle and self._size() > self.min_size and
+                now - self._idle[0][1] > self.max_idle):
+                to_close.append(self._idle.pop(0)[0])
+
+            self._cond.notify()
+
+        for c in to_close:
+            self._close(c)
+
+    # Closes every idle connection. Connections in use are closed when they are
+    # returned.
+    def closeall(self):
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+            self.min_size = 0
+            self.max_idle = 0
+        for (conn, _) in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size(),
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'timeouts': self.timeouts,
+                'created': self.created,
+                'discarded': self.discarded,
+            }
+
+    def _new_connection(self):
+        conn = self.connect()
+        with self._cond:
+            self.created += 1
+        return conn
+
+    # Opens connections until there are min_size of them.
+    def _fill(self):
+        while True:
+            with self._cond:
+                if self._size() >= self.min_size:
+                    return
+                self._num_pending += 1
+            conn = None
+            try:
+                conn = self._new_connection()
+            finally:
+                with self._cond:
+                    self._num_pending -= 1
+                    if conn is not None:
+                        self._idle.insert(0, (conn, time.time()))
+                    self._cond.notify()
+
+    # Returns whether an idle connection is still usable, pinging the server
+    # if the connection hasn't been used in a while.
+    def _healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.time() - returned_at < self.check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1;')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
@@ -0,0 +1,136 @@
+# ranking.py
+#
+# Rank indexes for Project Lorikeet's leaderboards.
+
+import math
+import random
+
+class _Node(object):
+    __slots__ = ('key', 'member', 'next', 'width')
+
+    def __init__(self, key, member, levels):
+        self.key = key
+        self.member = member
+        self.next = [None] * levels
+        self.width = [0] * levels
+
+# Members (e.g. competitor ids) kept in order of a sort key, smallest first,
+# each with at most one position. Changing a member's key, finding a member's
+# rank and finding the member at a rank all take O(log n) time on average.
+#
+# This is an indexable skip list: each link also records how many members it
+# skips, so ranks can be counted on the way down instead of by walking the
+# list. Members with equal keys are ordered by member.
+class RankIndex(object):
+    def __init__(self, max_levels=24, seed=None):
+        self.max_levels = max_levels
+        self._keys = {}
+        self._random = random.Random(seed)
+        self._tail = _Node(None, None, 0)
+        self._head = _Node(None, None, max_levels)
+        self._head.next = [self._tail] * max_levels
+        self._head.width = [1] * max_levels
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, member):
+        return member in self._keys
+
+    # Returns a member's key, or None if it isn't in the index.
+    def key(self, member):
+        return self._keys.get(member)
+
+    # Adds member with key, or moves it there if it is already in the index.
+    def update(self, member, key):
+        old = self._keys.get(member)
+        if old is not None:
+            if old == key:
+                return
+            self._remove((old, member))
+        self._insert((key, member), member)
+        self._keys[member] = key
+
+    def discard(self, member):
+        old = self._keys.pop(member, None)
+        if old is not None:
+            self._remove((old, member))
+
+    # Returns a member's rank, counting from 1, or None if it isn't in the
+    # index.
+    def rank(self, member):
+        key = self._keys.get(member)
+        if key is None:
+            return None
+        (position, _) = self._find((key, member))
+        return position + 1
+
+    # Returns (member, key) for up to limit members, starting from the one with
+    # rank offset + 1.
+    def page(self, offset, limit):
+        ret = []
+        if offset < 0 or offset >= len(self):
+            return ret
+
+        # Find the member at offset, skipping as far as possible at each level.
+        node = self._head
+        remaining = offset + 1
+        for level in reversed(range(self.max_levels)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+
+        while node is not self._tail and len(ret) < limit:
+            ret.append((node.member, node.key[0]))
+            node = node.next[0]
+        return ret
+
+    # Returns the number of members before a (key, member) and the last node
+    # before it at each level.
+    def _find(self, key):
+        chain = [None] * self.max_levels
+        position = 0
+        node = self._head
+        for level in reversed(range(self.max_levels)):
+            while (node.next[level] is not self._tail and
+                node.next[level].key < key):
+                position += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        return position, chain
+
+    def _insert(self, key, member):
+        chain = [None] * self.max_levels
+        skipped = [0] * self.max_levels
+        node = self._head
+        for level in reversed(range(self.max_levels)):
+            while (node.next[level] is not self._tail and
+                node.next[level].key < key):
+                skipped[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        # Each node is in a level with half the probability of the one below.
+        levels = min(self.max_levels,
+            1 - int(math.log(1.0 - self._random.random(), 2.0)))
+        new = _Node(key, member, levels)
+        steps = 0
+        for level in range(levels):
+            prev = chain[level]
+            new.next[level] = prev.next[level]
+            prev.next[level] = new
+            new.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += skipped[level]
+        for level in range(levels, self.max_levels):
+            chain[level].width[level] += 1
+
+    def _remove(self, key):
+        (_, chain) = self._find(key)
+        node = chain[0].next[0]
+        for level in range(len(node.next)):
+            prev = chain[level]
+            prev.width[level] += node.width[level] - 1
+            prev.next[level] = node.next[level]
+        for level in range(len(node.next), self.max_levels):
+            chain[level].width[level] -= 1
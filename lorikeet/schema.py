@@ -0,0 +1,130 @@
+# schema.py
+#
+# Schema and index health checks for Project Lorikeet.
+
+import json
+import re
+import threading
+from collections import OrderedDict
+
+import psycopg2.extensions
+
+_INDEX_DDL = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+'
+    r'(?:CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?(\S+)\s+ON\s+'
+    r'(?:ONLY\s+)?(\S+)\s*(?:USING\s+(\w+)\s*)?\((.*)\)', re.I | re.S)
+
+# Returns (name, table, method, columns) for a CREATE INDEX statement, as
+# written in views.INDEXES or as returned by pg_indexes, or None for any other
+# statement. Schema names are dropped and columns are normalised so that
+# equivalent definitions compare equal; for btree indexes the sort order is
+# dropped too, since they can be scanned in either direction.
+def parse_index(ddl):
+    m = _INDEX_DDL.match(ddl.strip())
+    if m is None:
+        return None
+    name, table, method, columns = m.groups()
+    method = (method or 'btree').lower()
+    columns = re.sub(r'\s+', ' ', columns.lower())
+    if method == 'btree':
+        columns = re.sub(r' (asc|desc)\b', '', columns)
+        columns = re.sub(r' nulls (first|last)\b', '', columns)
+    columns = columns.replace(' ', '').replace('"', '').replace('::text', '')
+    return (name.split('.')[-1].strip('"'), table.split('.')[-1].strip('"'),
+        method, columns)
+
+# Returns whether an existing index (as returned by parse_index) does the job
+# of a required one: it has the same name, or it is on the same table with the
+# same method and the required columns as its leading columns.
+def index_covers(index, required):
+    if index[0] == required[0]:
+        return True
+    return (index[1:3] == required[1:3] and
+        (index[3] == required[3] or index[3].startswith(required[3] + ',')))
+
+def existing_indexes(cur):
+    cur.execute('SELECT indexdef FROM pg_indexes '
+        'WHERE schemaname = ANY(current_schemas(false));')
+    return [x for x in (parse_index(r[0]) for r in cur.fetchall())
+        if x is not None]
+
+# Given lists of DDL statements (such as views.INDEXES), returns the
+# statements needed to create the indexes that are missing. Other statements
+# in a list (e.g. CREATE EXTENSION) are included if any of its indexes are.
+def missing_indexes(cur, ddl_lists):
+    existing = existing_indexes(cur)
+    ret = []
+    for ddl_list in ddl_lists:
+        other = []
+        missing = []
+        for ddl in ddl_list:
+            required = parse_index(ddl)
+            if required is None:
+                other.append(ddl)
+            elif not any(index_covers(x, required) for x in existing):
+                missing.append(ddl)
+        if missing:
+            ret.extend(other + missing)
+    return ret
+
+# Returns a mapping from table name to its (estimated) number of rows.
+def table_sizes(cur):
+    cur.execute("SELECT relname, GREATEST(reltuples, 0) FROM pg_class "
+        "WHERE relkind = 'r';")
+    return dict((r[0], int(r[1])) for r in cur.fetchall())
+
+# Returns the plan of a query as parsed from EXPLAIN (FORMAT JSON). With
+# analyze, the query is run; the caller should roll back afterwards.
+def explain(cur, query, params=None, analyze=False):
+    options = 'ANALYZE, FORMAT JSON' if analyze else 'FORMAT JSON'
+    cur.execute('EXPLAIN (%s) %s' % (options, query), params)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+# Returns (table, filter) for each sequential scan in a plan of a table with
+# at least min_rows rows.
+def seq_scans(plan, sizes, min_rows):
+    ret = []
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        if node.get('Node Type') == 'Seq Scan':
+            table = node.get('Relation Name')
+            if sizes.get(table, 0) >= min_rows:
+                ret.append((table, node.get('Filter')))
+        nodes.extend(node.get('Plans', []))
+    return ret
+
+# Records the distinct queries run through its cursor_factory, along with the
+# parameters they were first run with and the labels that were current when
+# they ran. Queries run while label is None aren't recorded.
+class QueryRecorder(object):
+    def __init__(self):
+        self.label = None
+        self.queries = OrderedDict()
+        self._lock = threading.Lock()
+
+        class Cursor(RecordingCursor):
+            recorder = self
+        self.cursor_factory = Cursor
+
+    def record(self, query, params):
+        label = self.label
+        if label is None:
+            return
+        with self._lock:
+            entry = self.queries.get(query)
+            if entry is None:
+                entry = self.queries[query] = (params, [])
+            if label not in entry[1]:
+                entry[1].append(label)
+
+# A cursor that records its queries in recorder. Use a QueryRecorder's
+# cursor_factory rather than this class directly.
+class RecordingCursor(psycopg2.extensions.cursor):
+    recorder = None
+
+    def execute(self, query, vars=None):
+        self.recorder.record(query, vars)
+        return super(RecordingCursor, self).execute(query, vars)
@@ -0,0 +1,68 @@
+# singleflight.py
+#
+# Request coalescing for Project Lorikeet.
+
+import threading
+
+# State of a call that is in progress.
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# Makes sure that only one call for a given key is in progress at a time.
+# Threads calling do() with a key that is already being computed wait for that
+# computation and share its result (or exception) instead of repeating it.
+# Waiters give up and compute the result themselves after timeout seconds, if
+# a timeout is given.
+class SingleFlight(object):
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            call.done.wait(self.timeout)
+            if call.done.is_set():
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            with self._lock:
+                self.timeouts += 1
+            return fn(*args, **kwargs)
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+                'timeouts': self.timeouts,
+                'in_flight': len(self._calls),
+            }
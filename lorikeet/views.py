@@ -10,82 +10,450 @@
 # TODO(junkbot): Fix unicode issues.
 
 from lorikeet import app
+from lorikeet.cache import LRUCache, EntityCache, DiskCache, ResponseCache
+from lorikeet.pool import ConnectionPool
+from lorikeet.singleflight import SingleFlight
+from lorikeet.feed import SubmissionFeed
+from lorikeet.fanout import QueryFanout
+from lorikeet.metrics import QueryMetrics, MetricsRegistry, RequestStats
+from lorikeet.metrics import TimedTemplate
+from lorikeet.zipstream import iter_zip
+from lorikeet.ranking import RankIndex
+from lorikeet import analytics
 from flask import render_template, url_for, make_response, request, redirect, g
+from flask import Response, stream_with_context, get_template_attribute
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
 import groups
 
 import psycopg2
 import base64
+import bisect
+import datetime
+import functools
+import hashlib
+import json
+import os
+import Queue
+import tempfile
+import threading
 import time
+import zlib
+from collections import OrderedDict
 
 _DATABASE_NAME = 'train'
 _HARD_LIMIT = 100
 
+# Limits for pages that list every submission (see stream_submissions). Rows
+# are fetched from the database _STREAM_FETCH_SIZE at a time and sent to the
+# client every _STREAM_BUFFER_SIZE template chunks.
+_STREAM_HARD_LIMIT = 100000
+_STREAM_FETCH_SIZE = 1000
+_STREAM_BUFFER_SIZE = 100
+
+# Bulk exports read submissions (with their source) from the database
+# _EXPORT_FETCH_SIZE at a time.
+_EXPORT_FETCH_SIZE = 100
+
+# Judged submissions never change, so their pages and downloads are sent with
+# long-lived Cache-Control headers (in seconds). Pages show the number of
+# attempts, which can change, so they are kept for less time. Decoded zip
+# archives are kept on disk in _ARCHIVE_CACHE_DIR, which is made private to
+# the user the app runs as (see DiskCache).
+_SUBMISSION_PAGE_MAX_AGE = 300
+_SUBMISSION_EXTRACT_MAX_AGE = 365 * 24 * 60 * 60
+_ARCHIVE_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+    'lorikeet-archives-%d' % (os.getuid()))
+_ARCHIVE_CACHE_MAX_FILES = 1024
+archive_cache = DiskCache(_ARCHIVE_CACHE_DIR, _ARCHIVE_CACHE_MAX_FILES)
+
+# Rendered pages and submission tables are cached, in memory or (if
+# _RESPONSE_CACHE_BACKEND is 'disk') in _RESPONSE_CACHE_DIR, where they can be
+# shared between processes running as the same user (see DiskCache). Cached
+# pages are keyed by the latest submission timestamp, which is read at most
+# every _WATERMARK_POLL_INTERVAL seconds, so they are replaced as soon as a new
+# submission arrives. The TTLs (in seconds) bound how long changes other than
+# new submissions take to show up.
+_RESPONSE_CACHE_BACKEND = 'memory'
+_RESPONSE_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+    'lorikeet-pages-%d' % (os.getuid()))
+_RESPONSE_CACHE_SIZE = 1024
+_WATERMARK_POLL_INTERVAL = 2
+_PAGE_CACHE_TTLS = {
+    'index': 300,
+    'group_scoreboard': 300,
+    'group_subs': 300,
+    'group_set': 300,
+    'api_group_scoreboard': 300,
+    'set_analytics': 60,
+    'group_analytics': 60,
+}
+_FRAGMENT_CACHE_TTL = 300
+if _RESPONSE_CACHE_BACKEND == 'disk':
+    response_cache = ResponseCache(DiskCache(_RESPONSE_CACHE_DIR,
+        _RESPONSE_CACHE_SIZE))
+else:
+    response_cache = ResponseCache(LRUCache(_RESPONSE_CACHE_SIZE))
+_watermark = {'value': None, 'read_at': None}
+
+# Requests waiting on an identical request to render a page give up and render
+# it themselves after _VIEW_FLIGHT_TIMEOUT seconds.
+_VIEW_FLIGHT_TIMEOUT = 30
+view_flight = SingleFlight(_VIEW_FLIGHT_TIMEOUT)
+
+# The live feed is woken by notifications on _FEED_CHANNEL (see
+# FEED_TRIGGER_DDL) and polls for new submissions at least every
+# _FEED_POLL_INTERVAL seconds in case nothing sends them. Subscribers more than
+# _FEED_QUEUE_SIZE submissions behind are disconnected, and idle connections
+# are sent a comment every _FEED_KEEPALIVE seconds.
+_FEED_CHANNEL = 'lorikeet_submissions'
+_FEED_POLL_INTERVAL = 5.0
+_FEED_QUEUE_SIZE = 1000
+_FEED_KEEPALIVE = 15.0
+
+# Trigger that notifies the live feed of new submissions.
+FEED_TRIGGER_DDL = [
+    'CREATE OR REPLACE FUNCTION lorikeet_notify_submission() '
+        'RETURNS trigger AS $$ BEGIN '
+        "PERFORM pg_notify('" + _FEED_CHANNEL + "', ''); "
+        'RETURN NULL; '
+        'END; $$ LANGUAGE plpgsql;',
+    'CREATE TRIGGER lorikeet_notify_submission '
+        'AFTER INSERT ON submissions '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE lorikeet_notify_submission();',
+]
+
+# The JSON API lives under /api/v<_API_VERSION>. Responses of at least
+# _API_GZIP_MIN_SIZE bytes are gzipped (at _API_GZIP_LEVEL) for clients that
+# accept it.
+_API_VERSION = 1
+_API_PREFIX = '/api/v%d' % (_API_VERSION)
+_API_GZIP_MIN_SIZE = 1024
+_API_GZIP_LEVEL = 6
+
+# Indexes that the submission lists, attempt lookups, scoreboards, set pages,
+# leaderboards and user lookups rely on. checkdb.py reports any that are
+# missing.
+INDEXES = [
+    'CREATE INDEX submissions_competitor_problem_attempt ON submissions '
+        '(competitorid, problemid, attempt);',
+    'CREATE INDEX submissions_timestamp ON submissions (timestamp DESC);',
+    'CREATE INDEX progress_competitor_problem ON progress '
+        '(competitorid, problemid);',
+    'CREATE INDEX progress_problem_bestscoreon ON progress '
+        '(problemid, bestscoreon);',
+    'CREATE INDEX progress_bestscoreon ON progress (bestscoreon);',
+    'CREATE INDEX set_contents_set ON set_contents (set);',
+    'CREATE INDEX competitors_username ON competitors (username);',
+]
+
+# Number of results on each page of search results.
+_SEARCH_LIMIT = 50
+
+# Indexes that let the search queries' LIKE '%...%' conditions use trigram
+# index scans rather than sequential scans. They need the pg_trgm extension.
+SEARCH_INDEXES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm;',
+    'CREATE INDEX competitors_username_trgm ON competitors '
+        'USING gin (lower(username) gin_trgm_ops);',
+    'CREATE INDEX competitors_firstname_trgm ON competitors '
+        'USING gin (lower(firstname) gin_trgm_ops);',
+    'CREATE INDEX competitors_lastname_trgm ON competitors '
+        'USING gin (lower(lastname) gin_trgm_ops);',
+    "CREATE INDEX competitors_fullname_trgm ON competitors "
+        "USING gin ((lower(firstname) || ' ' || lower(lastname)) "
+        "gin_trgm_ops);",
+    'CREATE INDEX problems_name_trgm ON problems '
+        'USING gin (lower(name) gin_trgm_ops);',
+    'CREATE INDEX problems_title_trgm ON problems '
+        'USING gin (lower(title) gin_trgm_ops);',
+    'CREATE INDEX sets_name_trgm ON sets '
+        'USING gin (lower(name) gin_trgm_ops);',
+    'CREATE INDEX sets_title_trgm ON sets '
+        'USING gin (lower(title) gin_trgm_ops);',
+]
+
+# Users, problems and sets rarely change, so lookups by id or name are cached
+# in-process. Sizes are in entries (users and problems take one entry each for
+# their id and their name) and TTLs are in seconds.
+_USER_CACHE_SIZE = 8192
+_PROBLEM_CACHE_SIZE = 8192
+_SET_CACHE_SIZE = 1024
+_ENTITY_CACHE_TTL = 600
+
+user_cache = EntityCache('userid', 'username', _USER_CACHE_SIZE,
+    _ENTITY_CACHE_TTL)
+problem_cache = EntityCache('problemid', 'name', _PROBLEM_CACHE_SIZE,
+    _ENTITY_CACHE_TTL)
+set_cache = LRUCache(_SET_CACHE_SIZE, _ENTITY_CACHE_TTL)
+
+# Submissions up to _WATERMARK_SLACK older than the last one seen are re-read
+# when bringing in-memory state up to date, to catch submissions whose judging
+# finished after they were seen.
+_WATERMARK_SLACK = datetime.timedelta(minutes=5)
+
+# Group scoreboards are kept in memory, brought up to date at most once every
+# _SCOREBOARD_REFRESH_INTERVAL seconds and rebuilt from scratch every
+# _SCOREBOARD_MAX_AGE seconds (to pick up rejudged submissions).
+_SCOREBOARD_REFRESH_INTERVAL = 10
+_SCOREBOARD_MAX_AGE = 3600
+_SCOREBOARDS = {}
+_SCOREBOARDS_LOCK = threading.Lock()
+
+# Scoreboards as they were at past times are replayed from each group's history
+# of submissions, with a copy of the scores kept every
+# _HISTORY_CHECKPOINT_INTERVAL submissions (or every submission per score on
+# the scoreboard, if there are more scores than that).
+_HISTORY_CHECKPOINT_INTERVAL = 1000
+_HISTORIES = {}
+_HISTORIES_LOCK = threading.Lock()
+
+# Formats accepted for times given in query strings, as for
+# group_scoreboard's at, and in pagination cursors.
+_TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M',
+    '%Y-%m-%dT%H:%M', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S.%f']
+
+# Groups are built from the groups module the first time one is asked for. The
+# module's file is checked for changes at most once every
+# _GROUPS_CHECK_INTERVAL seconds, and reloaded if it has changed.
+_GROUPS_CHECK_INTERVAL = 2
+
+# Statistics for up to _PROBLEM_STATS_CACHE_SIZE problems are kept in memory.
+# They are brought up to date with new submissions at most once every
+# _PROBLEM_STATS_REFRESH_INTERVAL seconds, and rebuilt from scratch (which also
+# updates the number of viewers) every _PROBLEM_STATS_MAX_AGE seconds.
+_PROBLEM_STATS_CACHE_SIZE = 1024
+_PROBLEM_STATS_REFRESH_INTERVAL = 10
+_PROBLEM_STATS_MAX_AGE = 3600
+_PROBLEM_STATS = LRUCache(_PROBLEM_STATS_CACHE_SIZE)
+
+# If NumPy is installed, problem statistics and the analytics pages are instead
+# computed from a copy of the submissions and progress tables held in memory
+# (see analytics.SubmissionSnapshot), loaded in chunks of _SNAPSHOT_FETCH_SIZE
+# rows. It is brought up to date with new submissions at most once every
+# _SNAPSHOT_REFRESH_INTERVAL seconds, and progress is re-read every
+# _SNAPSHOT_PROGRESS_MAX_AGE seconds. Problem pages use ProblemStats until the
+# first load finishes.
+_SNAPSHOT_REFRESH_INTERVAL = 10
+_SNAPSHOT_PROGRESS_MAX_AGE = 3600
+_SNAPSHOT_FETCH_SIZE = 100000
+
+# Leaderboards are kept in memory, brought up to date with changed progress rows
+# at most once every _LEADERBOARD_REFRESH_INTERVAL seconds and rebuilt from
+# scratch every _LEADERBOARD_MAX_AGE seconds. Leaderboards for up to
+# _PROBLEM_LEADERBOARD_CACHE_SIZE problems are kept. Each page of a leaderboard
+# shows _LEADERBOARD_PAGE_SIZE competitors.
+_LEADERBOARD_REFRESH_INTERVAL = 10
+_LEADERBOARD_MAX_AGE = 3600
+_LEADERBOARD_PAGE_SIZE = 50
+_PROBLEM_LEADERBOARD_CACHE_SIZE = 256
+_PROBLEM_LEADERBOARDS = LRUCache(_PROBLEM_LEADERBOARD_CACHE_SIZE)
+
+# Every query is timed and counted. Queries taking at least
+# _SLOW_QUERY_THRESHOLD seconds are logged along with the code that ran them
+# and their SQL, cut to _SLOW_QUERY_MAX_LENGTH characters; set the threshold
+# to None to turn the log off.
+_SLOW_QUERY_THRESHOLD = 0.5
+_SLOW_QUERY_MAX_LENGTH = 2000
+query_metrics = QueryMetrics(_SLOW_QUERY_THRESHOLD, _SLOW_QUERY_MAX_LENGTH)
+
+# Per-endpoint histograms of request times (in seconds) and of the number of
+# queries each request runs, served at /metrics.
+_REQUEST_TIME_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+    10]
+_REQUEST_QUERY_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+metrics = MetricsRegistry('lorikeet')
+request_time = metrics.histogram('request_duration_seconds',
+    'Time taken to handle a request.', _REQUEST_TIME_BUCKETS, 'endpoint')
+request_db_time = metrics.histogram('request_db_seconds',
+    'Time spent on database queries for a request.', _REQUEST_TIME_BUCKETS,
+    'endpoint')
+request_queries = metrics.histogram('request_queries',
+    'Number of database queries run for a request.', _REQUEST_QUERY_BUCKETS,
+    'endpoint')
+
+# Time spent rendering templates is added to each request's stats.
+app.jinja_env.template_class = TimedTemplate
+
 # Connect to database
 def connect_db():
-    conn = psycopg2.connect('dbname=%s' % (_DATABASE_NAME))
+    conn = psycopg2.connect('dbname=%s' % (_DATABASE_NAME),
+        cursor_factory=query_metrics.cursor_factory)
     return conn
 
+# Connections are shared between requests through a pool rather than opened
+# for each request. Timeouts are in seconds.
+_POOL_MIN_SIZE = 2
+_POOL_MAX_SIZE = 20
+_POOL_CHECKOUT_TIMEOUT = 10.0
+db_pool = ConnectionPool(connect_db, min_size=_POOL_MIN_SIZE,
+    max_size=_POOL_MAX_SIZE, timeout=_POOL_CHECKOUT_TIMEOUT)
+
+# Views run independent queries at the same time: one on the request's own
+# connection and the rest on _FANOUT_WORKERS threads. Set to 0 to run them one
+# at a time. The threads take connections from a pool of their own, with one
+# connection for each thread, so no request holds more than one connection
+# from db_pool and the threads never wait for requests to give one back.
+_FANOUT_WORKERS = 8
+fanout_pool = ConnectionPool(connect_db, min_size=0,
+    max_size=_FANOUT_WORKERS, timeout=_POOL_CHECKOUT_TIMEOUT)
+query_fanout = QueryFanout(app, _FANOUT_WORKERS, inherit=('query_stats', ),
+    context={'psql_pool': fanout_pool})
+
 # Return connection to database
 def get_db():
     if not hasattr(g, 'psql_db'):
-        g.psql_db = connect_db()
+        g.psql_db = getattr(g, 'psql_pool', db_pool).getconn()
     return g.psql_db
 
-# Close the database after each request
+# Start counting the queries and template time of each request.
+@app.before_request
+def start_request_stats():
+    g.query_stats = RequestStats()
+
+# Record each request in the per-endpoint histograms and break down where its
+# time went in a Server-Timing header. The time taken to send streamed
+# responses isn't included.
+@app.after_request
+def finish_request_stats(response):
+    stats = getattr(g, 'query_stats', None)
+    if stats is None:
+        return response
+
+    elapsed = time.time() - stats.start
+    endpoint = request.endpoint or 'none'
+    request_time.observe(endpoint, elapsed)
+    request_db_time.observe(endpoint, stats.db_time)
+    request_queries.observe(endpoint, stats.queries)
+    response.headers['Server-Timing'] = stats.server_timing(elapsed)
+    return response
+
+# Return the database connection to the pool after each request
 @app.teardown_appcontext
 def close_db(error):
     if hasattr(g, 'psql_db'):
-        g.psql_db.close()
+        getattr(g, 'psql_pool', db_pool).putconn(g.psql_db)
+        del g.psql_db
+
+# A text attribute that is decoded lazily. The string from the database is kept
+# in the slot named slot and decoded (dropping anything that isn't ASCII, and
+# optionally stripping whitespace) the first time it's read, so that objects
+# whose text is never shown don't pay for decoding it.
+class AsciiText(object):
+    def __init__(self, slot, strip=False):
+        self.slot = slot
+        self.strip = strip
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        value = getattr(obj, self.slot)
+        if isinstance(value, bytes):
+            if self.strip:
+                value = value.strip()
+            value = value.decode('ascii', 'ignore')
+            setattr(obj, self.slot, value)
+        return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+# The domain classes below use __slots__, since pages can build thousands of
+# them at once.
 
 # Information about a user that we might actually care about
 class User(object):
+    __slots__ = ('userid', 'username', '_firstname', '_lastname', '_school',
+        'year', 'state', 'country')
+
     def __init__(self, userid=-1, username='', firstname='', lastname='',
         school='', year='', state='', country=''):
         self.userid = userid
         self.username = username
-        self.firstname = firstname.decode('ascii', 'ignore')
-        self.lastname = lastname.decode('ascii', 'ignore')
-        self.school = school.decode('ascii', 'ignore')
+        self.firstname = firstname
+        self.lastname = lastname
+        self.school = school
         self.year = year
         self.state = state
         self.country = country
 
+    firstname = AsciiText('_firstname')
+    lastname = AsciiText('_lastname')
+    school = AsciiText('_school')
+
 # Information about a problem that we might actually care about
 class Problem(object):
+    __slots__ = ('problemid', 'name', '_title')
+
     def __init__(self, problemid=-1, name='', title=''):
         self.problemid = problemid
         self.name = name
-        self.title = title.decode('ascii', 'ignore')
+        self.title = title
+
+    title = AsciiText('_title')
 
 class SubmissionScoreSummary(object):
+    __slots__ = ('user', 'problem', 'mark')
+
     def __init__(self, user=None, problem=None, mark=None):
         self.user = user
         self.problem = problem
         self.mark = mark
 
-# Information about a submission that we might actually care about
+# Information about a submission that we might actually care about. Never
+# carries the source code; see Submission for that.
 class SubmissionSummary(SubmissionScoreSummary):
-    def __init__(self, user=None, problem=None, attempt=0, mark=0, timestamp=''):
+    __slots__ = ('attempt', 'timestamp', '_num_attempts')
+
+    def __init__(self, user=None, problem=None, attempt=0, mark=0, timestamp='',
+        num_attempts=None):
         super(SubmissionSummary, self).__init__(user, problem, mark)
         self.attempt = attempt
-
-        # TODO(junkbot): Make this faster. Getting number of attempts is
-        # currently really, really slow.
-        self.num_attempts = get_num_attempts(user.userid, problem.problemid)
         self.timestamp = timestamp
+        self._num_attempts = num_attempts
+
+    # The number of submissions the user has made to the problem. Callers that
+    # build many summaries at once should pass it in or use fill_num_attempts,
+    # since otherwise it is looked up with a query per summary when first read.
+    @property
+    def num_attempts(self):
+        if self._num_attempts is None:
+            self._num_attempts = get_num_attempts(self.user.userid,
+                self.problem.problemid)
+        return self._num_attempts
+
+    @num_attempts.setter
+    def num_attempts(self, value):
+        self._num_attempts = value
 
 # Full submission details including source, judging output and language
 class Submission(SubmissionSummary):
+    __slots__ = ('_source', 'lang', 'langid', 'judge')
+
     def __init__(self, user=None, problem=None, attempt=0, mark=0,
-        timestamp='', source='', lang='', langid='', judge=''):
+        timestamp='', source='', lang='', langid='', judge='',
+        num_attempts=None):
         super(Submission, self).__init__(user, problem, attempt, mark,
-            timestamp)
-        self.source = source.strip().decode('ascii', 'ignore')
+            timestamp, num_attempts)
+        self.source = source
         self.lang = lang
         self.langid = langid
         self.judge = judge
 
+    source = AsciiText('_source', strip=True)
+
+# A list of SubmissionSummary objects making up one page of a longer list, with
+# cursors for the pages of older and newer submissions (None if there are no
+# more submissions in that direction).
+class SubmissionPage(list):
+    def __init__(self, subs=[], older_cursor=None, newer_cursor=None):
+        super(SubmissionPage, self).__init__(subs)
+        self.older_cursor = older_cursor
+        self.newer_cursor = newer_cursor
+
 class ProblemSetBrief(object):
+    __slots__ = ('name', 'title', 'public')
+
     def __init__(self, name='', title='', public=False):
         self.name = name
         self.title = title
@@ -93,6 +461,8 @@ class ProblemSetBrief(object):
 
 # Information about a set that we might actually care about
 class ProblemSet(ProblemSetBrief):
+    __slots__ = ('problems', )
+
     def __init__(self, name='', title='', public=False, problems=[]):
         super(ProblemSet, self).__init__(name, title, public)
         self.problems = problems
@@ -101,6 +471,8 @@ class ProblemSet(ProblemSetBrief):
 # array of SubmissionSummary objects describing the scores for each of the
 # constituent problems.
 class ProblemSetScores(ProblemSet):
+    __slots__ = ('mark', 'subs')
+
     def __init__(self, name='', title='', public=False, problems=[], mark=None,
         subs=None):
         super(ProblemSetScores, self).__init__(name, title, public, problems)
@@ -109,6 +481,8 @@ class ProblemSetScores(ProblemSet):
 
 # Class that stores the result to a problem search query.
 class ProblemSearchResult(object):
+    __slots__ = ('problem', 'sets')
+
     def __init__(self, problem=None, sets=[]):
         self.problem = problem
         self.sets = sets
@@ -117,6 +491,15 @@ class ProblemSearchResult(object):
     def from_problem(cls, problem=None):
         return cls(problem, sets_containing_problem(problem))
 
+# A list of search results making up one page (counting from 0) of a longer
+# list. The search queries fetch one result more than fits on a page; it is
+# dropped here, and has_more records that there is a next page.
+class SearchPage(list):
+    def __init__(self, results=[], page=0):
+        super(SearchPage, self).__init__(results[:_SEARCH_LIMIT])
+        self.page = page
+        self.has_more = len(results) > _SEARCH_LIMIT
+
 # Class that stores a list of users and a list of sets that define a group.
 class Group(object):
     def __init__(self, name='', title='', users=None, sets=None):
@@ -138,190 +521,926 @@ class GroupMarks(Group):
             group.sets)
         self.marks = marks
 
+# Materialized scoreboard for a group. Holds the matrix of best scores for the
+# group's users and problems along with the latest submission timestamp that
+# has been accounted for (the watermark). Each refresh only re-reads the
+# progress rows of (user, problem) pairs with a submission newer than the
+# watermark, and replaces their scores with those read, so scores that went
+# down are shown too. The full matrix is built when the group is (re)defined
+# and again every _SCOREBOARD_MAX_AGE seconds, since a rejudge of an older
+# submission changes its score without any new submission.
+class GroupScoreboard(object):
+    def __init__(self, group=None):
+        self.group = group
+        self.problems = group_problems(group)
+        self.marks = None
+        self.watermark = None
+        self.group_marks = None
+        self.last_refresh = None
+        self.built_at = None
+        self._lock = threading.Lock()
+
+    # Brings the scoreboard up to date if it hasn't been refreshed in the last
+    # _SCOREBOARD_REFRESH_INTERVAL seconds. Returns the GroupMarks to display.
+    def get_group_marks(self):
+        now = time.time()
+        if (self.group_marks is None or
+            now - self.last_refresh >= _SCOREBOARD_REFRESH_INTERVAL):
+            with self._lock:
+                # Another request may have refreshed while we were waiting.
+                if (self.group_marks is None or
+                    now - self.last_refresh >= _SCOREBOARD_REFRESH_INTERVAL):
+                    self.refresh()
+        return self.group_marks
+
+    def refresh(self):
+        # Read the new watermark before the scores, so that submissions made
+        # while we are reading are picked up again next time.
+        now = time.time()
+        watermark = get_submission_watermark()
+
+        if (self.marks is None or self.watermark is None or
+            now - self.built_at >= _SCOREBOARD_MAX_AGE):
+            marks = get_best_scores(self.group.users, self.problems)
+            changed = True
+            self.built_at = now
+        else:
+            marks = self.marks
+            changed = update_best_scores(marks, self.group.users,
+                self.problems, self.watermark - _WATERMARK_SLACK)
+
+        if changed or self.group_marks is None:
+            self.group_marks = GroupMarks(self.group,
+                group_scores_from_marks(self.group, self.problems, marks))
+        self.marks = marks
+        self.watermark = watermark
+        self.last_refresh = time.time()
+
+# The history of a group's scores, for showing its scoreboard as it was at any
+# time.
+#
+# The group's marked submissions are read once, in order of time, by a single
+# query and kept as (user index, problem index, mark) events; afterwards only
+# newer submissions are read. Submissions within _WATERMARK_SLACK of the latest
+# one may not have been marked yet, so they aren't kept but read again for each
+# scoreboard that needs them.
+#
+# While reading, a copy of the matrix of best scores is kept every
+# checkpoint_interval events. The scores at a time are then those of the last
+# checkpoint before it plus the events between them, so moving through the
+# timeline replays at most checkpoint_interval events at each step. The
+# interval is at least the number of scores on the scoreboard, so checkpoints
+# never take more memory than the events they summarize.
+class ScoreboardHistory(object):
+    def __init__(self, group=None):
+        self.group = group
+        self.problems = group_problems(group)
+        self.user_index = dict((u.userid, i)
+            for (i, u) in enumerate(group.users))
+        self.problem_index = dict((p.problemid, j)
+            for (j, p) in enumerate(self.problems))
+        self.num_scores = len(group.users) * len(self.problems)
+        self.checkpoint_interval = max(_HISTORY_CHECKPOINT_INTERVAL,
+            self.num_scores)
+        self.events = []
+        self.times = []
+        self.scores = [None] * self.num_scores
+        self.checkpoints = [list(self.scores)]
+        self.horizon = None
+        self.last_refresh = None
+        self._lock = threading.Lock()
+
+    # Returns the GroupMarks for the group as it was at a time (a datetime).
+    def get_group_marks(self, at):
+        with self._lock:
+            now = time.time()
+            if (self.last_refresh is None or
+                now - self.last_refresh >= _SCOREBOARD_REFRESH_INTERVAL):
+                self.refresh()
+
+            n = bisect.bisect_right(self.times, at)
+            k = n // self.checkpoint_interval
+            scores = list(self.checkpoints[k])
+            self._replay(scores,
+                self.events[k * self.checkpoint_interval:n])
+            if self.horizon is None or at > self.horizon:
+                self._replay(scores, self._read(self.horizon, at))
+
+        marks = [scores[i * len(self.problems):(i + 1) * len(self.problems)]
+            for i in range(len(self.group.users))]
+        return GroupMarks(self.group,
+            group_scores_from_marks(self.group, self.problems, marks))
+
+    # Reads the submissions made since the last refresh, up to _WATERMARK_SLACK
+    # before the latest one.
+    def refresh(self):
+        watermark = get_submission_watermark()
+        if watermark is not None:
+            horizon = watermark - _WATERMARK_SLACK
+            if self.horizon is None or horizon > self.horizon:
+                for (timestamp, event) in self._read(self.horizon, horizon,
+                    with_times=True):
+                    self._add(timestamp, event)
+                self.horizon = horizon
+        self.last_refresh = time.time()
+
+    def _add(self, timestamp, event):
+        self._replay(self.scores, [event])
+        self.events.append(event)
+        self.times.append(timestamp)
+        if len(self.events) % self.checkpoint_interval == 0:
+            self.checkpoints.append(list(self.scores))
+
+    # Applies events to a flat list of best scores.
+    def _replay(self, scores, events):
+        num_problems = len(self.problems)
+        for (i, j, mark) in events:
+            k = i * num_problems + j
+            if scores[k] is None or mark > scores[k]:
+                scores[k] = mark
+
+    # Returns the events for the group's submissions made after since (if not
+    # None) and up to until, in order of time, optionally with their
+    # timestamps.
+    def _read(self, since, until, with_times=False):
+        ret = []
+        if not self.num_scores:
+            return ret
+        for (timestamp, userid, problemid, mark) in get_marked_submissions(
+            list(self.user_index), list(self.problem_index), since, until):
+            event = (self.user_index[userid], self.problem_index[problemid],
+                int(mark))
+            ret.append((timestamp, event) if with_times else event)
+        return ret
+
+# A ranking of competitors, kept up to date from the progress table.
+#
+# read_rows(since) returns a row of the form (competitorid, <values>...) for
+# every ranked competitor, or if since is given, only for those with a best
+# score set after since. orderings is a list of (name, function from a row to
+# its sort key, smallest first), and a RankIndex is kept for each. Refreshing
+# re-reads the rows of only the competitors whose best scores have changed
+# since the watermark and moves them within each index, so neither a page of
+# the leaderboard nor a competitor's rank needs a sort.
+class Leaderboard(object):
+    def __init__(self, read_rows, orderings):
+        self.read_rows = read_rows
+        self.orderings = orderings
+        self.rows = None
+        self.indexes = None
+        self.watermark = None
+        self.built_at = None
+        self.last_refresh = None
+        self._lock = threading.Lock()
+
+    # Returns (rank, row) for up to limit competitors in the named ordering,
+    # starting from rank offset + 1, and the number of competitors ranked.
+    def page(self, ordering, offset, limit):
+        with self._lock:
+            self._update()
+            index = self.indexes[ordering]
+            ret = [(offset + i + 1, self.rows[member])
+                for (i, (member, _)) in enumerate(index.page(offset, limit))]
+            return ret, len(index)
+
+    # Returns a competitor's rank in the named ordering, counting from 1, or
+    # None if they aren't ranked.
+    def rank(self, ordering, competitorid):
+        with self._lock:
+            self._update()
+            return self.indexes[ordering].rank(competitorid)
+
+    # Brings the leaderboard up to date if needed. Must be called with _lock
+    # held.
+    def _update(self):
+        now = time.time()
+        if (self.indexes is None or
+            now - self.built_at >= _LEADERBOARD_MAX_AGE):
+            self.rebuild()
+        elif now - self.last_refresh >= _LEADERBOARD_REFRESH_INTERVAL:
+            self.refresh()
+
+    def rebuild(self):
+        # Read the watermark first, so changes made while we are reading are
+        # picked up by the next refresh.
+        watermark = get_submission_watermark()
+        self.rows = {}
+        self.indexes = dict((name, RankIndex())
+            for (name, _) in self.orderings)
+        self.update(self.read_rows(None))
+        self.watermark = watermark
+        self.built_at = self.last_refresh = time.time()
+
+    # The watermark is None while there are no submissions, in which case
+    # every row is read once the first ones arrive.
+    def refresh(self):
+        watermark = get_submission_watermark()
+        if watermark != self.watermark:
+            since = None
+            if self.watermark is not None:
+                since = self.watermark - _WATERMARK_SLACK
+            self.update(self.read_rows(since))
+            self.watermark = watermark
+        self.last_refresh = time.time()
+
+    # Replaces the rows of the competitors in rows, moving them to their new
+    # places in each ordering.
+    def update(self, rows):
+        for row in rows:
+            self.rows[row[0]] = row
+            for (name, key) in self.orderings:
+                self.indexes[name].update(row[0], key(row))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'competitors': len(self.rows) if self.rows else 0,
+            }
+
+# The groups defined in a config module's GROUPS, a mapping from group name to
+# the keyword arguments of Group.from_names.
+#
+# Groups are built the first time one is asked for rather than at import time.
+# Afterwards the module is reloaded whenever its file changes, and only the
+# groups whose definitions changed are rebuilt, so the scoreboards of the others
+# are kept. The new groups replace the old ones all at once; requests that come
+# in while they are being built keep using the old ones rather than waiting. If
+# the new definitions can't be loaded, the old groups are kept.
+class GroupRegistry(object):
+    def __init__(self, module, check_interval=2):
+        self.module = module
+        self.check_interval = check_interval
+        self.groups = None
+        self.params = None
+        self.mtime = None
+        self.last_check = None
+        self.loads = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    # Returns the Group called name, or None if there is no such group.
+    def get(self, name):
+        if self.groups is None:
+            # Nothing to fall back on, so wait for the first load.
+            with self._lock:
+                if self.groups is None:
+                    self.load()
+        else:
+            self.check()
+        return self.groups.get(name)
+
+    # Reloads the module if its file has changed since it was last loaded.
+    # Does nothing if it has been checked in the last check_interval seconds
+    # or another thread is already reloading it.
+    def check(self):
+        if time.time() - self.last_check < self.check_interval:
+            return
+        if not self._lock.acquire(False):
+            return
+        try:
+            self.last_check = time.time()
+            mtime = self._mtime()
+            if mtime == self.mtime:
+                return
+            try:
+                reload(self.module)
+                self.load(mtime)
+            except psycopg2.Error:
+                # Try again next time.
+                self.errors += 1
+                app.logger.exception('Could not load groups')
+            except Exception:
+                # Don't try again until the file changes again.
+                self.errors += 1
+                self.mtime = mtime
+                app.logger.exception('Could not load groups from %s',
+                    self.module.__name__)
+        finally:
+            self._lock.release()
+
+    # Builds the groups from the module as it is now, reusing the old Group
+    # objects of groups whose definitions haven't changed. Must be called with
+    # _lock held.
+    def load(self, mtime=None):
+        if mtime is None:
+            mtime = self._mtime()
+        params = dict(self.module.GROUPS)
+        old_params = self.params or {}
+        old_groups = self.groups or {}
+
+        changed = dict((key, value) for (key, value) in params.iteritems()
+            if key not in old_groups or old_params.get(key) != value)
+        groups = load_groups(changed)
+        for key in params:
+            if key not in changed:
+                groups[key] = old_groups[key]
+
+        self.params = params
+        self.mtime = mtime
+        self.last_check = time.time()
+        self.loads += 1
+        self.groups = groups
+
+        # Pages showing groups that were changed or removed are out of date.
+        if self.loads > 1 and (changed or len(groups) != len(old_groups)):
+            response_cache.clear()
+
+    # Returns the modification time of the module's source file, or None if it
+    # can't be found.
+    def _mtime(self):
+        path = getattr(self.module, '__file__', None)
+        if not path:
+            return None
+        if path.endswith(('.pyc', '.pyo')):
+            path = path[:-1]
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def stats(self):
+        return {
+            'groups': len(self.groups or {}),
+            'loads': self.loads,
+            'errors': self.errors,
+        }
+
+# Statistics for a problem, kept up to date from the submissions table.
+#
+# The per-competitor aggregates from get_problem_competitor_stats are kept
+# along with their totals. Refreshing re-reads the aggregates of only those
+# competitors who have submitted since the watermark and adjusts the totals by
+# the difference, so a problem page doesn't scan the problem's submissions.
+class ProblemStats(object):
+    def __init__(self, problemid=None):
+        self.problemid = problemid
+        self.competitors = None
+        self.num_subs = 0
+        self.num_solves = 0
+        self.solver_subs = 0
+        self.mark_sum = 0
+        self.num_marked = 0
+        self.num_viewers = 0
+        self.watermark = None
+        self.built_at = None
+        self.last_refresh = None
+        self._lock = threading.Lock()
+
+    # Brings the statistics up to date if needed, and returns a mapping from a
+    # stat's display name to a tuple containing the values for that stat, as
+    # for problem_stats.
+    def get_stats(self):
+        with self._lock:
+            now = time.time()
+            if (self.competitors is None or self.watermark is None or
+                now - self.built_at >= _PROBLEM_STATS_MAX_AGE):
+                self.rebuild()
+            elif now - self.last_refresh >= _PROBLEM_STATS_REFRESH_INTERVAL:
+                self.refresh()
+
+            stats = {}
+            stats["Total Solves"] = (self.num_solves, )
+            stats["Total Submissions"] = (self.num_subs, )
+            if self.num_solves == 0:
+                stats["Average submissions per solve"] = ("N/A", )
+            else:
+                stats["Average submissions per solve"] = (
+                    self.solver_subs/self.num_solves, )
+            stats["Total users who've viewed this problem"] = (
+                self.num_viewers, )
+            if self.num_marked == 0:
+                stats["Average score per submission"] = ("N/A", )
+            else:
+                stats["Average score per submission"] = (
+                    int(self.mark_sum/self.num_marked), )
+            return stats
+
+    def rebuild(self):
+        # Read the watermark first, so submissions made while we are reading
+        # are picked up by the next refresh.
+        watermark = get_submission_watermark()
+        self.competitors = {}
+        self.num_subs = 0
+        self.num_solves = 0
+        self.solver_subs = 0
+        self.mark_sum = 0
+        self.num_marked = 0
+        self.update(get_problem_competitor_stats(self.problemid))
+        self.num_viewers = get_problem_viewers(self.problemid)
+        self.watermark = watermark
+        self.built_at = self.last_refresh = time.time()
+
+    def refresh(self):
+        watermark = get_submission_watermark()
+        if watermark != self.watermark:
+            self.update(get_problem_competitor_stats(self.problemid,
+                self.watermark - _WATERMARK_SLACK))
+            self.watermark = watermark
+        self.last_refresh = time.time()
+
+    # Replaces the aggregates of the competitors in rows, as returned by
+    # get_problem_competitor_stats, adjusting the totals to match.
+    def update(self, rows):
+        for row in rows:
+            old = self.competitors.get(row[0])
+            if old is not None:
+                self._add(old, -1)
+            new = (int(row[1]), row[2], int(row[3] or 0), int(row[4]))
+            self._add(new, 1)
+            self.competitors[row[0]] = new
+
+    def _add(self, competitor, sign):
+        num_subs, best, mark_sum, num_marked = competitor
+        self.num_subs += sign * num_subs
+        if best == 100:
+            self.num_solves += sign
+            self.solver_subs += sign * num_subs
+        self.mark_sum += sign * mark_sum
+        self.num_marked += sign * num_marked
+
+# Columns selected whenever a User or Problem is hydrated as part of a larger
+# query. The order matches the constructor arguments of each class.
+_USER_COLUMNS = ('c.id, c.username, c.firstname, c.lastname, c.school, '
+    'c.year, c.state, c.country')
+_NUM_USER_COLUMNS = 8
+_PROBLEM_COLUMNS = 'p.id, p.name, p.title'
+_NUM_PROBLEM_COLUMNS = 3
+
 # Given a list of users (by username), a list of sets (by name) and a list of
 # problems (by name), return all submissions made by a user in the list and is
 # either in the list of problems or belongs to a set in the list of sets. If
-# users is empty, do not filter based on users. If sets and problems are both
+# users is None, do not filter based on users; an empty list of users (e.g. a
+# group with no users) matches no submissions. If sets and problems are both
 # empty, do not filter based on problems at all. Orders in descending order of
-# time (reverse chronological). Returns a list of SubmissionSummary objects.
-# TODO(junkbot): Optimise this function's PSQL queries.
-def filter_submissions(users=None, sets=None, problems=None):
+# time (reverse chronological). Returns a SubmissionPage of at most _HARD_LIMIT
+# SubmissionSummary objects.
+#
+# Older pages are fetched by passing the SubmissionPage's older_cursor as
+# before, and newer pages by passing its newer_cursor as after.
+#
+# The users, problems and attempt counts for the whole page are resolved in a
+# single query, rather than with a get_user, get_problem and get_num_attempts
+# round trip for each row.
+def filter_submissions(users=None, sets=None, problems=None, before=None,
+    after=None):
+    before = decode_cursor(before)
+    after = decode_cursor(after)
+
     # Connect to database.
     conn = get_db()
     cur = conn.cursor()
 
-    # Shorthand for getting the first element in a tuple
-    get_first = lambda x: x[0]
+    # Fetch one more row than we need to tell whether there's another page.
+    query, params = submissions_query(users, sets, problems, before, after,
+        _HARD_LIMIT + 1)
+    cur.execute(query, params)
+    results = submission_summaries_from_rows(cur.fetchall())
 
-    # Work out which user ids we care about
-    if users:
-        query = 'SELECT id FROM competitors WHERE username=ANY(%s)'
-        cur.execute(query, (users, ))
-        user_ids = map(get_first, cur.fetchall())
+    # Close database connection.
+    cur.close()
 
-    # Work out which problem ids we care about.
+    # Rows come back newest first, so the extra row is at the start when
+    # paging towards newer submissions and at the end otherwise.
+    more = len(results) > _HARD_LIMIT
+    if more and after:
+        results = results[1:]
+    elif more:
+        results = results[:-1]
+
+    page = SubmissionPage(results)
+    if results:
+        if more or after:
+            page.older_cursor = encode_cursor(results[-1])
+        if (more and after) or before:
+            page.newer_cursor = encode_cursor(results[0])
+    return page
+
+# Returns a query and its parameters selecting the submissions matched by
+# filter_submissions, newest first. before and after are decoded cursors; only
+# the limit submissions immediately before or after the cursor are selected.
+# Each row is of the form read by submission_summaries_from_rows.
+def submissions_query(users=None, sets=None, problems=None, before=None,
+    after=None, limit=_HARD_LIMIT):
+    conditions, params = submission_filter_conditions(users, sets, problems)
+
+    # Keyset pagination: each page starts from a row comparison against the
+    # last key seen, which is an index range scan however deep the page is.
+    order = 'DESC'
+    if before:
+        conditions.append(
+            '(timestamp, competitorid, problemid, attempt) < (%s, %s, %s, %s)')
+        params.extend(before)
+    elif after:
+        conditions.append(
+            '(timestamp, competitorid, problemid, attempt) > (%s, %s, %s, %s)')
+        params.extend(after)
+        order = 'ASC'
+
+    if conditions:
+        where_clause = 'WHERE %s ' % (' AND '.join(conditions))
+    else:
+        where_clause = ''
+
+    # The page of submissions is picked first, then joined against the users
+    # and problems it mentions and the number of attempts for each
+    # (user, problem) pair on the page.
+    query = ('WITH page AS ('
+            'SELECT DISTINCT competitorid, problemid, attempt, mark, timestamp '
+            'FROM submissions ' + where_clause +
+            'ORDER BY timestamp {0}, competitorid {0}, problemid {0}, '
+                'attempt {0} '
+            'LIMIT %s'
+        ') '
+        'SELECT page.attempt, page.mark, page.timestamp, ' +
+            _USER_COLUMNS + ', ' + _PROBLEM_COLUMNS + ', '
+            'counts.num_attempts '
+        'FROM page '
+        'INNER JOIN competitors c ON (c.id = page.competitorid) '
+        'INNER JOIN problems p ON (p.id = page.problemid) '
+        'INNER JOIN ('
+            'SELECT competitorid, problemid, COUNT(*) AS num_attempts '
+            'FROM submissions '
+            'WHERE (competitorid, problemid) IN '
+                '(SELECT competitorid, problemid FROM page) '
+            'GROUP BY competitorid, problemid'
+        ') counts ON (counts.competitorid = page.competitorid AND '
+            'counts.problemid = page.problemid) '
+        'ORDER BY page.timestamp DESC, page.competitorid DESC, '
+            'page.problemid DESC, page.attempt DESC;').format(order)
+    params.append(limit)
+    return query, tuple(params)
+
+# Returns a list of SQL conditions on the submissions table, and a list of their
+# parameters, matching the users, sets and problems given to
+# filter_submissions. prefix is prepended to submissions column names.
+def submission_filter_conditions(users=None, sets=None, problems=None,
+    prefix=''):
+    # Work out which users and problems we care about as part of the query.
+    conditions = []
+    params = []
+    if users is not None:
+        conditions.append(prefix + 'competitorid IN '
+            '(SELECT id FROM competitors WHERE username=ANY(%s))')
+        params.append(list(users))
     if sets or problems:
-        problem_ids = set()
-
-        if sets:
-            query = ('SELECT problemid FROM set_contents WHERE set=ANY(%s)')
-            cur.execute(query, (sets, ))
-            problem_ids |= set(map(get_first, cur.fetchall()))
-
-        if problems:
-            query = ('SELECT id FROM problems WHERE name=ANY(%s)')
-            cur.execute(query, (problems, ))
-            problem_ids |= set(map(get_first, cur.fetchall()))
-
-        problem_ids = list(problem_ids)
-
-    select_fields = [
-        'competitorid',
-        'problemid',
-        'attempt',
-        'mark',
-        'timestamp'
-    ]
-    select_clause = 'SELECT DISTINCT %s ' % (', '.join(select_fields))
-
-    if users and (sets or problems):
-        query = select_clause + ('FROM submissions '
-            'WHERE (competitorid=ANY(%s) AND problemid=ANY(%s)) '
-            'ORDER BY timestamp DESC '
-            'LIMIT %s;')
-        cur.execute(query, (user_ids, problem_ids, _HARD_LIMIT, ))
-    elif users:
-        query = select_clause + ('FROM submissions '
-            'WHERE competitorid=ANY(%s) '
-            'ORDER BY timestamp DESC '
-            'LIMIT %s;')
-        cur.execute(query, (user_ids, _HARD_LIMIT, ))
-    elif sets or problems:
-        query = select_clause + ('FROM submissions '
-            'WHERE problemid=ANY(%s) '
-            'ORDER BY timestamp DESC '
-            'LIMIT %s;')
-        cur.execute(query, (problem_ids, _HARD_LIMIT, ))
-    else:
-        # 0.8s on limit 100
-        query = select_clause + ('FROM submissions '
-            'ORDER BY timestamp DESC '
-            'LIMIT %s;')
-        cur.execute(query, (_HARD_LIMIT, ))
-
-    raw_results = cur.fetchall()
-    results = []
-    for r in raw_results:
-        user = get_user(r[0])
-
-        # 0.7s on limit 100
-        problem = get_problem(r[1])
-        attempt = int(r[2])
+        conditions.append(prefix + 'problemid IN '
+            '(SELECT problemid FROM set_contents WHERE set=ANY(%s) '
+            'UNION SELECT id FROM problems WHERE name=ANY(%s))')
+        params.extend([list(sets or []), list(problems or [])])
+    return conditions, params
+
+# Like filter_submissions, but returns a generator of up to limit
+# SubmissionSummary objects rather than a page. Rows are read through a
+# server-side cursor _STREAM_FETCH_SIZE at a time, so memory use doesn't grow
+# with the number of submissions. The query is ordered by the submissions
+# index, so the first rows arrive without the whole list being sorted.
+def stream_submissions(users=None, sets=None, problems=None,
+    limit=_STREAM_HARD_LIMIT):
+    conditions, params = submission_filter_conditions(users, sets, problems,
+        prefix='s.')
+    if conditions:
+        where_clause = 'WHERE %s ' % (' AND '.join(conditions))
+    else:
+        where_clause = ''
+
+    query = ('SELECT s.attempt, s.mark, s.timestamp, ' +
+            _USER_COLUMNS + ', ' + _PROBLEM_COLUMNS + ', '
+            '(SELECT COUNT(*) FROM submissions n '
+                'WHERE n.competitorid = s.competitorid AND '
+                'n.problemid = s.problemid) '
+        'FROM submissions s '
+        'INNER JOIN competitors c ON (c.id = s.competitorid) '
+        'INNER JOIN problems p ON (p.id = s.problemid) ' +
+        where_clause +
+        'ORDER BY s.timestamp DESC, s.competitorid DESC, s.problemid DESC, '
+            's.attempt DESC '
+        'LIMIT %s;')
+    params.append(limit)
+
+    # Connect to database, using a named (server-side) cursor.
+    conn = get_db()
+    cur = conn.cursor('stream_submissions')
+    cur.itersize = _STREAM_FETCH_SIZE
+    try:
+        cur.execute(query, tuple(params))
+
+        # Duplicate rows are adjacent in this order, so they can be skipped
+        # without remembering every row seen.
+        last_key = None
+        for sub in iter_submission_summaries(cur):
+            key = (sub.timestamp, sub.user.userid, sub.problem.problemid,
+                sub.attempt, sub.mark)
+            if key != last_key:
+                last_key = key
+                yield sub
+    finally:
+        # Close database connection.
+        cur.close()
+
+# Returns an opaque cursor for the position of a SubmissionSummary in a list of
+# submissions, for use with filter_submissions.
+def encode_cursor(sub):
+    return encode_key((sub.timestamp, sub.user.userid, sub.problem.problemid,
+        sub.attempt))
+
+# Returns the cursor for a (timestamp, competitorid, problemid, attempt) key.
+def encode_key(key):
+    return base64.urlsafe_b64encode('%s|%d|%d|%d' % key)
+
+# Returns the (timestamp, competitorid, problemid, attempt) key encoded in a
+# cursor, or None if the cursor is missing or malformed. The timestamp may also
+# be '-infinity', for a cursor before every submission.
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        key = base64.urlsafe_b64decode(str(cursor))
+        timestamp, userid, problemid, attempt = key.split('|')
+        key = (timestamp, int(userid), int(problemid), int(attempt))
+    except (TypeError, ValueError):
+        return None
+    if timestamp != '-infinity' and parse_time(timestamp) is None:
+        return None
+    return key
+
+# Returns the pagination arguments for filter_submissions given in the current
+# request's query string.
+def page_args():
+    return {
+        'before': request.args.get('before'),
+        'after': request.args.get('after'),
+    }
+
+# Returns the datetime given as a string in one of _TIME_FORMATS, or None if it
+# isn't in any of them.
+def parse_time(value):
+    for time_format in _TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.strip(), time_format)
+        except ValueError:
+            pass
+    return None
+
+# Given rows of the form (attempt, mark, timestamp, <user columns>,
+# <problem columns>, num_attempts), as selected by filter_submissions, return a
+# list of SubmissionSummary objects. Users and problems that appear in more
+# than one row share the same object.
+def submission_summaries_from_rows(rows):
+    return list(iter_submission_summaries(rows))
+
+# Generator version of submission_summaries_from_rows, for rows read from a
+# cursor as they arrive.
+def iter_submission_summaries(rows):
+    users = {}
+    problems = {}
+    for r in rows:
+        attempt = int(r[0])
 
         # We need the or _DID_NOT_SCORE to handle cases when the judging was
         # terminated early and a mark was not assigned.
         try:
-            mark = int(r[3])
+            mark = int(r[1])
         except TypeError:
             mark = None
 
-        timestamp = r[4]
+        timestamp = r[2]
 
-        # 0.7s on limit 100
-        results.append(SubmissionSummary(user, problem, attempt, mark,
-            timestamp))
+        user_row = r[3:3 + _NUM_USER_COLUMNS]
+        user = users.get(user_row[0])
+        if user is None:
+            user = users[user_row[0]] = User(*user_row)
 
-    # Close database connection.
-    cur.close()
-    
+        problem_row = r[3 + _NUM_USER_COLUMNS:
+            3 + _NUM_USER_COLUMNS + _NUM_PROBLEM_COLUMNS]
+        problem = problems.get(problem_row[0])
+        if problem is None:
+            problem = problems[problem_row[0]] = Problem(*problem_row)
+
+        num_attempts = int(r[3 + _NUM_USER_COLUMNS + _NUM_PROBLEM_COLUMNS])
 
-    return results
+        yield SubmissionSummary(user, problem, attempt, mark, timestamp,
+            num_attempts)
 
-# TODO(junkbot): Make the PSQL queries more efficient. Possibly cache.
 # Given a group, return a list for each set, each containing a list of
 # ProblemSetScores containing the score details of each user for the set.
 def get_group_scores(group=None):
-    # Shorthand for getting the first element in a tuple
-    get_first = lambda x: x[0]
-
     if group:
-        # Connect to database.
-        conn = get_db()
-        cur = conn.cursor()
-
-        ret = [] 
-
-        for s in group.sets:
-            scores = []
-
-            # Number of problems in the set.
-            num_problems = len(s.problems)
-
-            for user in group.users:
-                tot = 0
-                any_attempts = False
-                subs = []
-                for problem in s.problems:
-                    # Find max score for this user for this problem, if any.
-                    query = (
-                        'SELECT bestscore '
-                        'FROM progress '
-                        'WHERE (competitorid=%s AND problemid=%s);'
-                    )
-                    cur.execute(query, (user.userid, problem.problemid, ))
-                    raw_result = cur.fetchone()
-                    if raw_result and get_first(raw_result) is not None:
-                        sub = SubmissionScoreSummary(user, problem,
-                                mark=int(get_first(raw_result)))
-                    else:
-                        sub = SubmissionScoreSummary(user, problem, mark=None)
-
-                    subs.append(sub)
-
-                    if sub.mark:
-                        mark = int(sub.mark)
-                        any_attempts = True
-                    else:
-                        mark = 0
-                    tot += mark
-
-                if any_attempts:
-                    ave = tot/num_problems
-                else:
-                    ave = None
-                scores.append(ProblemSetScores(s.name, s.title, s.public,
-                    s.problems, ave, subs))
-
-            ret.append(scores)
-
-        # Close database connection.
-        cur.close()
-        
-
-        return ret
+        problems = group_problems(group)
+        marks = get_best_scores(group.users, problems)
+        return group_scores_from_marks(group, problems, marks)
     else:
         return None
 
+# Returns the GroupMarks for a group from its materialized GroupScoreboard,
+# creating the scoreboard if the group is new or has been redefined.
+def get_group_marks(group):
+    scoreboard = _SCOREBOARDS.get(group.name)
+    if scoreboard is None or scoreboard.group is not group:
+        with _SCOREBOARDS_LOCK:
+            scoreboard = _SCOREBOARDS.get(group.name)
+            if scoreboard is None or scoreboard.group is not group:
+                scoreboard = GroupScoreboard(group)
+                _SCOREBOARDS[group.name] = scoreboard
+    return scoreboard.get_group_marks()
+
+# Returns the GroupMarks for a group as it was at a time (a datetime), replayed
+# from its ScoreboardHistory.
+def get_group_marks_at(group, at):
+    history = _HISTORIES.get(group.name)
+    if history is None or history.group is not group:
+        with _HISTORIES_LOCK:
+            history = _HISTORIES.get(group.name)
+            if history is None or history.group is not group:
+                history = ScoreboardHistory(group)
+                _HISTORIES[group.name] = history
+    return history.get_group_marks(at)
+
+# Returns the timestamp of the most recent submission, or None if there are no
+# submissions.
+def get_submission_watermark():
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
+
+    cur.execute('SELECT max(timestamp) FROM submissions;')
+    ret = cur.fetchone()[0]
+
+    # Close database connection.
+    cur.close()
+
+    return ret
+
+# Returns every problem in a group's sets, in order of first appearance and
+# without duplicates.
+def group_problems(group):
+    seen = set()
+    problems = []
+    for s in group.sets:
+        for problem in s.problems:
+            if problem.problemid not in seen:
+                seen.add(problem.problemid)
+                problems.append(problem)
+    return problems
+
+# Given lists of User and Problem objects, return a dense matrix of best
+# scores with a row for each user and a column for each problem, in the order
+# given. An entry is None if the user has no score for that problem. Uses a
+# single query however many users and problems there are.
+def get_best_scores(users, problems):
+    user_index = dict((u.userid, i) for (i, u) in enumerate(users))
+    problem_index = dict((p.problemid, j) for (j, p) in enumerate(problems))
+    marks = [[None] * len(problems) for _ in users]
+    if not users or not problems:
+        return marks
+
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
+
+    query = ('SELECT competitorid, problemid, bestscore '
+        'FROM progress '
+        'WHERE competitorid=ANY(%s) AND problemid=ANY(%s) AND '
+        'bestscore IS NOT NULL;')
+    cur.execute(query, (list(user_index), list(problem_index), ))
+    for (userid, problemid, bestscore) in cur.fetchall():
+        i = user_index[userid]
+        j = problem_index[problemid]
+        if marks[i][j] is None or int(bestscore) > marks[i][j]:
+            marks[i][j] = int(bestscore)
+
+    # Close database connection.
+    cur.close()
+
+    return marks
+
+# Given a matrix of best scores as returned by get_best_scores for the given
+# users and problems, re-read the best scores of every (user, problem) pair
+# with a submission made after since and replace them in the matrix (so a
+# score lowered by a rejudge is lowered here too). Returns whether any entry
+# changed.
+def update_best_scores(marks, users, problems, since):
+    if not users or not problems:
+        return False
+    user_index = dict((u.userid, i) for (i, u) in enumerate(users))
+    problem_index = dict((p.problemid, j) for (j, p) in enumerate(problems))
+
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
+
+    query = ('SELECT competitorid, problemid, bestscore '
+        'FROM progress '
+        'WHERE (competitorid, problemid) IN ('
+            'SELECT DISTINCT competitorid, problemid '
+            'FROM submissions '
+            'WHERE timestamp > %s AND '
+            'competitorid=ANY(%s) AND problemid=ANY(%s)'
+        ');')
+    cur.execute(query, (since, list(user_index), list(problem_index), ))
+    changed = False
+    for (userid, problemid, bestscore) in cur.fetchall():
+        i = user_index[userid]
+        j = problem_index[problemid]
+        if bestscore is not None:
+            bestscore = int(bestscore)
+        if marks[i][j] != bestscore:
+            marks[i][j] = bestscore
+            changed = True
+
+    # Close database connection.
+    cur.close()
+
+    return changed
+
+# Returns (timestamp, competitorid, problemid, mark) for every marked submission
+# by one of userids to one of problemids made after since (if not None) and no
+# later than until, in order of time.
+def get_marked_submissions(userids, problemids, since, until):
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
+
+    query = ('SELECT timestamp, competitorid, problemid, mark '
+        'FROM submissions '
+        'WHERE competitorid = ANY(%s) AND problemid = ANY(%s) AND '
+            'mark IS NOT NULL AND timestamp <= %s ')
+    params = [userids, problemids, until]
+    if since is not None:
+        query += 'AND timestamp > %s '
+        params.append(since)
+    query += 'ORDER BY timestamp;'
+    cur.execute(query, tuple(params))
+    ret = cur.fetchall()
+
+    # Close database connection.
+    cur.close()
+
+    return ret
+
+# Given a group, the list of problems in its sets and a matrix of best scores
+# as returned by get_best_scores, build the per-set scores returned by
+# get_group_scores without touching the database.
+def group_scores_from_marks(group, problems, marks):
+    problem_index = dict((p.problemid, j) for (j, p) in enumerate(problems))
+
+    ret = []
+    for s in group.sets:
+        scores = []
+
+        # Number of problems in the set.
+        num_problems = len(s.problems)
+        columns = [problem_index[p.problemid] for p in s.problems]
+
+        for (user, user_marks) in zip(group.users, marks):
+            tot = 0
+            any_attempts = False
+            subs = []
+            for (problem, j) in zip(s.problems, columns):
+                sub = SubmissionScoreSummary(user, problem, mark=user_marks[j])
+                subs.append(sub)
+
+                if sub.mark:
+                    tot += sub.mark
+                    any_attempts = True
+
+            if any_attempts:
+                ave = tot/num_problems
+            else:
+                ave = None
+            scores.append(ProblemSetScores(s.name, s.title, s.public,
+                s.problems, ave, subs))
+
+        ret.append(scores)
+
+    return ret
+
 # Returns a User object based on competitorid or username None if user doesn't
 # exist. If both are given, only competitorid is used.
 def get_user(userid=None, username=None):
+    if userid:
+        ret = user_cache.get_by_id(userid)
+    elif username:
+        ret = user_cache.get_by_name(username)
+    else:
+        return None
+    if ret is not None:
+        return ret
+
     # Connect to database.
     conn = get_db()
     cur = conn.cursor()
 
-    if userid or username:
-        if userid:
-            cur.execute('SELECT id, username, firstname, lastname, school, '
-                'year, state, country FROM competitors WHERE id=%s', (userid, ))
-        elif username:
-            cur.execute('SELECT id, username, firstname, lastname, school, '
-                'year, state, country FROM competitors WHERE username=%s',
-                (username, ))
-        raw_result = cur.fetchone()
-        if raw_result:
-            ret = User(*raw_result)
-        else:
-            ret = None
+    if userid:
+        cur.execute('SELECT id, username, firstname, lastname, school, '
+            'year, state, country FROM competitors WHERE id=%s', (userid, ))
+    else:
+        cur.execute('SELECT id, username, firstname, lastname, school, '
+            'year, state, country FROM competitors WHERE username=%s',
+            (username, ))
+    raw_result = cur.fetchone()
+    if raw_result:
+        ret = User(*raw_result)
+        user_cache.put_entity(ret)
     else:
         ret = None
 
@@ -330,26 +1449,89 @@ def get_user(userid=None, username=None):
     
     return ret
 
+# Returns a mapping from competitorid to User object for each of the given
+# competitorids that exists, using at most one query for those not cached.
+def get_users_by_id(userids):
+    ret = {}
+    missing = []
+    for userid in userids:
+        user = user_cache.get_by_id(userid)
+        if user is not None:
+            ret[userid] = user
+        else:
+            missing.append(userid)
+    if not missing:
+        return ret
+
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
+
+    cur.execute('SELECT id, username, firstname, lastname, school, '
+        'year, state, country FROM competitors WHERE id = ANY(%s);',
+        (missing, ))
+    for r in cur.fetchall():
+        user = User(*r)
+        user_cache.put_entity(user)
+        ret[user.userid] = user
+
+    # Close database connection.
+    cur.close()
+
+    return ret
+
+# Returns a mapping from username to User object for each of the given
+# usernames that exists, using a single query.
+def get_users_by_name(usernames):
+    usernames = list(usernames)
+    if not usernames:
+        return {}
+
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
+
+    cur.execute('SELECT id, username, firstname, lastname, school, '
+        'year, state, country FROM competitors WHERE username = ANY(%s);',
+        (usernames, ))
+    ret = {}
+    for r in cur.fetchall():
+        user = User(*r)
+        user_cache.put_entity(user)
+        ret[user.username] = user
+
+    # Close database connection.
+    cur.close()
+
+    return ret
+
 # Returns a Problem object based on problemid or problemname or None if problem
 # doesn't exist. If both are given, only problemid is used.
 def get_problem(problemid=None, problemname=None):
+    if problemid:
+        ret = problem_cache.get_by_id(problemid)
+    elif problemname:
+        ret = problem_cache.get_by_name(problemname)
+    else:
+        return None
+    if ret is not None:
+        return ret
+
     # Connect to database.
     conn = get_db()
     cur = conn.cursor()
 
-    if problemid or problemname:
-        if problemid:
-            cur.execute('SELECT id, name, title '
-                'FROM problems WHERE id=%s', (problemid, ))
-        elif problemname:
-            cur.execute('SELECT id, name, title '
-                'FROM problems WHERE name=%s', (problemname, ))
-
-        raw_result = cur.fetchone()
-        if raw_result:
-            ret = Problem(*raw_result)
-        else:
-            ret = None
+    if problemid:
+        cur.execute('SELECT id, name, title '
+            'FROM problems WHERE id=%s', (problemid, ))
+    else:
+        cur.execute('SELECT id, name, title '
+            'FROM problems WHERE name=%s', (problemname, ))
+
+    raw_result = cur.fetchone()
+    if raw_result:
+        ret = Problem(*raw_result)
+        problem_cache.put_entity(ret)
     else:
         ret = None
 
@@ -360,22 +1542,32 @@ def get_problem(problemid=None, problemname=None):
 
 # Returns a ProblemSet object based on setname or None if problem doesn't exist.
 def get_set(setname=None):
+    if not setname:
+        return None
+    ret = set_cache.get(setname)
+    if ret is not None:
+        return ret
+
     # Connect to database.
     conn = get_db()
     cur = conn.cursor()
 
-    if setname:
-        cur.execute('SELECT name, title, public '
-            'FROM sets WHERE name=%s', (setname, ))
-
-        raw_result = cur.fetchone()
-        if raw_result:
-            cur.execute('SELECT problemid FROM set_contents WHERE set=%s;',
-                (setname, ))
-            problems = map(lambda x: get_problem(problemid=x[0]), cur.fetchall())
-            ret = ProblemSet(*raw_result, problems=problems)
-        else:
-            ret = None
+    cur.execute('SELECT name, title, public '
+        'FROM sets WHERE name=%s', (setname, ))
+
+    raw_result = cur.fetchone()
+    if raw_result:
+        # Fetch all of the set's problems at once, rather than with a
+        # get_problem per problem.
+        cur.execute('SELECT ' + _PROBLEM_COLUMNS + ' '
+            'FROM set_contents sc '
+            'INNER JOIN problems p ON (p.id = sc.problemid) '
+            'WHERE sc.set=%s;', (setname, ))
+        problems = map(lambda x: Problem(*x), cur.fetchall())
+        for problem in problems:
+            problem_cache.put_entity(problem)
+        ret = ProblemSet(*raw_result, problems=problems)
+        set_cache.put(setname, ret)
     else:
         ret = None
 
@@ -384,10 +1576,116 @@ def get_set(setname=None):
     
     return ret
 
+# Returns a mapping from set name to ProblemSet object for each of the given
+# set names that exists. Uses one query for the sets and one for all of their
+# problems.
+def get_sets_by_name(setnames):
+    setnames = list(setnames)
+    if not setnames:
+        return {}
+
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
+
+    cur.execute('SELECT name, title, public '
+        'FROM sets WHERE name = ANY(%s);', (setnames, ))
+    set_rows = cur.fetchall()
+
+    set_problems = dict((r[0], []) for r in set_rows)
+    problems = {}
+    if set_rows:
+        cur.execute('SELECT sc.set, ' + _PROBLEM_COLUMNS + ' '
+            'FROM set_contents sc '
+            'INNER JOIN problems p ON (p.id = sc.problemid) '
+            'WHERE sc.set = ANY(%s);', (list(set_problems), ))
+        for r in cur.fetchall():
+            problem = problems.get(r[1])
+            if problem is None:
+                problem = problems[r[1]] = Problem(*r[1:])
+                problem_cache.put_entity(problem)
+            set_problems[r[0]].append(problem)
+
+    ret = {}
+    for r in set_rows:
+        problem_set = ProblemSet(*r, problems=set_problems[r[0]])
+        set_cache.put(problem_set.name, problem_set)
+        ret[problem_set.name] = problem_set
+
+    # Close database connection.
+    cur.close()
+
+    return ret
+
+# Drops all cached users, problems and sets, e.g. after the training site's
+# problem list has been edited. Single entries can be dropped with
+# user_cache.invalidate_entity, problem_cache.invalidate_entity and
+# set_cache.invalidate.
+def clear_entity_caches():
+    user_cache.clear()
+    problem_cache.clear()
+    set_cache.clear()
+
+# Returns a mapping from cache name to its size and hit/miss counters.
+def entity_cache_stats():
+    return {
+        'users': user_cache.stats(),
+        'problems': problem_cache.stats(),
+        'sets': set_cache.stats(),
+    }
+
 # Returns a Group object based on groupname or None if group doesn't exist.
 # TODO(junkbot): Find a better way of specifying groups.
 def get_group(groupname=None):
-    return GROUPS.get(groupname)
+    return group_registry.get(groupname)
+
+# Builds Group objects from a mapping of group name to the keyword arguments of
+# Group.from_names, as in groups.GROUPS. However many groups there are, this
+# takes one query for all of their users, one for their sets and one for the
+# sets' problems. Usernames and set names that don't exist are left out.
+def load_groups(params):
+    usernames = set()
+    setnames = set()
+    for p in params.itervalues():
+        usernames.update(p.get('usernames', []))
+        setnames.update(p.get('setnames', []))
+    users = get_users_by_name(usernames)
+    sets = get_sets_by_name(setnames)
+
+    ret = {}
+    for (key, p) in params.iteritems():
+        ret[key] = Group(name=key, title=p.get('title', ''),
+            users=[users[x] for x in p.get('usernames', []) if x in users],
+            sets=[sets[x] for x in p.get('setnames', []) if x in sets])
+    return ret
+
+# Fills in num_attempts for each SubmissionSummary in subs that doesn't have it
+# yet, using a single query. Returns subs.
+def fill_num_attempts(subs):
+    missing = [sub for sub in subs if sub._num_attempts is None]
+    if not missing:
+        return subs
+
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
+
+    userids = set(sub.user.userid for sub in missing)
+    problemids = set(sub.problem.problemid for sub in missing)
+    cur.execute('SELECT competitorid, problemid, COUNT(*) '
+        'FROM submissions '
+        'WHERE competitorid=ANY(%s) AND problemid=ANY(%s) '
+        'GROUP BY competitorid, problemid;',
+        (list(userids), list(problemids), ))
+    counts = dict(((r[0], r[1]), int(r[2])) for r in cur.fetchall())
+
+    # Close database connection.
+    cur.close()
+
+    for sub in missing:
+        sub.num_attempts = counts.get(
+            (sub.user.userid, sub.problem.problemid), 0)
+    return subs
 
 # Returns the number of submissions a user has made to a problem.
 # TODO(junkbot): Apparently this is a bottleneck. FIXME.
@@ -407,152 +1705,397 @@ def get_num_attempts(userid, problemid):
     return ret
 
 # Returns a Submission object based on username, problename and attempt or None
-# if such a submission doesn't exist. 
+# if such a submission doesn't exist. attempt counts from 1, or from -1 for the
+# most recent attempt backwards.
 def get_submission(username=None, problemname=None, attempt=None):
+    return fetch_submission(username, problemname, attempt, with_source=True)
+
+# Like get_submission, but returns a SubmissionSummary, without reading the
+# submission's source or judging output.
+def get_submission_summary(username=None, problemname=None, attempt=None):
+    return fetch_submission(username, problemname, attempt, with_source=False)
+
+# Implementation of get_submission and get_submission_summary. Only the row for
+# the requested attempt is read; the number of attempts is counted over the
+# (user, problem) pair by a subquery in the same statement, which the
+# submissions_competitor_problem_attempt index answers on its own.
+def fetch_submission(username, problemname, attempt, with_source):
     try:
         # Convert attempt number to integer
         attempt = int(attempt)
+    except ValueError:
+        return None
+    if attempt == 0:
+        return None
 
-        # Connect to database.
-        conn = get_db()
-        cur = conn.cursor()
+    user = get_user(username=username)
+    problem = get_problem(problemname=problemname)
+    if not user or not problem:
+        return None
 
-        user = get_user(username=username)
-        problem = get_problem(problemname=problemname)
-
-        if user and problem:
-            query = ('SELECT s.attempt, s.mark, s.timestamp, s.submitted_file, '
-                'l.name, l.id, s.judge '
-                'FROM submissions s '
-                'INNER JOIN languages l ON (s.languageid = l.id) '
-                'WHERE s.competitorid=%s AND s.problemid=%s '
-                'ORDER BY s.attempt ASC;')
-            cur.execute(query, (user.userid, problem.problemid, ))
-            raw_results = cur.fetchall()
-            if (raw_results and attempt != 0
-                and abs(attempt) <= len(raw_results)):
-                if attempt > 0:
-                    attempt -= 1
-                raw_result = raw_results[attempt]
-                ret = Submission(user, problem, *raw_result)
-            else:
-                ret = None
-        else:
-            ret = None
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
 
-        # Close database connection.
-        cur.close()
-        
-    except ValueError:
+    # Attempts are numbered by their position in attempt order, from the start
+    # or (if negative) from the end.
+    if attempt > 0:
+        order = 'ASC'
+    else:
+        order = 'DESC'
+
+    if with_source:
+        fields = ('s.attempt, s.mark, s.timestamp, s.submitted_file, '
+            'l.name, l.id, s.judge, ')
+        join = 'INNER JOIN languages l ON (s.languageid = l.id) '
+    else:
+        fields = 's.attempt, s.mark, s.timestamp, '
+        join = ''
+    query = ('SELECT ' + fields + '('
+            'SELECT count(*) FROM submissions '
+            'WHERE competitorid=%(userid)s AND problemid=%(problemid)s) '
+        'FROM submissions s ' + join +
+        'WHERE s.competitorid=%(userid)s AND s.problemid=%(problemid)s '
+        'ORDER BY s.attempt ' + order + ' '
+        'OFFSET %(offset)s LIMIT 1;')
+    cur.execute(query, {
+        'userid': user.userid,
+        'problemid': problem.problemid,
+        'offset': abs(attempt) - 1,
+    })
+    raw_result = cur.fetchone()
+    if raw_result and with_source:
+        ret = Submission(user, problem, *raw_result[:-1],
+            num_attempts=int(raw_result[-1]))
+    elif raw_result:
+        ret = SubmissionSummary(user, problem, *raw_result[:-1],
+            num_attempts=int(raw_result[-1]))
+    else:
         ret = None
+
+    # Close database connection.
+    cur.close()
+
     return ret
 
-# Given a search string, looks for all users that contain that substring in
-# username, firstname or lastname.
-def user_search_query(substr):
-    # Add literal % on either side of the string for PSQL-style regex.
-    substr = '%%%s%%' % (substr.lower())
-    space = ' '
+# Given a search string, looks for users that contain that substring in
+# username, firstname or lastname. Exact and prefix matches on the username or
+# full name are ranked first. Returns a SearchPage of User objects for the
+# given page (counting from 0) of results.
+def user_search_query(substr, page=0):
+    terms = search_terms(substr)
+    if terms is None:
+        return SearchPage([], page)
 
     # Connect to database.
     conn = get_db()
     cur = conn.cursor()
 
-    query = ('SELECT id FROM competitors '
-        'WHERE lower(username) LIKE %s OR '
-        'lower(firstname) LIKE %s OR '
-        'lower(lastname) LIKE %s OR '
-        '(lower(firstname) || %s || lower(lastname)) LIKE %s '
-        'ORDER BY firstname, lastname;')
-    cur.execute(query, (substr, substr, substr, space, substr, ))
-    ret = map(lambda x: get_user(userid=x[0]), cur.fetchall())
+    query = ('SELECT id, username, firstname, lastname, school, '
+            'year, state, country '
+        'FROM competitors '
+        'WHERE lower(username) LIKE %(like)s OR '
+        'lower(firstname) LIKE %(like)s OR '
+        'lower(lastname) LIKE %(like)s OR '
+        "(lower(firstname) || ' ' || lower(lastname)) LIKE %(like)s "
+        'ORDER BY CASE '
+            'WHEN lower(username) = %(exact)s THEN 0 '
+            'WHEN lower(username) LIKE %(prefix)s OR '
+                "(lower(firstname) || ' ' || lower(lastname)) LIKE %(prefix)s "
+                'THEN 1 '
+            'ELSE 2 END, '
+        'firstname, lastname '
+        'LIMIT %(limit)s OFFSET %(offset)s;')
+    cur.execute(query, search_params(terms, page))
+    ret = SearchPage(map(lambda x: User(*x), cur.fetchall()), page)
 
     # Close database connection.
     cur.close()
     
     return ret
 
-# Given a search string, looks for all problems that contain that substring in
-# either name or title.
-def problem_search_query(substr):
-    # Add literal % on either side of the string for PSQL-style regex.
-    substr = '%%%s%%' % (substr.lower())
+# Given a search string, looks for problems that contain that substring in
+# either name or title, ranked as for user_search_query. Returns a SearchPage
+# of ProblemSearchResult objects for the given page of results.
+def problem_search_query(substr, page=0):
+    terms = search_terms(substr)
+    if terms is None:
+        return SearchPage([], page)
 
     # Connect to database.
     conn = get_db()
     cur = conn.cursor()
 
     query = ('SELECT id, name, title FROM problems WHERE '
-        'lower(title) LIKE %s OR lower(name) LIKE %s '
-        'ORDER BY id;')
-    cur.execute(query, (substr, substr, ))
-    ret = map(lambda x: ProblemSearchResult.from_problem(Problem(*x)),
-        cur.fetchall())
+        'lower(title) LIKE %(like)s OR lower(name) LIKE %(like)s '
+        'ORDER BY CASE '
+            'WHEN lower(name) = %(exact)s THEN 0 '
+            'WHEN lower(name) LIKE %(prefix)s OR '
+                'lower(title) LIKE %(prefix)s THEN 1 '
+            'ELSE 2 END, '
+        'id '
+        'LIMIT %(limit)s OFFSET %(offset)s;')
+    cur.execute(query, search_params(terms, page))
+    problems = map(lambda x: Problem(*x), cur.fetchall())
 
     # Close database connection.
     cur.close()
-    
-    return ret
+
+    # Look up the sets containing every problem on the page at once.
+    sets = sets_containing_problems(problems)
+    return SearchPage(map(lambda x: ProblemSearchResult(x,
+        sets.get(x.problemid, [])), problems), page)
+
+# Returns the lowercased search string used by the search queries, or None if
+# there is nothing to search for.
+def search_terms(substr):
+    substr = substr.strip().lower()
+    if not substr:
+        return None
+    return substr
+
+# Returns the parameters for a search query given its terms and the page of
+# results wanted. LIKE wildcards in the terms are escaped. One more result than
+# fits on a page is asked for, and SearchPage drops it after noting that there
+# is a next page.
+def search_params(terms, page):
+    escaped = (terms.replace('\\', '\\\\').replace('%', '\\%')
+        .replace('_', '\\_'))
+    return {
+        'exact': terms,
+        'prefix': '%s%%' % (escaped),
+        'like': '%%%s%%' % (escaped),
+        'limit': _SEARCH_LIMIT + 1,
+        'offset': page * _SEARCH_LIMIT,
+    }
 
 # Gets some general stats for a given problem to display on the problem's page
 # Returns a mapping from a stat's display name to a tuple containing the 
 # values for that stat. A stat can have multiple values e.g. if we are
-# looking at the stat over different time periods
+# looking at the stat over different time periods. The stats are kept in
+# memory by a ProblemStats for each problem and updated as submissions arrive.
 def problem_stats(problemid):
+    if submission_snapshot is not None:
+        submission_snapshot.start()
+        if submission_snapshot.ready:
+            return snapshot_problem_stats(problemid)
+
+    stats = _PROBLEM_STATS.get(problemid)
+    if stats is None:
+        stats = ProblemStats(problemid)
+        _PROBLEM_STATS.put(problemid, stats)
+    return stats.get_stats()
+
+# Labels for the bins of a score distribution.
+SCORE_BINS = ['%d-%d' % (10 * i, 10 * i + 9)
+    for i in range(analytics.NUM_SCORE_BINS - 1)] + ['100']
+
+# As for problem_stats, but computed from submission_snapshot, which must be
+# ready. Besides ProblemStats's statistics, includes the number of competitors
+# who have attempted the problem, the proportion of them who solved it, their
+# average best score and the distribution of best scores.
+def snapshot_problem_stats(problemid):
+    summary = submission_snapshot.problem_summary([problemid])
+    summary = dict((k, v[0]) for (k, v) in summary.items())
+    rows = problem_summary_rows(summary)
+
+    stats = OrderedDict()
+    stats["Total Solves"] = (summary['solved'], )
+    stats["Total Submissions"] = (summary['submissions'], )
+    stats["Average submissions per solve"] = (rows['subs_per_solve'], )
+    stats["Total users who've viewed this problem"] = (summary['viewers'], )
+    if summary['marked'] == 0:
+        stats["Average score per submission"] = ("N/A", )
+    else:
+        stats["Average score per submission"] = (
+            int(summary['mark_sum']/summary['marked']), )
+    stats["Total users who've attempted this problem"] = (
+        summary['attempted'], )
+    stats["Solve rate"] = (rows['solve_rate'], )
+    stats["Average best score"] = (rows['mean_best'], )
+    stats["Best score distribution"] = (rows['distribution'], )
+    return stats
+
+# Given the statistics for one problem from SubmissionSnapshot.problem_summary,
+# returns a mapping of the derived values shown on analytics pages, formatted
+# for display.
+def problem_summary_rows(summary):
+    ret = {}
+    if summary['solved'] == 0:
+        ret['subs_per_solve'] = "N/A"
+    else:
+        ret['subs_per_solve'] = summary['solver_submissions']/summary['solved']
+    if summary['attempted'] == 0:
+        ret['solve_rate'] = "N/A"
+    else:
+        ret['solve_rate'] = '%d%%' % (
+            100 * summary['solved'] // summary['attempted'])
+    if summary['scored'] == 0:
+        ret['mean_best'] = "N/A"
+    else:
+        ret['mean_best'] = summary['best_sum'] // summary['scored']
+    ret['distribution'] = ', '.join('%s: %d' % (label, n)
+        for (label, n) in zip(SCORE_BINS, summary['distribution']) if n)
+    return ret
+
+# Given a list of Problem objects, returns a row of analytics for each as for
+# problem_summary_rows, counting only the competitors in users (a list of User
+# objects) if given. With compare, each row also has the solve rate over all
+# competitors as overall_solve_rate.
+def problem_analytics(problems, users=None, compare=False):
+    problemids = [p.problemid for p in problems]
+    userids = None
+    if users is not None:
+        userids = [u.userid for u in users if u is not None]
+    summary = submission_snapshot.problem_summary(problemids, userids)
+    overall = None
+    if compare:
+        overall = submission_snapshot.problem_summary(problemids)
+
+    ret = []
+    for i in range(len(problems)):
+        row = problem_summary_rows(
+            dict((k, v[i]) for (k, v) in summary.items()))
+        row['attempted'] = summary['attempted'][i]
+        row['solved'] = summary['solved'][i]
+        row['viewers'] = summary['viewers'][i]
+        if overall is not None:
+            row['overall_solve_rate'] = problem_summary_rows(
+                dict((k, v[i]) for (k, v) in overall.items()))['solve_rate']
+        ret.append(row)
+    return ret
+
+# Given a problem, returns a row for each competitor who has submitted to it of
+# the form (competitorid, number of submissions, best mark, sum of marks,
+# number of marked submissions). If since is given, only competitors with a
+# submission to the problem made after since are included.
+def get_problem_competitor_stats(problemid, since=None):
+    # Connect to database.
     conn = get_db()
     cur = conn.cursor()
-    stats = {}
 
-    # Total number of competitors who scored 100
-    query = ('SELECT DISTINCT count(competitorid) '
-             'FROM submissions '
-             'WHERE problemid = %s AND mark = 100;')
-    cur.execute(query, (problemid, ))
-    total_solves = cur.fetchone()[0]
-    stats["Total Solves"] = (total_solves,)
+    query = ('SELECT competitorid, count(*), max(mark), sum(mark), '
+            'count(mark) '
+        'FROM submissions '
+        'WHERE problemid = %s ')
+    params = [problemid]
+    if since is not None:
+        query += ('AND competitorid IN ('
+            'SELECT competitorid FROM submissions '
+            'WHERE problemid = %s AND timestamp > %s) ')
+        params.extend([problemid, since])
+    query += 'GROUP BY competitorid;'
+    cur.execute(query, tuple(params))
+    ret = cur.fetchall()
 
-    # Total Submissions
-    query = ('SELECT count(*) '
-             'FROM submissions '
-             'WHERE problemid = %s;')
-    cur.execute(query, (problemid, ))
-    stats["Total Submissions"] = cur.fetchone()
-
-    # Average Submissions for people who solve the problem
-    if total_solves == 0:
-        stats["Average submissions per solve"] = ("N/A",)
-    else:
-        query = ('''SELECT count(t1.competitorid)
-                    FROM submissions as t1
-                    JOIN (
-                        SELECT DISTINCT competitorid
-                        FROM progress
-                        WHERE problemid = %s AND bestscore = 100
-                    ) as t2
-                    ON t1.competitorid = t2.competitorid
-                    WHERE t1.problemid = %s;''')
-        cur.execute(query, (problemid, problemid, ))
-        stats["Average submissions per solve"] = (cur.fetchone()[0]/
-                                                  total_solves, )
-
-    # How many people have viewed to the problem
-    query = ('SELECT DISTINCT count(competitorid) '
+    # Close database connection.
+    cur.close()
+
+    return ret
+
+# Returns the number of competitors who have viewed a problem.
+def get_problem_viewers(problemid):
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
+
+    query = ('SELECT count(competitorid) '
              'FROM progress '
              'WHERE problemid = %s;')
     cur.execute(query, (problemid, ))
-    stats["Total users who've viewed this problem"] = cur.fetchone()
+    ret = cur.fetchone()[0]
 
-    # Average score per submission
-    query = ('SELECT avg(mark) '
-             'FROM submissions '
-             'WHERE problemid = %s;')
-    cur.execute(query, (problemid, ))
-    stats["Average score per submission"] = (int(cur.fetchone()[0]), )
+    # Close database connection.
+    cur.close()
+
+    return ret
+
+# Returns a sort key for a time that may be None, with None last.
+def time_key(timestamp):
+    if timestamp is None:
+        return datetime.datetime.max
+    return timestamp
+
+# Orderings of the overall leaderboard, for rows of get_competitor_totals: by
+# number of problems solved, by total of best scores, and by time to solve
+# (the number solved, with ties going to whoever solved their last problem
+# first). Each breaks ties by the other two measures.
+LEADERBOARD_ORDERINGS = [
+    ('solved', lambda r: (-r[1], -r[2], time_key(r[3]))),
+    ('score', lambda r: (-r[2], -r[1], time_key(r[3]))),
+    ('time', lambda r: (-r[1], time_key(r[3]), -r[2])),
+]
+
+# Ordering of a problem's leaderboard, for rows of get_problem_progress: by
+# best score, with ties going to whoever got it first.
+PROBLEM_LEADERBOARD_ORDERINGS = [
+    ('score', lambda r: (-r[1], time_key(r[2]))),
+]
+
+# Returns a row for each competitor with a best score of the form
+# (competitorid, number of problems solved, total of best scores, time of the
+# last solve or None). If since is given, only competitors with a best score
+# set after since are included.
+def get_competitor_totals(since=None):
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
+
+    query = ('SELECT competitorid, '
+            'sum(CASE WHEN bestscore = 100 THEN 1 ELSE 0 END), '
+            'sum(bestscore), '
+            'max(CASE WHEN bestscore = 100 THEN bestscoreon END) '
+        'FROM progress '
+        'WHERE bestscore IS NOT NULL ')
+    params = []
+    if since is not None:
+        query += ('AND competitorid IN ('
+            'SELECT competitorid FROM progress WHERE bestscoreon > %s) ')
+        params.append(since)
+    query += 'GROUP BY competitorid;'
+    cur.execute(query, tuple(params))
+    ret = [(r[0], int(r[1]), int(r[2]), r[3]) for r in cur.fetchall()]
+
+    # Close database connection.
+    cur.close()
+
+    return ret
+
+# Returns a row of the form (competitorid, best score, time of best score) for
+# each competitor with a best score for a problem. If since is given, only
+# best scores set after since are included.
+def get_problem_progress(problemid, since=None):
+    # Connect to database.
+    conn = get_db()
+    cur = conn.cursor()
+
+    query = ('SELECT competitorid, bestscore, bestscoreon '
+        'FROM progress '
+        'WHERE problemid = %s AND bestscore IS NOT NULL ')
+    params = [problemid]
+    if since is not None:
+        query += 'AND bestscoreon > %s '
+        params.append(since)
+    query += ';'
+    cur.execute(query, tuple(params))
+    ret = [(r[0], int(r[1]), r[2]) for r in cur.fetchall()]
 
     # Close database connection.
     cur.close()
-    
-    return stats
+
+    return ret
+
+overall_leaderboard = Leaderboard(get_competitor_totals, LEADERBOARD_ORDERINGS)
+
+# Returns the Leaderboard for a problem, kept in memory for up to
+# _PROBLEM_LEADERBOARD_CACHE_SIZE problems.
+def problem_leaderboard(problemid):
+    board = _PROBLEM_LEADERBOARDS.get(problemid)
+    if board is None:
+        board = Leaderboard(functools.partial(get_problem_progress, problemid),
+            PROBLEM_LEADERBOARD_ORDERINGS)
+        _PROBLEM_LEADERBOARDS.put(problemid, board)
+    return board
 
 # Gives the most recent solves for a user
 def recent_solves(userid, max_solves=10):
@@ -560,39 +2103,50 @@ def recent_solves(userid, max_solves=10):
     conn = get_db()
     cur = conn.cursor()
     
-    query = ('''SELECT problemid, bestscoreon
-                FROM progress
-                WHERE competitorid = %s and bestscore = 100
-                ORDER BY bestscoreon DESC
+    query = ('''SELECT pr.bestscoreon, ''' + _PROBLEM_COLUMNS + '''
+                FROM progress pr
+                INNER JOIN problems p ON (p.id = pr.problemid)
+                WHERE pr.competitorid = %s and pr.bestscore = 100
+                ORDER BY pr.bestscoreon DESC
                 LIMIT %s;''')
 
     cur.execute(query, (userid, max_solves, ))
     solves = cur.fetchall()
     # Close database connection.
     cur.close()
-    
+
+    user = get_user(userid=userid)
     subs = []
     for s in solves:
-        subs.append(Submission(problem=get_problem(s[0]), 
-                               timestamp=s[1],
-                               user=get_user(userid=userid)))
-    return subs
-
-# Given a search string, looks for all sets that contain that substring in name
-# or title.
-def set_search_query(substr):
-    # Add literal % on either side of the string for PSQL-style regex.
-    substr = '%%%s%%' % (substr.lower())
+        problem = Problem(*s[1:])
+        problem_cache.put_entity(problem)
+        subs.append(SubmissionSummary(user, problem, mark=100,
+            timestamp=s[0]))
+    return fill_num_attempts(subs)
+
+# Given a search string, looks for sets that contain that substring in name or
+# title, ranked as for user_search_query. Returns a SearchPage of
+# ProblemSetBrief objects for the given page of results.
+def set_search_query(substr, page=0):
+    terms = search_terms(substr)
+    if terms is None:
+        return SearchPage([], page)
 
     # Connect to database.
     conn = get_db()
     cur = conn.cursor()
 
     query = ('SELECT name, title, public FROM sets '
-        'WHERE lower(name) LIKE %s OR lower(title) LIKE %s '
-        'ORDER BY name;')
-    cur.execute(query, (substr, substr, ))
-    ret = map(lambda x: ProblemSetBrief(*x), cur.fetchall())
+        'WHERE lower(name) LIKE %(like)s OR lower(title) LIKE %(like)s '
+        'ORDER BY CASE '
+            'WHEN lower(name) = %(exact)s THEN 0 '
+            'WHEN lower(name) LIKE %(prefix)s OR '
+                'lower(title) LIKE %(prefix)s THEN 1 '
+            'ELSE 2 END, '
+        'name '
+        'LIMIT %(limit)s OFFSET %(offset)s;')
+    cur.execute(query, search_params(terms, page))
+    ret = SearchPage(map(lambda x: ProblemSetBrief(*x), cur.fetchall()), page)
 
     # Close database connection.
     cur.close()
@@ -602,26 +2156,316 @@ def set_search_query(substr):
 # Given a Problem object, return a list of ProblemSetBrief objects that
 # represent all sets that contain this problem.
 def sets_containing_problem(problem):
+    return sets_containing_problems([problem]).get(problem.problemid, [])
+
+# Given a list of Problem objects, return a mapping from problemid to a list of
+# ProblemSetBrief objects representing all sets that contain that problem.
+# Problems in no sets are left out.
+def sets_containing_problems(problems):
+    if not problems:
+        return {}
+
     # Connect to database.
     conn = get_db()
     cur = conn.cursor()
 
-    query = ('SELECT name, title, public '
+    query = ('SELECT set_contents.problemid, name, title, public '
         'FROM sets, set_contents '
         'WHERE sets.name = set_contents.set AND '
-        'set_contents.problemid = %s '
+        'set_contents.problemid = ANY(%s) '
         'ORDER BY sets.name;')
-    cur.execute(query, (problem.problemid, ))
-    ret = map(lambda x: ProblemSetBrief(*x), cur.fetchall())
+    cur.execute(query, (map(lambda x: x.problemid, problems), ))
+    ret = {}
+    for r in cur.fetchall():
+        ret.setdefault(r[0], []).append(ProblemSetBrief(*r[1:]))
 
     # Close database connection.
     cur.close()
     
     return ret
 
+# Returns the timestamp of the most recent submission, as for
+# get_submission_watermark, reading it from the database at most every
+# _WATERMARK_POLL_INTERVAL seconds.
+def current_watermark():
+    now = time.time()
+    if (_watermark['read_at'] is None or
+        now - _watermark['read_at'] >= _WATERMARK_POLL_INTERVAL):
+        _watermark['value'] = get_submission_watermark()
+        _watermark['read_at'] = now
+    return _watermark['value']
+
+# Returns the response cache key for a view given its name and arguments. The
+# key includes the query string (in a canonical order) and the submission
+# watermark, so a new submission moves every view on to a new key.
+def response_cache_key(name, view_args):
+    args = sorted((k, sorted(request.args.getlist(k))) for k in request.args)
+    return repr(('page', name, sorted(view_args.items()), args,
+        str(current_watermark())))
+
+# Decorator for views whose rendered pages should be kept in the response
+# cache, for _PAGE_CACHE_TTLS[name of the view] seconds. Only pages rendered to
+# strings are cached; streamed and other responses are passed through.
+#
+# Identical requests that miss the cache at the same time (e.g. everyone
+# reloading the scoreboard when a contest ends) are coalesced: one of them
+# renders the page and the rest wait for it and share the result. Responses
+# that aren't strings can't be shared, so waiters make their own.
+def cached_view(f):
+    @functools.wraps(f)
+    def wrapper(**view_args):
+        key = response_cache_key(f.__name__, view_args)
+        ret = response_cache.get(key)
+        if ret is not None:
+            return ret
+
+        own_result = []
+        def render():
+            ret = f(**view_args)
+            own_result.append(ret)
+            if isinstance(ret, basestring):
+                response_cache.put(key, ret, _PAGE_CACHE_TTLS[f.__name__])
+                return ret
+            return None
+
+        ret = view_flight.do(key, render)
+        if own_result:
+            ret = own_result[0]
+        elif ret is None:
+            ret = f(**view_args)
+        return ret
+    return wrapper
+
+# Renders the recent_subs_table macro, reusing a cached rendering of the same
+# table if there is one. Tables are identified as pages are (by the request's
+# view, arguments and query string, and the submission watermark), along with
+# their position on the page and hidden fields, so a hit doesn't need to look
+# at the submissions at all. Templates call this in place of the macro itself.
+def cached_recent_subs_table(subs=[], hidden_fields=[]):
+    position = getattr(g, 'fragments', 0)
+    g.fragments = position + 1
+    key = response_cache_key(
+        repr(('fragment', request.endpoint, position, list(hidden_fields))),
+        request.view_args or {})
+    key = hashlib.sha1(key).hexdigest()
+    ret = response_cache.get(key)
+    if ret is None:
+        ret = get_template_attribute('recent_subs_table.html',
+            'recent_subs_table')(subs, hidden_fields)
+        response_cache.put(key, unicode(ret), _FRAGMENT_CACHE_TTL)
+    return Markup(ret)
+app.jinja_env.globals['recent_subs_table'] = cached_recent_subs_table
+
+# Renders a template as a generator of chunks rather than a single string.
+def stream_template(template_name, **context):
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    ret = template.stream(context)
+    ret.enable_buffering(_STREAM_BUFFER_SIZE)
+    return ret
+
+# If the current request asks for all submissions (with ?all=1), returns a
+# streamed page of every submission matching the filters given, as for
+# filter_submissions. Otherwise returns None.
+def stream_all_submissions(title, hidden_fields=[], users=None, sets=None,
+    problems=None):
+    if not request.args.get('all'):
+        return None
+    subs = stream_submissions(users=users, sets=sets, problems=problems)
+    return Response(stream_with_context(stream_template('subs_stream.html',
+        title=title, subs=subs, hidden_fields=hidden_fields)))
+
+# Yields (filename, source, timestamp) for every submission matching the
+# filters given, as for filter_submissions, ordered by user, problem and
+# attempt. Filenames are username-problem-attempt.langid, as for
+# user_problem_attempt_extract, and zip archives submitted as the 'zip'
+# language are decoded in the same way. Rows are read through a server-side
+# cursor, so only _EXPORT_FETCH_SIZE submissions are held in memory at once.
+def export_submissions(users=None, sets=None, problems=None):
+    conditions, params = submission_filter_conditions(users, sets, problems,
+        prefix='s.')
+    if conditions:
+        where_clause = 'WHERE %s ' % (' AND '.join(conditions))
+    else:
+        where_clause = ''
+    query = ('SELECT c.username, p.name, s.attempt, s.languageid, '
+            's.timestamp, s.submitted_file '
+        'FROM submissions s '
+        'INNER JOIN competitors c ON (c.id = s.competitorid) '
+        'INNER JOIN problems p ON (p.id = s.problemid) ' +
+        where_clause +
+        'ORDER BY c.username, p.name, s.attempt;')
+
+    # Connect to database, using a named (server-side) cursor.
+    conn = get_db()
+    cur = conn.cursor('export_submissions')
+    cur.itersize = _EXPORT_FETCH_SIZE
+    try:
+        cur.execute(query, tuple(params))
+        for (username, problemname, attempt, langid, timestamp,
+            source) in cur:
+            if langid == 'zip':
+                source = base64.b64decode(source)
+            yield ('%s-%s-%d.%s' % (username, problemname, attempt, langid),
+                source, timestamp)
+    finally:
+        # Close database connection.
+        cur.close()
+
+# Returns a response that streams a zip archive, named name.zip, of every
+# submission matching the filters given, as for export_submissions. The
+# archive is built as it is sent, so memory use doesn't grow with its size.
+def export_response(name, users=None, sets=None, problems=None):
+    members = export_submissions(users=users, sets=sets, problems=problems)
+    response = Response(stream_with_context(iter_zip(members)),
+        mimetype='application/zip')
+    response.headers['Content-Disposition'] = (
+        'attachment; filename=%s.zip' % (name))
+    return response
+
+# Reads new submissions for the live feed. Returns every submission after a
+# cursor in chronological order, and a cursor for _WATERMARK_SLACK before the
+# last of them, so the next call reads those again and picks up submissions
+# that were committed late or have been marked since (SubmissionFeed only
+# publishes what has changed). Given None, starts from _WATERMARK_SLACK before
+# the latest submission.
+def fetch_new_submissions(cursor):
+    with app.app_context():
+        if cursor is None:
+            cursor = recent_submissions_cursor()
+
+        ret = []
+        after = cursor
+        while True:
+            page = filter_submissions(after=after)
+            if not page:
+                break
+            ret.extend(reversed(page))
+            after = encode_cursor(ret[-1])
+            if not page.newer_cursor:
+                break
+        if ret:
+            cursor = encode_key((ret[-1].timestamp - _WATERMARK_SLACK, 0, 0,
+                0))
+        return ret, cursor
+
+# Returns a cursor for _WATERMARK_SLACK before the most recent submission. If
+# there are no submissions, the cursor is before any submission that could be
+# made.
+def recent_submissions_cursor():
+    watermark = get_submission_watermark()
+    if watermark is None:
+        return encode_key(('-infinity', 0, 0, 0))
+    return encode_key((watermark - _WATERMARK_SLACK, 0, 0, 0))
+
+# Returns the identity of a submission in the live feed, and the version of it
+# that was sent, for SubmissionFeed.
+def feed_key(sub):
+    return ((sub.user.userid, sub.problem.problemid, sub.attempt), sub.mark)
+
+# Returns a function telling whether a SubmissionSummary would be returned by
+# filter_submissions for the given users, sets and problems.
+def submission_matcher(users=None, sets=None, problems=None):
+    usernames = set(users or [])
+    filter_users = users is not None
+    problem_names = set(problems or [])
+    for setname in sets or []:
+        sett = get_set(setname=setname)
+        if sett:
+            problem_names.update(p.name for p in sett.problems)
+    filter_problems = bool(sets or problems)
+
+    def matches(sub):
+        if filter_users and sub.user.username not in usernames:
+            return False
+        if filter_problems and sub.problem.name not in problem_names:
+            return False
+        return True
+    return matches
+
+# Formats a SubmissionSummary as a Server-Sent Event. The event id is the
+# submission's cursor, so a reconnecting client's Last-Event-ID says where it
+# left off. Submissions that were sent before and have changed since (e.g. they
+# have been marked) are sent as "update" events rather than the default
+# "message".
+def submission_event(sub, update=False):
+    data = json.dumps({
+        'username': sub.user.username,
+        'firstname': sub.user.firstname,
+        'lastname': sub.user.lastname,
+        'problemname': sub.problem.name,
+        'problemtitle': sub.problem.title,
+        'attempt': sub.attempt,
+        'num_attempts': sub.num_attempts,
+        'mark': sub.mark,
+        'timestamp': str(sub.timestamp),
+    })
+    event = 'event: update\n' if update else ''
+    return '%sid: %s\ndata: %s\n\n' % (event, encode_cursor(sub), data)
+
+# Yields the rows of a query for submission_snapshot in lists of up to
+# _SNAPSHOT_FETCH_SIZE, read through a named (server-side) cursor. The snapshot
+# only reads on its background thread, outside of any request, so this runs in
+# its own app context with a connection from db_pool.
+def fetch_snapshot_rows(name, query, params=()):
+    with app.app_context():
+        conn = get_db()
+        cur = conn.cursor(name)
+        try:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(_SNAPSHOT_FETCH_SIZE)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            # Close database connection.
+            cur.close()
+
+# Reads submissions for submission_snapshot: all of them if since is None, or
+# else those made after since (in whole seconds since the epoch). Timestamps
+# are rounded down to whole seconds, so the rows after since are exactly those
+# made from the second after it; the snapshot drops the rows it holds after
+# since before adding these, and none are left in both.
+def fetch_snapshot_submissions(since):
+    query = ('SELECT competitorid, problemid, attempt, coalesce(mark, -1), '
+            'floor(extract(epoch from timestamp))::bigint '
+        'FROM submissions ')
+    params = ()
+    if since is not None:
+        query += "WHERE timestamp >= to_timestamp(%s) AT TIME ZONE 'UTC' "
+        params = (since + 1, )
+    query += 'ORDER BY timestamp;'
+    return fetch_snapshot_rows('snapshot_submissions', query, params)
+
+# Reads progress for submission_snapshot.
+def fetch_snapshot_progress():
+    return fetch_snapshot_rows('snapshot_progress',
+        'SELECT competitorid, problemid FROM progress;')
+
+if analytics.numpy is not None:
+    submission_snapshot = analytics.SubmissionSnapshot(
+        fetch_snapshot_submissions, fetch_snapshot_progress,
+        refresh_interval=_SNAPSHOT_REFRESH_INTERVAL,
+        progress_max_age=_SNAPSHOT_PROGRESS_MAX_AGE,
+        slack=int(_WATERMARK_SLACK.total_seconds()))
+else:
+    submission_snapshot = None
+
+# The feed LISTENs on its own connection rather than one from the pool, since
+# it holds it for as long as the process runs.
+submission_feed = SubmissionFeed(fetch_new_submissions, connect=connect_db,
+    channel=_FEED_CHANNEL, poll_interval=_FEED_POLL_INTERVAL,
+    queue_size=_FEED_QUEUE_SIZE, key=feed_key)
+
 @app.route('/')
+@cached_view
 def index():
-    subs = filter_submissions()
+    streamed = stream_all_submissions('All Submissions')
+    if streamed:
+        return streamed
+
+    subs = filter_submissions(**page_args())
     return render_template('index.html', subs=subs)
 
 # Page for a user.
@@ -630,11 +2474,18 @@ def index():
 def user_page(username):
     user = get_user(username=username)
     if user:
-        # Get recent submissions
-        subs = filter_submissions(users=[user.username])
-
-        # Get recent solves
-        solves = recent_solves(user.userid)
+        streamed = stream_all_submissions(
+            'All Submissions by %s %s (%s)' % (user.firstname, user.lastname,
+                user.username),
+            ['name', 'username'], users=[user.username])
+        if streamed:
+            return streamed
+
+        # Get recent submissions and recent solves at the same time.
+        subs, solves = query_fanout.run(
+            functools.partial(filter_submissions, users=[user.username],
+                **page_args()),
+            functools.partial(recent_solves, user.userid))
 
         return render_template('user_page.html', user=user, subs=subs, solves=solves)
     else:
@@ -646,11 +2497,17 @@ def user_page(username):
 def problem_page(problemname):
     problem = get_problem(problemname=problemname)
     if problem:
-        # Get submissions
-        subs = filter_submissions(problems=[problemname])
-
-        # Get problem stats
-        stats = problem_stats(problem.problemid)
+        streamed = stream_all_submissions(
+            'All Submissions for %s' % (problem.title),
+            ['problemtitle', 'problemname'], problems=[problemname])
+        if streamed:
+            return streamed
+
+        # Get submissions and problem stats at the same time.
+        subs, stats = query_fanout.run(
+            functools.partial(filter_submissions, problems=[problemname],
+                **page_args()),
+            functools.partial(problem_stats, problem.problemid))
 
         return render_template('problem_page.html', 
                                problem=problem, 
@@ -666,7 +2523,12 @@ def problem_page(problemname):
 def set_page(setname):
     sett = get_set(setname=setname)
     if sett:
-        subs = filter_submissions(sets=[setname])
+        streamed = stream_all_submissions(
+            'All Submissions for Set %s' % (sett.title), sets=[setname])
+        if streamed:
+            return streamed
+
+        subs = filter_submissions(sets=[setname], **page_args())
         return render_template('set_page.html', sett=sett, subs=subs)
     else:
         return 'Set does not exist'
@@ -678,7 +2540,16 @@ def user_problem(username, problemname):
     user = get_user(username=username)
     problem = get_problem(problemname=problemname)
     if user and problem:
-        subs = filter_submissions(users=[username], problems=[problemname])
+        streamed = stream_all_submissions(
+            'All Submissions by %s %s for Problem %s' % (user.firstname,
+                user.lastname, problem.title),
+            ['name', 'username', 'problemtitle', 'problemname', 'num_attempts'],
+            users=[username], problems=[problemname])
+        if streamed:
+            return streamed
+
+        subs = filter_submissions(users=[username], problems=[problemname],
+            **page_args())
         return render_template('user_problem.html', user=user, problem=problem,
             subs=subs)
     else:
@@ -691,7 +2562,15 @@ def user_set_page(username, setname):
     user = get_user(username=username)
     sett = get_set(setname=setname)
     if user and sett:
-        subs = filter_submissions(users=[username], sets=[setname])
+        streamed = stream_all_submissions(
+            'All Submissions by %s %s for Set %s' % (user.firstname,
+                user.lastname, sett.title),
+            ['name', 'username'], users=[username], sets=[setname])
+        if streamed:
+            return streamed
+
+        subs = filter_submissions(users=[username], sets=[setname],
+            **page_args())
         return render_template('user_set.html', user=user, sett=sett, subs=subs)
     else:
         return 'User or set does not exist'
@@ -700,9 +2579,22 @@ def user_set_page(username, setname):
 @app.route('/user/<username>/problem/<problem>/<attempt>/')
 @app.route('/user/<username>/problem/<problem>/<attempt>')
 def user_problem_attempt(username, problem, attempt):
+    # The page also shows the number of attempts, so that is part of its ETag.
+    # Only conditional requests check it against a summary first; others read
+    # the whole submission at once.
+    if request.if_none_match or request.if_modified_since:
+        summary = get_submission_summary(username, problem, attempt)
+        if summary and not submission_modified(summary, 'page',
+            summary.num_attempts):
+            return submission_cache_headers(Response(status=304), summary,
+                attempt, _SUBMISSION_PAGE_MAX_AGE, 'page',
+                summary.num_attempts)
+
     sub = get_submission(username, problem, attempt)
     if sub:
-        return render_template('submission.html', sub=sub)
+        response = make_response(render_template('submission.html', sub=sub))
+        return submission_cache_headers(response, sub, attempt,
+            _SUBMISSION_PAGE_MAX_AGE, 'page', sub.num_attempts)
     else:
         return 'Attempt doesn\'t exist.'
     
@@ -710,19 +2602,100 @@ def user_problem_attempt(username, problem, attempt):
 @app.route('/user/<username>/problem/<problem>/<attempt>/extract/')
 @app.route('/user/<username>/problem/<problem>/<attempt>/extract')
 def user_problem_attempt_extract(username, problem, attempt):
-    sub = get_submission(username, problem, attempt)
-    if sub:
+    summary = get_submission_summary(username, problem, attempt)
+    if not summary:
+        return 'Attempt doesn\'t exist.'
+    if not submission_modified(summary, 'extract'):
+        return submission_cache_headers(Response(status=304), summary,
+            attempt, _SUBMISSION_EXTRACT_MAX_AGE, 'extract')
+
+    # Decoded zip archives are kept on disk, so they don't need to be read from
+    # the database and decoded again.
+    sub = summary
+    archive = archive_cache.get(submission_etag(summary, 'extract'))
+    if archive is not None:
+        langid = 'zip'
+        response = make_response(archive)
+    else:
+        sub = get_submission(username, problem, attempt)
+        if not sub:
+            return 'Attempt doesn\'t exist.'
+        langid = sub.langid
         if sub.langid == 'zip':
-            response = make_response(base64.b64decode(sub.source))
+            archive = base64.b64decode(sub.source)
+            archive_cache.put(submission_etag(sub, 'extract'), archive)
+            response = make_response(archive)
         else:
             response = make_response(sub.source)
 
-        response.headers['Content-Disposition'] = (
-            'attachment; filename=%s-%s-%d.%s'
-        ) % (sub.user.username, sub.problem.name, sub.attempt, sub.langid)
-        return response
+    response.headers['Content-Disposition'] = (
+        'attachment; filename=%s-%s-%d.%s'
+    ) % (sub.user.username, sub.problem.name, sub.attempt, langid)
+    return submission_cache_headers(response, sub, attempt,
+        _SUBMISSION_EXTRACT_MAX_AGE, 'extract')
+
+# Download every submission to a set.
+@app.route('/set/<setname>/export/')
+@app.route('/set/<setname>/export')
+def set_export(setname):
+    sett = get_set(setname=setname)
+    if sett:
+        return export_response('set-%s' % (sett.name), sets=[sett.name])
     else:
-        return 'Attempt doesn\'t exist.'
+        return 'Set does not exist'
+
+# Download every submission by a user.
+@app.route('/user/<username>/export/')
+@app.route('/user/<username>/export')
+def user_export(username):
+    user = get_user(username=username)
+    if user:
+        return export_response('user-%s' % (user.username),
+            users=[user.username])
+    else:
+        return 'User does not exist'
+
+# Download every submission by a group's users.
+@app.route('/group/<groupname>/export/')
+@app.route('/group/<groupname>/export')
+def group_export(groupname):
+    group = get_group(groupname)
+    if group:
+        return export_response('group-%s' % (group.name),
+            users=map(lambda x: x.username, group.users))
+    else:
+        return 'Group does not exist.'
+
+# Returns a strong ETag for a submission. A submission never changes once it
+# has been judged, so it is identified by its user, problem, attempt and
+# timestamp. extra gives anything else the response depends on, e.g. which
+# page it is.
+def submission_etag(sub, *extra):
+    key = '|'.join(map(str, (sub.user.username, sub.problem.name, sub.attempt,
+        sub.timestamp, sub.mark) + extra))
+    return hashlib.sha1(key).hexdigest()
+
+# Returns whether the current request needs a new copy of a response about a
+# submission, i.e. it isn't a conditional GET for the version we would send.
+def submission_modified(sub, *extra):
+    return is_resource_modified(request.environ,
+        etag=submission_etag(sub, *extra), last_modified=sub.timestamp)
+
+# Sets the ETag, Last-Modified and Cache-Control headers on a response about a
+# submission. Responses for attempts counted from the end (such as -1 for the
+# latest attempt) or for submissions still being judged can change, so clients
+# must revalidate them; other responses can be kept for max_age seconds.
+def submission_cache_headers(response, sub, attempt, max_age, *extra):
+    response.set_etag(submission_etag(sub, *extra))
+    response.last_modified = sub.timestamp
+    response.cache_control.public = True
+    if int(attempt) > 0 and sub.mark is not None:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.max_age = 0
+        response.cache_control.must_revalidate = True
+    return response
+
 #@app.route('/filter')
 #def filter_test():
 #    q = filter_submissions(users=['junkbot','rayli'],
@@ -736,24 +2709,56 @@ def user_problem_attempt_extract(username, problem, attempt):
 # Group scoreboard.
 @app.route('/group/<groupname>/scoreboard/')
 @app.route('/group/<groupname>/scoreboard')
+@cached_view
 def group_scoreboard(groupname):
     group = get_group(groupname)
     if group:
-        groupMarks = GroupMarks(group, get_group_scores(group))
-        response = render_template('group_scoreboard.html', group=groupMarks)
+        at = request.args.get('at')
+        if at:
+            at = parse_time(at)
+            if at is None:
+                return 'Invalid time.'
+            groupMarks = get_group_marks_at(group, at)
+        else:
+            groupMarks = get_group_marks(group)
+        response = render_template('group_scoreboard.html', group=groupMarks,
+            at=at, timeline=scoreboard_timeline(at))
         return response
     else:
         return 'Group does not exist.'
 
+# Returns (label, time) links for moving a scoreboard shown as it was at a time
+# backwards and forwards in time. The time is None for the current scoreboard.
+# Submission timestamps are taken to be in UTC (as submission_snapshot does),
+# so the current time is too.
+def scoreboard_timeline(at):
+    base = at or datetime.datetime.utcnow().replace(second=0, microsecond=0)
+    steps = [('-1 day', datetime.timedelta(days=-1)),
+        ('-1 hour', datetime.timedelta(hours=-1))]
+    if at:
+        steps.extend([('+1 hour', datetime.timedelta(hours=1)),
+            ('+1 day', datetime.timedelta(days=1))])
+    ret = [(label, (base + step).strftime(_TIME_FORMATS[0]))
+        for (label, step) in steps]
+    if at:
+        ret.append(('Now', None))
+    return ret
+
 # Recent group submissions. Can be for any problem; not necessarily one in the
 # group's sets.
 @app.route('/group/<groupname>/subs/')
 @app.route('/group/<groupname>/subs')
+@cached_view
 def group_subs(groupname):
     group = get_group(groupname)
     if group:
         usernames = map(lambda x: x.username, group.users)
-        subs = filter_submissions(users=usernames)
+        streamed = stream_all_submissions(
+            'All Submissions by Group %s' % (group.title), users=usernames)
+        if streamed:
+            return streamed
+
+        subs = filter_submissions(users=usernames, **page_args())
         return render_template('group_subs.html',group=group,subs=subs)
     else:
         return 'Group does not exist.'
@@ -767,7 +2772,16 @@ def group_problem(groupname, problemname):
     problem = get_problem(problemname=problemname)
     if group and problem:
         usernames = map(lambda x: x.username, group.users)
-        subs = filter_submissions(users=usernames, problems=[problemname])
+        streamed = stream_all_submissions(
+            'All Submissions by Group %s for Problem %s' % (group.title,
+                problem.title),
+            ['problemtitle', 'problemname'], users=usernames,
+            problems=[problemname])
+        if streamed:
+            return streamed
+
+        subs = filter_submissions(users=usernames, problems=[problemname],
+            **page_args())
         return render_template('group_problem.html', group=group, problem=problem,
             subs=subs)
     else:
@@ -778,16 +2792,200 @@ def group_problem(groupname, problemname):
 # not.
 @app.route('/group/<groupname>/set/<setname>/')
 @app.route('/group/<groupname>/set/<setname>')
+@cached_view
 def group_set(groupname, setname):
     group = get_group(groupname)
     sett = get_set(setname=setname)
     if group and sett:
         usernames = map(lambda x: x.username, group.users)
-        subs = filter_submissions(users=usernames, sets=[setname])
+        streamed = stream_all_submissions(
+            'All Submissions by Group %s for Set %s' % (group.title,
+                sett.title),
+            users=usernames, sets=[setname])
+        if streamed:
+            return streamed
+
+        subs = filter_submissions(users=usernames, sets=[setname],
+            **page_args())
         return render_template('group_set.html',group=group,sett=sett,subs=subs)
     else:
         return 'Group or set does not exist.'
 
+# Renders an analytics page titled title, with a row for each of problems (a
+# list of Problem objects) counting only the competitors in users if given, as
+# for problem_analytics. Returns a 503 response if the snapshot the analytics
+# are computed from is still loading.
+def render_analytics(title, problems, users=None, compare=False):
+    if submission_snapshot is None:
+        return 'Analytics are not available.'
+    submission_snapshot.start()
+    if not submission_snapshot.ready:
+        response = make_response('Analytics are loading. Try again shortly.',
+            503)
+        response.headers['Retry-After'] = str(_SNAPSHOT_REFRESH_INTERVAL)
+        return response
+
+    col_header = ['Attempted', 'Solved', 'Solve rate']
+    if compare:
+        col_header.append('Solve rate (everyone)')
+    col_header.extend(['Submissions per solve', 'Average best score',
+        'Viewers', 'Best score distribution'])
+    stats = []
+    for row in problem_analytics(problems, users, compare):
+        values = [row['attempted'], row['solved'], row['solve_rate']]
+        if compare:
+            values.append(row['overall_solve_rate'])
+        values.extend([row['subs_per_solve'], row['mean_best'],
+            row['viewers'], row['distribution']])
+        stats.append(values)
+    return render_template('analytics.html', title=title, stats=stats,
+        col_header=col_header,
+        row_header=['%s (%s)' % (p.title, p.name) for p in problems])
+
+# Analytics for a set: how many competitors have attempted and solved each of
+# its problems, in the set's order, and how their best scores are distributed.
+@app.route('/set/<setname>/analytics/')
+@app.route('/set/<setname>/analytics')
+@cached_view
+def set_analytics(setname):
+    sett = get_set(setname=setname)
+    if sett:
+        return render_analytics('Analytics for Set %s' % (sett.title),
+            sett.problems)
+    else:
+        return 'Set does not exist'
+
+# Analytics for a group: as for set_analytics, for the problems in the group's
+# sets and counting only the group's users, alongside the solve rate of every
+# competitor.
+@app.route('/group/<groupname>/analytics/')
+@app.route('/group/<groupname>/analytics')
+@cached_view
+def group_analytics(groupname):
+    group = get_group(groupname)
+    if group:
+        return render_analytics('Analytics for Group %s' % (group.title),
+            group_problems(group), users=group.users, compare=True)
+    else:
+        return 'Group does not exist.'
+
+# Renders a page of a Leaderboard titled title. The ordering is given by the by
+# argument (the leaderboard's first by default) and the page, counting from 0,
+# by the page argument. With a user argument, the page that user is on is shown
+# instead, with them highlighted. columns is a list of (heading, function from a
+# leaderboard row to the value shown), and view_args are the view's arguments,
+# for linking to other pages.
+def render_leaderboard(title, board, columns, **view_args):
+    names = [name for (name, _) in board.orderings]
+    by = request.args.get('by')
+    if by not in names:
+        by = names[0]
+    page = search_page_arg()
+    highlight = None
+    username = request.args.get('user')
+    if username:
+        user = get_user(username=username)
+        rank = board.rank(by, user.userid) if user else None
+        if rank is None:
+            return 'User is not on this leaderboard.'
+        page = (rank - 1) // _LEADERBOARD_PAGE_SIZE
+        highlight = user.userid
+
+    rows, total = board.page(by, page * _LEADERBOARD_PAGE_SIZE,
+        _LEADERBOARD_PAGE_SIZE)
+    users = get_users_by_id([row[0] for (_, row) in rows])
+    entries = [(rank, users.get(row[0]), [fn(row) for (_, fn) in columns])
+        for (rank, row) in rows]
+
+    def link(**args):
+        args.update(view_args)
+        return url_for(request.endpoint, **args)
+    orderings = []
+    if len(names) > 1:
+        orderings = [(name, link(by=name)) for name in names]
+    return render_template('leaderboard.html', title=title, by=by,
+        orderings=orderings, columns=[heading for (heading, _) in columns],
+        entries=entries, highlight=highlight, total=total,
+        previous_url=link(by=by, page=page - 1) if page > 0 else None,
+        next_url=(link(by=by, page=page + 1)
+            if (page + 1) * _LEADERBOARD_PAGE_SIZE < total else None))
+
+# Leaderboard of every competitor with a best score, ranked by number of
+# problems solved, total score or time to solve (see LEADERBOARD_ORDERINGS).
+@app.route('/leaderboard/')
+@app.route('/leaderboard')
+def leaderboard():
+    return render_leaderboard('Leaderboard', overall_leaderboard, [
+        ('Solved', lambda r: r[1]),
+        ('Total Score', lambda r: r[2]),
+        ('Last Solve', lambda r: r[3] or ''),
+    ])
+
+# Leaderboard for a problem, ranked by best score and then by when it was got.
+@app.route('/problem/<problemname>/leaderboard/')
+@app.route('/problem/<problemname>/leaderboard')
+def problem_leaderboard_page(problemname):
+    problem = get_problem(problemname=problemname)
+    if problem:
+        return render_leaderboard('Leaderboard for %s' % (problem.title),
+            problem_leaderboard(problem.problemid), [
+                ('Best Score', lambda r: r[1]),
+                ('Achieved', lambda r: r[2] or ''),
+            ], problemname=problemname)
+    else:
+        return 'Problem does not exist'
+
+# Live feed of new submissions, as Server-Sent Events. Takes any number of
+# user, problem and set arguments and a group argument, which filter the feed
+# as for filter_submissions. Clients reconnecting with a Last-Event-ID are
+# first sent the submissions they missed.
+@app.route('/feed')
+def feed():
+    users = request.args.getlist('user') or None
+    sets = request.args.getlist('set')
+    problems = request.args.getlist('problem')
+    if request.args.get('group'):
+        group = get_group(request.args.get('group'))
+        if not group:
+            return 'Group does not exist.'
+        users = (users or []) + map(lambda x: x.username, group.users)
+
+    subscription = submission_feed.subscribe(
+        submission_matcher(users, sets, problems))
+    missed = []
+    if request.headers.get('Last-Event-ID'):
+        missed = list(reversed(filter_submissions(users, sets, problems,
+            after=request.headers.get('Last-Event-ID'))))
+
+    def stream():
+        try:
+            sent = set()
+            for sub in missed:
+                sent.add(feed_key(sub))
+                yield submission_event(sub)
+
+            while not subscription.closed:
+                try:
+                    sub, update = subscription.queue.get(
+                        timeout=_FEED_KEEPALIVE)
+                except Queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                # Skip anything already sent as a missed submission.
+                if feed_key(sub) not in sent:
+                    yield submission_event(sub, update)
+        finally:
+            submission_feed.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Metrics for Prometheus to scrape, in its text format.
+@app.route('/metrics')
+def export_metrics():
+    return Response(metrics.render(),
+        mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 # Correctly route search queries.
 @app.route('/search/handle')
 def search_handle():
@@ -803,25 +3001,327 @@ def search_handle():
 @app.route('/search/problem')
 def search_problem():
     query = request.args.get('query','')
-    problems_res = problem_search_query(query)
-    sets_res = set_search_query(query)
+    page = search_page_arg()
+    problems_res, sets_res = query_fanout.run(
+        functools.partial(problem_search_query, query, page),
+        functools.partial(set_search_query, query, page))
     return render_template(
         'search_problem.html',
         query=query,
+        page=page,
+        has_more=problems_res.has_more or sets_res.has_more,
         sets_res=sets_res,
         problems_res=problems_res)
 
 @app.route('/search/user')
 def search_user():
     query = request.args.get('query','')
-    users_res = user_search_query(query)
+    page = search_page_arg()
+    users_res = user_search_query(query, page)
     return render_template(
         'search_user.html',
         query=query,
+        page=page,
+        has_more=users_res.has_more,
         users_res=users_res)
 
-# Convert group.GROUPS into GROUPS.
-with app.app_context():
-    GROUPS = dict(
-        (key, Group.from_names(name=key, **params)) for (key, params) in
-            groups.GROUPS.iteritems())
+# Returns the page of search results asked for in the current request's query
+# string, counting from 0.
+def search_page_arg():
+    try:
+        return max(0, int(request.args.get('page', 0)))
+    except ValueError:
+        return 0
+
+# JSON API.
+#
+# The API mirrors the scoreboard, user, problem, set and search pages. Rather
+# than an object per submission or scoreboard cell, responses are columnar:
+# parallel arrays of ids, marks and so on, with each user and problem they
+# refer to described once in a "users" or "problems" dictionary keyed by id.
+
+# Decorator for API views. Views return a JSON string, or None if what was
+# asked for doesn't exist. Responses get an ETag that is a hash of the body, so
+# clients can revalidate with If-None-Match and skip downloading what they
+# already have, and are gzipped if the client accepts it. The body is still
+# built to compare against, since parts of it (cached pages, statistics and
+# group definitions) change on their own schedules, not just with the
+# submission watermark.
+def api_view(f):
+    @functools.wraps(f)
+    def wrapper(**view_args):
+        body = f(**view_args)
+        if body is None:
+            return Response(api_json({'error': 'Not found'}), status=404,
+                mimetype='application/json')
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        gzipped = request.accept_encodings['gzip'] > 0
+        etag = hashlib.sha1(body).hexdigest()
+        if gzipped:
+            etag += '-gzip'
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype='application/json')
+            if gzipped and len(body) >= _API_GZIP_MIN_SIZE:
+                response.data = gzip_data(body)
+                response.headers['Content-Encoding'] = 'gzip'
+
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+def gzip_data(data):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    compressor = zlib.compressobj(_API_GZIP_LEVEL, zlib.DEFLATED,
+        16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+# Returns an API response body, with the API version added.
+def api_json(data):
+    data['version'] = _API_VERSION
+    return json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+def api_time(timestamp):
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp.isoformat()
+    return timestamp
+
+# Adds users to a dictionary of users keyed by id, for an API response, and
+# returns their ids.
+def api_users(users, user_dict):
+    for user in users:
+        if str(user.userid) not in user_dict:
+            user_dict[str(user.userid)] = {
+                'username': user.username,
+                'firstname': user.firstname,
+                'lastname': user.lastname,
+                'school': user.school,
+                'year': user.year,
+                'state': user.state,
+                'country': user.country,
+            }
+    return [user.userid for user in users]
+
+# Adds problems to a dictionary of problems keyed by id, for an API response,
+# and returns their ids.
+def api_problems(problems, problem_dict):
+    for problem in problems:
+        if str(problem.problemid) not in problem_dict:
+            problem_dict[str(problem.problemid)] = {
+                'name': problem.name,
+                'title': problem.title,
+            }
+    return [problem.problemid for problem in problems]
+
+# Returns the columns of a list of SubmissionSummary objects, adding their
+# users and problems to the given dictionaries. For a SubmissionPage, the
+# cursors of the next pages are included too.
+def api_submissions(subs, user_dict, problem_dict):
+    ret = {
+        'user': api_users([sub.user for sub in subs], user_dict),
+        'problem': api_problems([sub.problem for sub in subs], problem_dict),
+        'attempt': [sub.attempt for sub in subs],
+        'mark': [sub.mark for sub in subs],
+        'timestamp': [api_time(sub.timestamp) for sub in subs],
+        'num_attempts': [sub.num_attempts for sub in subs],
+    }
+    if isinstance(subs, SubmissionPage):
+        ret['older'] = subs.older_cursor
+        ret['newer'] = subs.newer_cursor
+    return ret
+
+# Returns the columns of a list of ProblemSetBrief objects, along with the ids
+# of their problems for ProblemSet objects.
+def api_sets(sets, problem_dict):
+    ret = {
+        'name': [s.name for s in sets],
+        'title': [s.title for s in sets],
+        'public': [s.public for s in sets],
+    }
+    if all(isinstance(s, ProblemSet) for s in sets):
+        ret['problems'] = [api_problems(s.problems, problem_dict)
+            for s in sets]
+    return ret
+
+# A group's scoreboard. marks has a row for each user in user_ids and a column
+# for each problem in problem_ids, holding the user's best mark or null if
+# they haven't attempted the problem; set_marks likewise holds each user's
+# average mark for each set.
+@app.route(_API_PREFIX + '/group/<groupname>/scoreboard/')
+@app.route(_API_PREFIX + '/group/<groupname>/scoreboard')
+@api_view
+@cached_view
+def api_group_scoreboard(groupname):
+    group = get_group(groupname)
+    if not group:
+        return None
+
+    group_marks = get_group_marks(group)
+    problems = group_problems(group)
+    problem_index = dict((p.problemid, j) for (j, p) in enumerate(problems))
+    marks = [[None] * len(problems) for _ in group.users]
+    for set_scores in group_marks.marks:
+        for (i, scores) in enumerate(set_scores):
+            for sub in scores.subs:
+                marks[i][problem_index[sub.problem.problemid]] = sub.mark
+
+    user_dict = {}
+    problem_dict = {}
+    return api_json({
+        'group': {'name': group.name, 'title': group.title},
+        'user_ids': api_users(group.users, user_dict),
+        'problem_ids': api_problems(problems, problem_dict),
+        'sets': api_sets(group.sets, problem_dict),
+        'marks': marks,
+        'set_marks': [[scores.mark for scores in set_scores]
+            for set_scores in group_marks.marks],
+        'users': user_dict,
+        'problems': problem_dict,
+    })
+
+@app.route(_API_PREFIX + '/user/<username>/')
+@app.route(_API_PREFIX + '/user/<username>')
+@api_view
+def api_user_page(username):
+    user = get_user(username=username)
+    if not user:
+        return None
+
+    subs, solves = query_fanout.run(
+        functools.partial(filter_submissions, users=[user.username],
+            **page_args()),
+        functools.partial(recent_solves, user.userid))
+
+    user_dict = {}
+    problem_dict = {}
+    return api_json({
+        'user': api_users([user], user_dict)[0],
+        'submissions': api_submissions(subs, user_dict, problem_dict),
+        'solves': api_submissions(solves, user_dict, problem_dict),
+        'users': user_dict,
+        'problems': problem_dict,
+    })
+
+@app.route(_API_PREFIX + '/problem/<problemname>/')
+@app.route(_API_PREFIX + '/problem/<problemname>')
+@api_view
+def api_problem_page(problemname):
+    problem = get_problem(problemname=problemname)
+    if not problem:
+        return None
+
+    subs, stats = query_fanout.run(
+        functools.partial(filter_submissions, problems=[problemname],
+            **page_args()),
+        functools.partial(problem_stats, problem.problemid))
+
+    user_dict = {}
+    problem_dict = {}
+    return api_json({
+        'problem': api_problems([problem], problem_dict)[0],
+        'stats': dict((k, v[0]) for (k, v) in stats.items()),
+        'submissions': api_submissions(subs, user_dict, problem_dict),
+        'users': user_dict,
+        'problems': problem_dict,
+    })
+
+@app.route(_API_PREFIX + '/set/<setname>/')
+@app.route(_API_PREFIX + '/set/<setname>')
+@api_view
+def api_set_page(setname):
+    sett = get_set(setname=setname)
+    if not sett:
+        return None
+
+    subs = filter_submissions(sets=[setname], **page_args())
+
+    user_dict = {}
+    problem_dict = {}
+    return api_json({
+        'set': {
+            'name': sett.name,
+            'title': sett.title,
+            'public': sett.public,
+            'problems': api_problems(sett.problems, problem_dict),
+        },
+        'submissions': api_submissions(subs, user_dict, problem_dict),
+        'users': user_dict,
+        'problems': problem_dict,
+    })
+
+@app.route(_API_PREFIX + '/search/user')
+@api_view
+def api_search_user():
+    page = search_page_arg()
+    users_res = user_search_query(request.args.get('query', ''), page)
+
+    user_dict = {}
+    return api_json({
+        'page': page,
+        'has_more': users_res.has_more,
+        'user_ids': api_users(users_res, user_dict),
+        'users': user_dict,
+    })
+
+# Problems and sets matching a search. problem_sets holds the names of the sets
+# containing each problem in problem_ids.
+@app.route(_API_PREFIX + '/search/problem')
+@api_view
+def api_search_problem():
+    query = request.args.get('query', '')
+    page = search_page_arg()
+    problems_res, sets_res = query_fanout.run(
+        functools.partial(problem_search_query, query, page),
+        functools.partial(set_search_query, query, page))
+
+    problem_dict = {}
+    return api_json({
+        'page': page,
+        'has_more': problems_res.has_more or sets_res.has_more,
+        'problem_ids': api_problems([r.problem for r in problems_res],
+            problem_dict),
+        'problem_sets': [[s.name for s in r.sets] for r in problems_res],
+        'sets': api_sets(sets_res, problem_dict),
+        'problems': problem_dict,
+    })
+
+# Groups from groups.GROUPS, built when first needed.
+group_registry = GroupRegistry(groups, _GROUPS_CHECK_INTERVAL)
+
+# Export the pool, cache, coalescing, feed and group statistics alongside the
+# request histograms. The running totals in each are exported as counters.
+_CACHE_COUNTERS = ('hits', 'misses', 'evictions')
+_POOL_COUNTERS = ('checkouts', 'waits', 'wait_time', 'timeouts', 'created',
+    'discarded')
+metrics.add_collector('queries', query_metrics.stats,
+    counters=('queries', 'rows', 'db_time', 'slow_queries'))
+metrics.add_collector('pool', db_pool.stats, counters=_POOL_COUNTERS)
+metrics.add_collector('fanout_pool', fanout_pool.stats,
+    counters=_POOL_COUNTERS)
+metrics.add_collector('entity_cache', entity_cache_stats, label='cache',
+    counters=_CACHE_COUNTERS)
+metrics.add_collector('response_cache', response_cache.stats,
+    counters=_CACHE_COUNTERS)
+metrics.add_collector('archive_cache', archive_cache.stats,
+    counters=_CACHE_COUNTERS)
+metrics.add_collector('problem_stats_cache', _PROBLEM_STATS.stats,
+    counters=_CACHE_COUNTERS)
+metrics.add_collector('view_flight', view_flight.stats,
+    counters=('calls', 'coalesced', 'timeouts'))
+metrics.add_collector('feed', submission_feed.stats,
+    counters=('notifications', 'polls', 'sent', 'updates', 'dropped'))
+metrics.add_collector('groups', group_registry.stats,
+    counters=('loads', 'errors'))
+metrics.add_collector('leaderboard', overall_leaderboard.stats)
+metrics.add_collector('problem_leaderboard_cache', _PROBLEM_LEADERBOARDS.stats,
+    counters=_CACHE_COUNTERS)
+if submission_snapshot is not None:
+    metrics.add_collector('snapshot', submission_snapshot.stats,
+        counters=('refreshes', 'errors'))
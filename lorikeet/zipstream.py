@@ -0,0 +1,52 @@
+# zipstream.py
+#
+# Streamed zip archives for Project Lorikeet.
+
+import datetime
+import zipfile
+
+# A write-only file for ZipFile that keeps what is written until it is taken
+# with drain(). ZipFile only needs write and tell when writing members with
+# writestr, so the archive never has to be seekable.
+class _ZipOutput(object):
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        ret = b''.join(self.chunks)
+        self.chunks = []
+        return ret
+
+# Yields the bytes of a zip archive of members, an iterable of (filename,
+# data, timestamp), where timestamp is a datetime or None. Each member is
+# compressed and handed out as soon as it is read, so only one member's data is
+# held at a time, along with a small directory entry for each member that is
+# written at the end.
+def iter_zip(members, compression=zipfile.ZIP_DEFLATED):
+    out = _ZipOutput()
+    archive = zipfile.ZipFile(out, 'w', compression, allowZip64=True)
+    for (filename, data, timestamp) in members:
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        # Zip archives can't hold times before 1980.
+        timestamp = max(timestamp, datetime.datetime(1980, 1, 1))
+        info = zipfile.ZipInfo(filename, timestamp.timetuple()[:6])
+        info.compress_type = compression
+        info.external_attr = 0o644 << 16
+        archive.writestr(info, data)
+        chunk = out.drain()
+        if chunk:
+            yield chunk
+    archive.close()
+    yield out.drain()
@@ -1,4 +1,4 @@
 #!/usr/bin/python
 from lorikeet import app
-#app.run(port=3178, debug=True)
-app.run(port=3178)
+#app.run(port=3178, debug=True, threaded=True)
+app.run(port=3178, threaded=True)